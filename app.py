@@ -1,8 +1,12 @@
 import copy
 import json
+import asyncio
+import functools
 import os
 import logging
 import uuid
+from datetime import datetime
+from types import MappingProxyType
 from dotenv import load_dotenv
 import httpx
 from azure.storage.blob import BlobServiceClient
@@ -22,28 +26,50 @@ from quart import (
     request,
     send_from_directory,
     render_template,
+    current_app,
 )
 
 from openai import AsyncAzureOpenAI
-from azure.identity.aio import (
-    DefaultAzureCredential,
-    get_bearer_token_provider
-)
+from azure.identity.aio import get_bearer_token_provider
 from backend.auth.auth_utils import get_authenticated_user_details
+from backend.auth.credential_manager import (
+    CachedTokenCredential,
+    AZURE_OPENAI_SCOPE,
+    cosmosdb_scope,
+)
 from backend.security.ms_defender_utils import get_msdefender_user_json
+from backend.http_pool import create_pooled_http_client, get_pool_statistics
+from backend.admission import AdmissionController, AdmissionRejected, AdmittedStream
+from backend.cache import TTLCache
+from backend.context_window import ContextWindow
 from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.semantic_cache import SemanticCache
+from backend.single_flight import SingleFlight
+from backend.completion_cache import (
+    CompletionCache,
+    InMemoryCompletionCacheBackend,
+    RecordingStream,
+    RedisCompletionCacheBackend,
+    entry_from_completion,
+    format_cached_response,
+    format_cached_stream_as_ndjson,
+    make_cache_key,
+)
 from backend.settings import (
     app_settings,
     MINIMUM_SUPPORTED_AZURE_OPENAI_PREVIEW_API_VERSION
 )
 from backend.utils import (
-    format_as_ndjson,
-    format_stream_response,
+    closeGraphClient,
+    format_stream_as_ndjson,
     generateFilterString,
     generateFilterStringForConversation, parse_multi_columns,
     format_non_streaming_response,
     convert_to_pf_format,
     format_pf_non_streaming_response,
+    log_request_body,
+    StreamCancellationTracker,
+    StreamCoalescer,
 )
 from azure.search.documents.indexes.models import SearchIndexerDataContainer, SearchIndexerDataSourceConnection, SearchIndexer
 
@@ -74,6 +100,93 @@ def create_app():
     app.config["TEMPLATES_AUTO_RELOAD"] = True
     if DOCUPLOAD_MAX_SIZE_MB:
         app.config['MAX_CONTENT_LENGTH'] = int(DOCUPLOAD_MAX_SIZE_MB) * 1024 * 1024
+    app.azure_credential = None
+    app.azure_openai_client = None
+    app.cosmos_conversation_client = None
+    app.stream_coalescer = (
+        StreamCoalescer(
+            max_bytes=app_settings.azure_openai.stream_coalescing_max_bytes,
+            window_ms=app_settings.azure_openai.stream_coalescing_window_ms,
+        )
+        if app_settings.azure_openai.stream_coalescing else None
+    )
+    app.stream_cancellations = StreamCancellationTracker()
+    app.completion_cache = None
+    app.semantic_cache = None
+    app.single_flight = SingleFlight() if app_settings.azure_openai.single_flight else None
+    app.context_window = (
+        ContextWindow(
+            model=app_settings.azure_openai.model,
+            token_budget=app_settings.azure_openai.history_token_budget,
+        )
+        if app_settings.azure_openai.history_token_budget else None
+    )
+    app.admission = (
+        AdmissionController(
+            max_concurrency=app_settings.azure_openai.max_concurrent_requests,
+            max_queue_depth=app_settings.azure_openai.max_queued_requests,
+            queue_timeout=app_settings.azure_openai.queue_timeout,
+        )
+        if app_settings.azure_openai.max_concurrent_requests else None
+    )
+    # Delete-all jobs started by this worker, by user id
+    app.history_purges = TTLCache(max_size=1024, ttl=3600)
+
+    @app.before_serving
+    async def init():
+        # One credential chain and token cache for every Azure client in this worker
+        app.azure_credential = CachedTokenCredential()
+        token_scopes = []
+        if not app_settings.azure_openai.key:
+            token_scopes.append(AZURE_OPENAI_SCOPE)
+        if app_settings.chat_history and not app_settings.chat_history.account_key:
+            token_scopes.append(cosmosdb_scope(get_cosmosdb_endpoint()))
+        app.azure_credential.start(*token_scopes)
+
+        try:
+            app.azure_openai_client = init_openai_client(app.azure_credential)
+        except Exception:
+            ## chat requests fail with a clear error, the other routes keep working
+            logging.exception("Failed to initialize the Azure OpenAI client")
+            app.azure_openai_client = None
+        try:
+            app.completion_cache = init_completion_cache()
+        except Exception:
+            logging.exception("Failed to initialize the completion cache")
+            app.completion_cache = None
+        if app.azure_openai_client:
+            app.semantic_cache = init_semantic_cache(app.azure_openai_client)
+        if app.context_window:
+            await asyncio.to_thread(app.context_window.load_encoding)
+        if SHOULD_USE_DATA:
+            try:
+                get_data_source_template()
+            except Exception:
+                logging.exception("Invalid data source configuration")
+        try:
+            app.cosmos_conversation_client = init_cosmosdb_client(app.azure_credential)
+            if app.cosmos_conversation_client:
+                await app.cosmos_conversation_client.warm_up()
+        except Exception:
+            logging.exception("Failed to initialize CosmosDB client")
+            app.cosmos_conversation_client = None
+
+    @app.after_serving
+    async def shutdown():
+        if app.azure_openai_client:
+            await app.azure_openai_client.close()
+            app.azure_openai_client = None
+        if app.cosmos_conversation_client:
+            await app.cosmos_conversation_client.close()
+            app.cosmos_conversation_client = None
+        if app.completion_cache:
+            await app.completion_cache.close()
+            app.completion_cache = None
+        if app.azure_credential:
+            await app.azure_credential.close()
+            app.azure_credential = None
+        await closeGraphClient()
+
     return app
 
 
@@ -366,7 +479,7 @@ SHOULD_USE_DATA = should_use_data()
 
 
 # Initialize Azure OpenAI Client
-def init_openai_client():
+def init_openai_client(azure_credential):
     azure_openai_client = None
     try:
         # API version check
@@ -399,7 +512,7 @@ def init_openai_client():
         if not aoai_api_key:
             logging.debug("No AZURE_OPENAI_KEY found, using Azure AD auth")
             ad_token_provider = get_bearer_token_provider(
-                DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default"
+                azure_credential, AZURE_OPENAI_SCOPE
             )
 
         # Deployment
@@ -410,12 +523,21 @@ def init_openai_client():
         # Default Headers
         default_headers = {"x-ms-useragent": USER_AGENT}
 
+        # One connection pool per worker, reused by every chat request
+        http_client = create_pooled_http_client(
+            max_connections=app_settings.azure_openai.max_connections,
+            max_keepalive_connections=app_settings.azure_openai.max_keepalive_connections,
+            keepalive_expiry=app_settings.azure_openai.keepalive_expiry,
+            http2=app_settings.azure_openai.http2,
+        )
+
         azure_openai_client = AsyncAzureOpenAI(
             api_version=app_settings.azure_openai.preview_api_version,
             api_key=aoai_api_key,
             azure_ad_token_provider=ad_token_provider,
             default_headers=default_headers,
             azure_endpoint=endpoint,
+            http_client=http_client,
         )
 
         return azure_openai_client
@@ -425,16 +547,18 @@ def init_openai_client():
         raise e
 
 
-def init_cosmosdb_client():
+def get_cosmosdb_endpoint():
+    return f"https://{app_settings.chat_history.account}.documents.azure.com:443/"
+
+
+def init_cosmosdb_client(azure_credential):
     cosmos_conversation_client = None
     if app_settings.chat_history:
         try:
-            cosmos_endpoint = (
-                f"https://{app_settings.chat_history.account}.documents.azure.com:443/"
-            )
+            cosmos_endpoint = get_cosmosdb_endpoint()
 
             if not app_settings.chat_history.account_key:
-                credential = DefaultAzureCredential()
+                credential = azure_credential
             else:
                 credential = app_settings.chat_history.account_key
 
@@ -444,6 +568,7 @@ def init_cosmosdb_client():
                 database_name=app_settings.chat_history.database,
                 container_name=app_settings.chat_history.conversations_container,
                 enable_message_feedback=app_settings.chat_history.enable_feedback,
+                conversation_cache_ttl=app_settings.chat_history.conversation_cache_ttl,
             )
         except Exception as e:
             logging.exception("Exception in CosmosDB initialization", e)
@@ -454,11 +579,45 @@ def init_cosmosdb_client():
 
     return cosmos_conversation_client
 
-def get_configured_data_source(conversation_id):
+def init_completion_cache():
+    settings = app_settings.completion_cache
+    if not settings.enabled:
+        return None
+
+    if settings.backend == "redis":
+        backend = RedisCompletionCacheBackend(settings.redis_url, ttl=settings.ttl)
+    else:
+        backend = InMemoryCompletionCacheBackend(max_size=settings.max_size, ttl=settings.ttl)
+    logging.debug(f"Completion cache enabled with the {settings.backend} backend")
+    return CompletionCache(backend)
+
+
+def init_semantic_cache(azure_openai_client):
+    settings = app_settings.semantic_cache
+    if not settings.enabled:
+        return None
+
+    embedding_model = settings.embedding_model or app_settings.azure_openai.embedding_name
+    if not embedding_model:
+        logging.error(
+            "Semantic cache is enabled but no embedding deployment is configured "
+            "(SEMANTIC_CACHE_EMBEDDING_MODEL or AZURE_OPENAI_EMBEDDING_NAME) -- semantic cache disabled"
+        )
+        return None
+
+    return SemanticCache(
+        azure_openai_client,
+        embedding_model,
+        similarity_threshold=settings.similarity_threshold,
+        ttl=settings.ttl,
+        max_entries=settings.max_entries,
+        first_turn_only=settings.first_turn_only,
+    )
+
+
+def build_data_source_template():
     data_source = {}
     query_type = "simple"
-    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user['user_principal_id']
     if DATASOURCE_TYPE == "AzureCognitiveSearch":
         # Set query type
         if AZURE_SEARCH_QUERY_TYPE:
@@ -469,24 +628,6 @@ def get_configured_data_source(conversation_id):
         ):
             query_type = "semantic"
 
-        # Set filter
-        filter = None
-        userToken = None
-        if AZURE_SEARCH_PERMITTED_GROUPS_COLUMN:
-            userToken = request.headers.get("X-MS-TOKEN-AAD-ACCESS-TOKEN", "")
-            logging.debug(f"USER TOKEN is {'present' if userToken else 'not present'}")
-            if not userToken:
-                raise Exception(
-                    "Document-level access control is enabled, but user access token could not be fetched."
-                )
-
-            filter = generateFilterString(userToken)
-            logging.debug(f"FILTER: {filter}")
-
-        
-        # Filter data by conversation
-        filter = generateFilterStringForConversation(filter, user_id, conversation_id)
-
         # Set authentication
         authentication = {}
         if AZURE_SEARCH_KEY:
@@ -537,7 +678,6 @@ def get_configured_data_source(conversation_id):
                     else ""
                 ),
                 "role_information": AZURE_OPENAI_SYSTEM_MESSAGE,
-                "filter": filter,
                 "strictness": (
                     int(AZURE_SEARCH_STRICTNESS)
                     if AZURE_SEARCH_STRICTNESS
@@ -786,15 +926,92 @@ def get_configured_data_source(conversation_id):
             )
         data_source["parameters"]["embedding_dependency"] = embeddingDependency
 
-    return data_source
+    # Freeze the resolved payload; requests only ever read from it
+    data_source["parameters"] = MappingProxyType(data_source["parameters"])
+    return MappingProxyType(data_source)
+
+
+_data_source_template = None
+
+
+def get_data_source_template():
+    ## the static part of the data source payload only depends on configuration,
+    ## so it is resolved once per worker and reused by every chat request
+    global _data_source_template
+    if _data_source_template is None:
+        _data_source_template = build_data_source_template()
+    return _data_source_template
+
+
+async def get_configured_data_source(conversation_id):
+    template = get_data_source_template()
+    parameters = dict(template["parameters"])
+
+    if DATASOURCE_TYPE == "AzureCognitiveSearch":
+        authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+        user_id = authenticated_user['user_principal_id']
+
+        # Set filter
+        filter = None
+        userToken = None
+        if AZURE_SEARCH_PERMITTED_GROUPS_COLUMN:
+            userToken = request.headers.get("X-MS-TOKEN-AAD-ACCESS-TOKEN", "")
+            logging.debug(f"USER TOKEN is {'present' if userToken else 'not present'}")
+            if not userToken:
+                raise Exception(
+                    "Document-level access control is enabled, but user access token could not be fetched."
+                )
+
+            filter = await generateFilterString(userToken)
+            logging.debug(f"FILTER: {filter}")
+
+        # Filter data by conversation
+        parameters["filter"] = generateFilterStringForConversation(filter, user_id, conversation_id)
+
+    return {"type": template["type"], "parameters": parameters}
 
 
-def prepare_model_args(request_body, request_headers):
+async def apply_conversation_summary(request_messages, conversation_id, request_headers):
+    ## the turns covered by the conversation's rolling summary are replaced by the summary
+    cosmos_conversation_client = current_app.cosmos_conversation_client
+    if not (conversation_id and cosmos_conversation_client and app_settings.chat_history.summarize_after_messages):
+        return None, request_messages
+
+    try:
+        user_id = get_authenticated_user_details(request_headers)["user_principal_id"]
+        summary = await cosmos_conversation_client.get_conversation_summary(user_id, conversation_id)
+    except Exception as e:
+        logging.warning(f"Could not read the summary of conversation {conversation_id}: {e}")
+        return None, request_messages
+
+    if summary:
+        for index, message in enumerate(request_messages):
+            if message.get("id") == summary["lastMessageId"]:
+                summary_message = {"role": "assistant", "content": SUMMARY_PREFIX + summary["content"]}
+                if "tokenCount" in summary:
+                    summary_message["tokenCount"] = summary["tokenCount"]
+                return summary_message, request_messages[index + 1:]
+    return None, request_messages
+
+
+async def prepare_model_args(request_body, request_headers):
     request_messages = request_body.get("messages", [])
-    # conversation_id = request_body.get('conversation_id', None)
-    # if conversation_id is None:
-    #     conversation_id = request_body['history_metadata']['conversation_id']
-    print(f"Messages array {request_messages}")
+    conversation_id = request_body.get("conversation_id", None)
+    if conversation_id is None:
+        conversation_id = request_body.get("history_metadata", {}).get("conversation_id", None)
+
+    summary_message, request_messages = await apply_conversation_summary(
+        request_messages, conversation_id, request_headers
+    )
+    if current_app.context_window:
+        ## keep the newest turns that fit the budget; the system message is sent with every
+        ## request (as role information with data sources), so it is pinned with the summary
+        pinned = [{"role": "system", "content": AZURE_OPENAI_SYSTEM_MESSAGE}]
+        if summary_message:
+            pinned.append(summary_message)
+        request_messages = current_app.context_window.fit(request_messages, pinned=pinned)
+    if summary_message:
+        request_messages = [summary_message] + request_messages
 
     messages = []
     if not SHOULD_USE_DATA:
@@ -825,43 +1042,9 @@ def prepare_model_args(request_body, request_headers):
     }
 
     if SHOULD_USE_DATA:
-        model_args["extra_body"] = {"data_sources": [get_configured_data_source(conversation_id)]}
-
-    model_args_clean = copy.deepcopy(model_args)
-    if model_args_clean.get("extra_body"):
-        secret_params = [
-            "key",
-            "connection_string",
-            "embedding_key",
-            "encoded_api_key",
-            "api_key",
-        ]
-        for secret_param in secret_params:
-            if model_args_clean["extra_body"]["data_sources"][0]["parameters"].get(
-                secret_param
-            ):
-                model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                    secret_param
-                ] = "*****"
-        authentication = model_args_clean["extra_body"]["data_sources"][0][
-            "parameters"
-        ].get("authentication", {})
-        for field in authentication:
-            if field in secret_params:
-                model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                    "authentication"
-                ][field] = "*****"
-        embeddingDependency = model_args_clean["extra_body"]["data_sources"][0][
-            "parameters"
-        ].get("embedding_dependency", {})
-        if "authentication" in embeddingDependency:
-            for field in embeddingDependency["authentication"]:
-                if field in secret_params:
-                    model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                        "embedding_dependency"
-                    ]["authentication"][field] = "*****"
-
-    logging.debug(f"REQUEST BODY: {json.dumps(model_args_clean, indent=4)}")
+        model_args["extra_body"] = {"data_sources": [await get_configured_data_source(conversation_id)]}
+
+    log_request_body(model_args, app_settings.base_settings.request_log_sample_rate)
 
     return model_args
 
@@ -934,7 +1117,7 @@ async def docupload_delete_by_tag(tagName, tagValue):
             count = count + 1
         logging.debug(f"Deleted {count} index document {DOCUPLOAD_INDEX_DOCUMENT_KEY} from {AZURE_SEARCH_INDEX} tagged with {query}")
 
-async def send_chat_request(request_body, request_headers):
+async def prepare_chat_request(request_body, request_headers):
     filtered_messages = []
     messages = request_body.get("messages", [])
     for message in messages:
@@ -942,21 +1125,82 @@ async def send_chat_request(request_body, request_headers):
             filtered_messages.append(message)
             
     request_body['messages'] = filtered_messages
-    model_args = prepare_model_args(request_body, request_headers)
+    return await prepare_model_args(request_body, request_headers)
+
 
+async def send_model_request(model_args):
+    azure_openai_client = current_app.azure_openai_client
+    if not azure_openai_client:
+        raise Exception("Azure OpenAI is not configured correctly, see the server log for details")
     try:
-        azure_openai_client = init_openai_client()
         raw_response = await azure_openai_client.chat.completions.with_raw_response.create(**model_args)
         response = raw_response.parse()
         apim_request_id = raw_response.headers.get("apim-request-id") 
     except Exception as e:
-        logging.exception("Exception in send_chat_request")
+        logging.exception("Exception in send_model_request")
         raise e
 
     return response, apim_request_id
 
 
-async def complete_chat_request(request_body, request_headers):
+async def send_admitted_model_request(model_args, request_headers, admitted=False):
+    ## waits for a slot of this worker's admission controller when one is configured and
+    ## the request does not hold one already; a streamed response keeps its slot until the
+    ## stream has been read or closed
+    admission = current_app.admission
+    if not admission or admitted:
+        return await send_model_request(model_args)
+
+    user_id = get_authenticated_user_details(request_headers)["user_principal_id"]
+    lease = await admission.acquire(user_id)
+    try:
+        response, apim_request_id = await send_model_request(model_args)
+    except BaseException:
+        lease.release()
+        raise
+    if model_args.get("stream"):
+        return AdmittedStream(response, lease), apim_request_id
+    lease.release()
+    return response, apim_request_id
+
+
+async def lookup_cached_completion(request_body, model_args):
+    '''
+    Look the request up in the configured response caches, exact match first.
+    Returns the cached entry, or None and a coroutine function that stores the
+    answer to this request in every cache that missed (None if no cache applies).
+    '''
+    store_callbacks = []
+
+    completion_cache = current_app.completion_cache
+    if completion_cache:
+        cache_key = completion_cache.make_key(model_args)
+        entry = await completion_cache.get(cache_key)
+        if entry:
+            return entry, None
+        store_callbacks.append(functools.partial(completion_cache.set, cache_key))
+
+    semantic_cache = current_app.semantic_cache
+    if semantic_cache:
+        entry, slot = await semantic_cache.lookup(request_body.get("messages", []), model_args)
+        if entry:
+            if completion_cache:
+                await completion_cache.set(cache_key, entry)
+            return entry, None
+        if slot:
+            store_callbacks.append(functools.partial(semantic_cache.set, slot))
+
+    if not store_callbacks:
+        return None, None
+
+    async def store_in_cache(entry):
+        for store in store_callbacks:
+            await store(entry)
+
+    return None, store_in_cache
+
+
+async def complete_chat_request(request_body, request_headers, admitted=False):
     if app_settings.base_settings.use_promptflow:
         response = await promptflow_request(request_body)
         history_metadata = request_body.get("history_metadata", {})
@@ -967,35 +1211,167 @@ async def complete_chat_request(request_body, request_headers):
             app_settings.promptflow.citations_field_name
         )
     else:
-        response, apim_request_id = await send_chat_request(request_body, request_headers)
+        model_args = await prepare_chat_request(request_body, request_headers)
         history_metadata = request_body.get("history_metadata", {})
+
+        entry, store_in_cache = await lookup_cached_completion(request_body, model_args)
+        if entry:
+            return format_cached_response(entry, history_metadata)
+
+        single_flight = current_app.single_flight
+        if single_flight and not model_args.get("user"):
+            response, apim_request_id = await single_flight.call(
+                ("complete", make_cache_key(model_args)),
+                lambda: send_admitted_model_request(model_args, request_headers, admitted),
+            )
+        else:
+            response, apim_request_id = await send_admitted_model_request(model_args, request_headers, admitted)
+        if store_in_cache:
+            await store_in_cache(entry_from_completion(response))
         return format_non_streaming_response(response, history_metadata, apim_request_id)
 
 
-async def stream_chat_request(request_body, request_headers):
-    response, apim_request_id = await send_chat_request(request_body, request_headers)
+async def stream_chat_request(request_body, request_headers, admitted=False):
+    model_args = await prepare_chat_request(request_body, request_headers)
     history_metadata = request_body.get("history_metadata", {})
-    
-    async def generate():
-        async for completionChunk in response:
-            yield format_stream_response(completionChunk, history_metadata, apim_request_id)
 
-    return generate()
+    entry, store_in_cache = await lookup_cached_completion(request_body, model_args)
+    if entry:
+        return format_cached_stream_as_ndjson(entry, history_metadata)
+
+    async def open_stream():
+        response, apim_request_id = await send_admitted_model_request(model_args, request_headers, admitted)
+        if store_in_cache:
+            response = RecordingStream(response, store_in_cache)
+        return response, apim_request_id
+
+    single_flight = current_app.single_flight
+    # Identical concurrent requests share one upstream stream; requests carrying
+    # Defender user context are sent on their own so it reaches the service
+    if single_flight and not model_args.get("user"):
+        response = await single_flight.stream(("stream", make_cache_key(model_args)), open_stream)
+        apim_request_id = response.apim_request_id
+    else:
+        response, apim_request_id = await open_stream()
+
+    return format_stream_as_ndjson(
+        response,
+        history_metadata,
+        apim_request_id,
+        coalescer=current_app.stream_coalescer,
+        cancellation_tracker=current_app.stream_cancellations,
+        max_tokens=app_settings.azure_openai.max_tokens,
+    )
+
+
+# History writes that outlive their request (e.g. after a client disconnect)
+_history_writes = set()
+
+
+def start_history_write(coro):
+    task = asyncio.create_task(coro)
+    _history_writes.add(task)
+    task.add_done_callback(_history_write_done)
+    return task
+
+
+def _history_write_done(task):
+    _history_writes.discard(task)
+    if not task.cancelled() and task.exception():
+        logging.error("Exception while saving conversation history", exc_info=task.exception())
+
+
+def with_token_count(message):
+    ## stored with the message so the context window does not count it again on later turns
+    if not current_app.context_window:
+        return message
+    return {**message, "tokenCount": current_app.context_window.count_tokens(message)}
+
+
+async def write_user_message(cosmos_conversation_client, user_id, conversation_id, message, new_conversation=None):
+    if new_conversation:
+        await cosmos_conversation_client.create_conversation(
+            user_id=user_id,
+            title=new_conversation["title"],
+            conversation_id=conversation_id,
+            created_at=new_conversation["created_at"],
+        )
+
+    createdMessageValue = await cosmos_conversation_client.create_message(
+        uuid=str(uuid.uuid4()),
+        conversation_id=conversation_id,
+        user_id=user_id,
+        input_message=message,
+    )
+    if createdMessageValue == "Conversation not found":
+        raise Exception(
+            "Conversation not found for the given conversation ID: "
+            + conversation_id
+            + "."
+        )
 
 
-async def conversation_internal(request_body, request_headers):
+async def finish_history_write(stream, history_write):
+    ## the response only ends once the history write has completed, so a failure
+    ## is still reported to the client
+    try:
+        async for line in stream:
+            yield line
+
+        try:
+            await history_write
+        except Exception as e:
+            yield json.dumps({"error": f"Chat history could not be saved: {e}"})
+    finally:
+        await stream.aclose()
+
+
+def admission_rejected_response(ex):
+    logging.warning(f"Request not admitted: {ex}")
+    return jsonify({"error": str(ex)}), ex.status_code, {"Retry-After": str(ex.retry_after)}
+
+
+async def release_after_stream(stream):
+    ## the AdmittedStream releases its slot even when the response body is never read
+    try:
+        async for line in stream:
+            yield line
+    finally:
+        await stream.close()
+
+
+async def conversation_internal(request_body, request_headers, history_write=None, lease=None):
+    ## `lease` is an admission slot the caller acquired already; it is held until the
+    ## response has been sent
+    admitted = lease is not None
     try:
         if app_settings.azure_openai.stream:
-            result = await stream_chat_request(request_body, request_headers)
-            response = await make_response(format_as_ndjson(result))
+            result = await stream_chat_request(request_body, request_headers, admitted)
+            if history_write:
+                result = finish_history_write(result, history_write)
+            if lease:
+                result = release_after_stream(AdmittedStream(result, lease))
+            response = await make_response(result)
             response.timeout = None
             response.mimetype = "application/json-lines"
             return response
         else:
-            result = await complete_chat_request(request_body, request_headers)
+            try:
+                result = await complete_chat_request(request_body, request_headers, admitted)
+            finally:
+                if lease:
+                    lease.release()
+            if history_write:
+                await history_write
             return jsonify(result)
 
     except Exception as ex:
+        if lease:
+            lease.release()
+        if history_write:
+            await asyncio.wait({history_write})
+        if isinstance(ex, AdmissionRejected):
+            return admission_rejected_response(ex)
         logging.exception(ex)
         if hasattr(ex, "status_code"):
             return jsonify({"error": str(ex)}), ex.status_code
@@ -1010,7 +1386,6 @@ async def conversation():
     if not request.is_json:
         return jsonify({"error": "request must be json"}), 415
     request_json = await request.get_json()
-    print(f"request_json {request_json}")
     return await conversation_internal(request_json, request.headers)
 
 
@@ -1021,28 +1396,88 @@ def get_frontend_settings():
     except Exception as e:
         logging.exception("Exception in /frontend_settings")
         return jsonify({"error": str(e)}), 500
+
+
+@bp.route("/diagnostics", methods=["GET"])
+async def get_diagnostics():
+    if not app_settings.base_settings.diagnostics_enabled:
+        return jsonify({"error": "Not found"}), 404
+    if (
+        app_settings.base_settings.auth_enabled
+        and "X-Ms-Client-Principal-Id" not in request.headers
+    ):
+        return jsonify({"error": "Authentication required"}), 401
+
+    try:
+        azure_openai_client = current_app.azure_openai_client
+        diagnostics = {
+            "azure_openai_pool": get_pool_statistics(
+                azure_openai_client._client if azure_openai_client else None
+            ),
+            "azure_credential": (
+                current_app.azure_credential.get_statistics()
+                if current_app.azure_credential else {}
+            ),
+            "stream_coalescing": (
+                current_app.stream_coalescer.get_statistics()
+                if current_app.stream_coalescer else {}
+            ),
+            "stream_cancellations": current_app.stream_cancellations.get_statistics(),
+            "completion_cache": (
+                current_app.completion_cache.get_statistics()
+                if current_app.completion_cache else {}
+            ),
+            "semantic_cache": (
+                current_app.semantic_cache.get_statistics()
+                if current_app.semantic_cache else {}
+            ),
+            "single_flight": (
+                current_app.single_flight.get_statistics()
+                if current_app.single_flight else {}
+            ),
+            "admission": (
+                current_app.admission.get_statistics()
+                if current_app.admission else {}
+            ),
+            "context_window": (
+                current_app.context_window.get_statistics()
+                if current_app.context_window else {}
+            ),
+            "conversation_cache": (
+                current_app.cosmos_conversation_client.conversation_cache.get_statistics()
+                if current_app.cosmos_conversation_client else {}
+            ),
+        }
+        return jsonify(diagnostics), 200
+    except Exception as e:
+        logging.exception("Exception in /diagnostics")
+        return jsonify({"error": str(e)}), 500
     
+def get_search_credential():
+    if AZURE_SEARCH_KEY:
+        return AzureKeyCredential(AZURE_SEARCH_KEY)
+    # No key configured: use the worker's shared AAD credential
+    return current_app.azure_credential
+
+
 @bp.route("/document/index", methods=["POST"])
 async def index_document():
     # Upload the created file
     try:
         data = await request.get_json()
         uniqueName = data['indexName']
-        credential = AzureKeyCredential(AZURE_SEARCH_KEY)
-        # Rest of the code...
 
-        indexer_client = SearchIndexerClient(AZURE_SEARCH_ENDPOINT, credential)
-        
-        indexer = await indexer_client.get_indexer(DOCUPLOAD_AZURE_SEARCH_INDEXER)
+        async with SearchIndexerClient(AZURE_SEARCH_ENDPOINT, get_search_credential()) as indexer_client:
+            indexer = await indexer_client.get_indexer(DOCUPLOAD_AZURE_SEARCH_INDEXER)
 
-        # Create a new indexer with a GUID added to the name
-        new_indexer_name = indexer.name + '-' + uniqueName
-        new_indexer = copy.deepcopy(indexer)
-        new_indexer.name = new_indexer_name
-        new_indexer.parameters.configuration.indexed_file_name_extensions = f".{uniqueName}"
+            # Create a new indexer with a GUID added to the name
+            new_indexer_name = indexer.name + '-' + uniqueName
+            new_indexer = copy.deepcopy(indexer)
+            new_indexer.name = new_indexer_name
+            new_indexer.parameters.configuration.indexed_file_name_extensions = f".{uniqueName}"
 
-        # create indexer clone - newly created indexers will automatically run
-        await indexer_client.create_indexer(new_indexer)
+            # create indexer clone - newly created indexers will automatically run
+            await indexer_client.create_indexer(new_indexer)
 
         return jsonify({"indexer_name": new_indexer_name}), 200
     except Exception as e:
@@ -1059,16 +1494,15 @@ async def get_indexer_status():
             logging.exception("Exception in /indexer/status request json")
             return jsonify({"error": str(e)}), 500
             
-        credential = AzureKeyCredential(AZURE_SEARCH_KEY)
-        indexer_client = SearchIndexerClient(AZURE_SEARCH_ENDPOINT, credential)
-        indexer_status = await indexer_client.get_indexer_status(indexer_name)
-        status = "notStarted"
-        # Parse and add variables for each piece of information that the status check returns
-        if (indexer_status.last_result is not None): 
-            status = str(indexer_status.last_result.status)
-        
-        if (status == "success" or status == "transientFailure"):
-            await indexer_client.delete_indexer(indexer_name)
+        async with SearchIndexerClient(AZURE_SEARCH_ENDPOINT, get_search_credential()) as indexer_client:
+            indexer_status = await indexer_client.get_indexer_status(indexer_name)
+            status = "notStarted"
+            # Parse and add variables for each piece of information that the status check returns
+            if (indexer_status.last_result is not None): 
+                status = str(indexer_status.last_result.status)
+            
+            if (status == "success" or status == "transientFailure"):
+                await indexer_client.delete_indexer(indexer_name)
 
         return jsonify({"status": status}), 200
     except Exception as e:
@@ -1105,17 +1539,21 @@ async def upload_document():
     except Exception as e:
         try:
             # make sure cosmos is configured
-            cosmos_conversation_client = init_cosmosdb_client()
+            cosmos_conversation_client = current_app.cosmos_conversation_client
             if not cosmos_conversation_client:
                 raise Exception("CosmosDB is not configured or not working")
 
             # check for the conversation_id, if the conversation is not set, we will create a new one
             history_metadata = {}
-            title = await generate_title([{'role': 'user', 'content': filename}])
+            title_messages = [{'role': 'user', 'content': filename}]
+            title = get_placeholder_title(title_messages)
             conversation_dict = await cosmos_conversation_client.create_conversation(user_id=user_id, title=title)
             conversation_id = conversation_dict['id']
             history_metadata['title'] = title
             history_metadata['date'] = conversation_dict['createdAt']
+            current_app.add_background_task(
+                update_generated_title, user_id, conversation_id, title_messages, title
+            )
                 
             ## Format the incoming message object in the "chat/completions" messages format
             ## then write it to the conversation history in cosmos
@@ -1128,9 +1566,7 @@ async def upload_document():
                 )
             if createdMessageValue == "Conversation not found":
                 raise Exception("Conversation not found for the given conversation ID: " + conversation_id + ".")
-            
-            await cosmos_conversation_client.cosmosdb_client.close()
-        
+
         except Exception as e:
             logging.exception("Exception in /document/upload")
             return jsonify({"error": str(e)}), 500
@@ -1180,47 +1616,78 @@ async def add_conversation():
 
     try:
         # make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = current_app.cosmos_conversation_client
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
+        messages = request_json["messages"]
+        if not (len(messages) > 0 and messages[-1]["role"] == "user"):
+            raise Exception("No user message found")
+
+        ## images uploaded in the client are not always in the stored history, so a
+        ## request that carries one is sent as the client built it
+        has_images = any(message.get("type") == "img" for message in messages)
+        if request_json.get("server_history") and conversation_id and not has_images:
+            ## the client sent only the new turn; the earlier ones are read from the history
+            history = await cosmos_conversation_client.get_chat_history(user_id, conversation_id)
+            if history is None:
+                return (
+                    jsonify(
+                        {
+                            "error": f"Conversation {conversation_id} was not found. It either does not exist or the logged in user does not have access to it."
+                        }
+                    ),
+                    404,
+                )
+            messages = history + messages
+            request_json["messages"] = messages
+
         # check for the conversation_id, if the conversation is not set, we will create a new one
         history_metadata = {}
+        new_conversation = None
         if not conversation_id:
-            title = await generate_title(request_json["messages"])
-            conversation_dict = await cosmos_conversation_client.create_conversation(
-                user_id=user_id, title=title
-            )
-            conversation_id = conversation_dict["id"]
-            history_metadata["title"] = title
-            history_metadata["date"] = conversation_dict["createdAt"]
+            ## the id and date are chosen here so the response can start before the
+            ## conversation document is written
+            conversation_id = str(uuid.uuid4())
+            new_conversation = {
+                "title": get_placeholder_title(messages),
+                "created_at": datetime.utcnow().isoformat(),
+            }
+            history_metadata["title"] = new_conversation["title"]
+            history_metadata["date"] = new_conversation["created_at"]
+
+        ## admit the request before anything is written, so a request that is shed
+        ## leaves no conversation, message or title generation behind
+        lease = None
+        if current_app.admission:
+            try:
+                lease = await current_app.admission.acquire(user_id)
+            except AdmissionRejected as ex:
+                return admission_rejected_response(ex)
 
         ## Format the incoming message object in the "chat/completions" messages format
-        ## then write it to the conversation history in cosmos
-        messages = request_json["messages"]
-        if len(messages) > 0 and messages[-1]["role"] == "user":
-            createdMessageValue = await cosmos_conversation_client.create_message(
-                uuid=str(uuid.uuid4()),
-                conversation_id=conversation_id,
-                user_id=user_id,
-                input_message=messages[-1],
+        ## then write it to the conversation history in cosmos, concurrently with the
+        ## chat completion request
+        history_write = start_history_write(
+            write_user_message(cosmos_conversation_client, user_id, conversation_id, with_token_count(messages[-1]), new_conversation)
+        )
+        if new_conversation:
+            ## the real title needs an extra LLM round trip, so it is generated after
+            ## the response has started and patched onto the conversation
+            current_app.add_background_task(
+                update_generated_title,
+                user_id,
+                conversation_id,
+                messages,
+                new_conversation["title"],
+                history_write,
             )
-            if createdMessageValue == "Conversation not found":
-                raise Exception(
-                    "Conversation not found for the given conversation ID: "
-                    + conversation_id
-                    + "."
-                )
-        else:
-            raise Exception("No user message found")
-
-        await cosmos_conversation_client.cosmosdb_client.close()
 
         # Submit request to Chat Completions for response
-        request_body = await request.get_json()
+        request_body = request_json
         history_metadata["conversation_id"] = conversation_id
         request_body["history_metadata"] = history_metadata
-        return await conversation_internal(request_body, request.headers)
+        return await conversation_internal(request_body, request.headers, history_write=history_write, lease=lease)
 
     except Exception as e:
         logging.exception("Exception in /history/generate")
@@ -1238,7 +1705,7 @@ async def update_conversation():
 
     try:
         # make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = current_app.cosmos_conversation_client
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
@@ -1250,26 +1717,29 @@ async def update_conversation():
         ## then write it to the conversation history in cosmos
         messages = request_json["messages"]
         if len(messages) > 0 and messages[-1]["role"] == "assistant":
+            new_messages = []
             if len(messages) > 1 and messages[-2].get("role", None) == "tool":
                 # write the tool message first
-                await cosmos_conversation_client.create_message(
-                    uuid=str(uuid.uuid4()),
-                    conversation_id=conversation_id,
-                    user_id=user_id,
-                    input_message=messages[-2],
-                )
+                new_messages.append((str(uuid.uuid4()), messages[-2]))
             # write the assistant message
-            await cosmos_conversation_client.create_message(
-                uuid=messages[-1]["id"],
+            new_messages.append((messages[-1]["id"], with_token_count(messages[-1])))
+            createdMessageValue = await cosmos_conversation_client.create_messages(
                 conversation_id=conversation_id,
                 user_id=user_id,
-                input_message=messages[-1],
+                input_messages=new_messages,
             )
+            if createdMessageValue == "Conversation not found":
+                raise Exception(
+                    "Conversation not found for the given conversation ID: "
+                    + conversation_id
+                    + "."
+                )
+            if app_settings.chat_history.summarize_after_messages:
+                current_app.add_background_task(update_conversation_summary, user_id, conversation_id)
         else:
             raise Exception("No bot messages found")
 
         # Submit request to Chat Completions for response
-        await cosmos_conversation_client.cosmosdb_client.close()
         response = {"success": True}
         return jsonify(response), 200
 
@@ -1282,7 +1752,7 @@ async def update_conversation():
 async def update_message():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user["user_principal_id"]
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = current_app.cosmos_conversation_client
 
     ## check request for message_id
     request_json = await request.get_json()
@@ -1342,7 +1812,7 @@ async def delete_conversation():
             await docupload_delete_by_tag("conversation_id", f"{conversation_id}")
 
         ## make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = current_app.cosmos_conversation_client
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
@@ -1356,13 +1826,12 @@ async def delete_conversation():
             user_id, conversation_id
         )
 
-        await cosmos_conversation_client.cosmosdb_client.close()
-
         return (
             jsonify(
                 {
                     "message": "Successfully deleted conversation and messages",
                     "conversation_id": conversation_id,
+                    "deleted_messages": deleted_messages["deleted"],
                 }
             ),
             200,
@@ -1374,26 +1843,33 @@ async def delete_conversation():
 
 @bp.route("/history/list", methods=["GET"])
 async def list_conversations():
-    offset = request.args.get("offset", 0)
+    cursor = request.args.get("cursor", None)
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user["user_principal_id"]
 
+    try:
+        offset = int(request.args.get("offset", 0))
+    except ValueError:
+        return jsonify({"error": "offset must be an integer"}), 400
+
     ## make sure cosmos is configured
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = current_app.cosmos_conversation_client
     if not cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
-    ## get the conversations from cosmos
-    conversations = await cosmos_conversation_client.get_conversations(
-        user_id, offset=offset, limit=25
-    )
-    await cosmos_conversation_client.cosmosdb_client.close()
+    ## get the conversations from cosmos, continuing from the cursor of the previous page if given
+    try:
+        conversations, next_cursor = await cosmos_conversation_client.get_conversations_page(
+            user_id, limit=25, cursor=cursor, offset=offset
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     if not isinstance(conversations, list):
         return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
-    ## return the conversation ids
-
-    return jsonify(conversations), 200
+    ## the body stays a plain list; the cursor for the next page is returned in a header
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+    return jsonify(conversations), 200, headers
 
 
 @bp.route("/history/read", methods=["POST"])
@@ -1408,8 +1884,14 @@ async def get_conversation():
     if not conversation_id:
         return jsonify({"error": "conversation_id is required"}), 400
 
+    ## the whole conversation unless the client pages with `limit` or `cursor`
+    cursor = request_json.get("cursor", None)
+    limit = request_json.get("limit", app_settings.chat_history.messages_page_size if cursor else None)
+    if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit < 1):
+        return jsonify({"error": "limit must be a positive integer"}), 400
+
     ## make sure cosmos is configured
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = current_app.cosmos_conversation_client
     if not cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
@@ -1428,10 +1910,17 @@ async def get_conversation():
             404,
         )
 
-    # get the messages for the conversation from cosmos
-    conversation_messages = await cosmos_conversation_client.get_messages(
-        user_id, conversation_id
-    )
+    # get the newest messages of the conversation from cosmos, or the ones before the cursor
+    if limit is None:
+        conversation_messages = await cosmos_conversation_client.get_messages(user_id, conversation_id)
+        next_cursor = None
+    else:
+        try:
+            conversation_messages, next_cursor = await cosmos_conversation_client.get_messages_page(
+                user_id, conversation_id, limit=limit, cursor=cursor
+            )
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
     ## format the messages in the bot frontend format
     messages = [
@@ -1441,12 +1930,12 @@ async def get_conversation():
             "content": msg["content"],
             "createdAt": msg["createdAt"],
             "feedback": msg.get("feedback"),
+            "type": msg.get("type"),
         }
         for msg in conversation_messages
     ]
 
-    await cosmos_conversation_client.cosmosdb_client.close()
-    return jsonify({"conversation_id": conversation_id, "messages": messages}), 200
+    return jsonify({"conversation_id": conversation_id, "messages": messages, "next_cursor": next_cursor}), 200
 
 
 @bp.route("/history/rename", methods=["POST"])
@@ -1462,7 +1951,7 @@ async def rename_conversation():
         return jsonify({"error": "conversation_id is required"}), 400
 
     ## make sure cosmos is configured
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = current_app.cosmos_conversation_client
     if not cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
@@ -1484,57 +1973,77 @@ async def rename_conversation():
     title = request_json.get("title", None)
     if not title:
         return jsonify({"error": "title is required"}), 400
-    conversation["title"] = title
-    updated_conversation = await cosmos_conversation_client.upsert_conversation(
-        conversation
+    updated_conversation = await cosmos_conversation_client.update_conversation_title(
+        user_id, conversation_id, title
     )
 
-    await cosmos_conversation_client.cosmosdb_client.close()
     return jsonify(updated_conversation), 200
 
 
+# How often and how long a delete-all job waits for the service to empty the partition
+PURGE_POLL_INTERVAL = 2
+PURGE_TIMEOUT = 600
+
+
+async def purge_conversation_history(user_id, job):
+    cosmos_conversation_client = current_app.cosmos_conversation_client
+    try:
+        conversations = []
+        if DOCUPLOAD_ENABLED:
+            ## uploaded documents are tagged with their conversation, so list them before the purge
+            conversations = await cosmos_conversation_client.get_conversations(
+                user_id, offset=0, limit=None
+            )
+
+        summary = await cosmos_conversation_client.delete_partition(user_id)
+        job.update(summary)
+
+        if summary["method"] == "partition_key":
+            deadline = asyncio.get_running_loop().time() + PURGE_TIMEOUT
+            while await cosmos_conversation_client.count_items(user_id):
+                if asyncio.get_running_loop().time() > deadline:
+                    raise TimeoutError("Timed out waiting for the conversation history to be deleted")
+                await asyncio.sleep(PURGE_POLL_INTERVAL)
+
+        for conversation in conversations:
+            await docupload_delete_by_tag("conversation_id", conversation["id"])
+
+        job["status"] = "completed"
+    except Exception as e:
+        logging.exception("Exception while deleting all conversations")
+        job["status"] = "failed"
+        job["error"] = str(e)
+    finally:
+        job["finishedAt"] = datetime.utcnow().isoformat()
+
+
 @bp.route("/history/delete_all", methods=["DELETE"])
 async def delete_all_conversations():
     ## get the user id from the request headers
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user["user_principal_id"]
 
-    # get conversations for user
     try:
         ## make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = current_app.cosmos_conversation_client
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
-        conversations = await cosmos_conversation_client.get_conversations(
-            user_id, offset=0, limit=None
-        )
-        if not conversations:
-            return jsonify({"error": f"No conversations for {user_id} were found"}), 404
-
-        # delete each conversation
-        for conversation in conversations:
-            ## delete the conversation messages from cosmos first
-            deleted_messages = await cosmos_conversation_client.delete_messages(
-                conversation["id"], user_id
-            )
-
-            ## Now delete the conversation
-            deleted_conversation = await cosmos_conversation_client.delete_conversation(
-                user_id, conversation["id"]
-            )
-
-            if DOCUPLOAD_ENABLED:
-                await docupload_delete_by_tag("conversaton_id", conversation['id'])
+        ## the whole partition is purged in the background, poll /history/delete_all/status
+        job = current_app.history_purges.get(user_id)
+        if not job or job["status"] != "running":
+            job = {"status": "running", "startedAt": datetime.utcnow().isoformat()}
+            current_app.history_purges.set(user_id, job)
+            current_app.add_background_task(purge_conversation_history, user_id, job)
 
-        await cosmos_conversation_client.cosmosdb_client.close()
         return (
             jsonify(
                 {
-                    "message": f"Successfully deleted conversation and messages for user {user_id}"
+                    "message": f"Deleting conversations and messages for user {user_id}",
+                    **job,
                 }
             ),
-            200,
+            202,
         )
 
     except Exception as e:
@@ -1542,6 +2051,26 @@ async def delete_all_conversations():
         return jsonify({"error": str(e)}), 500
 
 
+@bp.route("/history/delete_all/status", methods=["GET"])
+async def delete_all_conversations_status():
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    user_id = authenticated_user["user_principal_id"]
+
+    try:
+        ## make sure cosmos is configured
+        cosmos_conversation_client = current_app.cosmos_conversation_client
+        if not cosmos_conversation_client:
+            raise Exception("CosmosDB is not configured or not working")
+
+        ## jobs are tracked by the worker that started them, the remaining count is always current
+        job = current_app.history_purges.get(user_id) or {"status": "unknown"}
+        remaining_items = await cosmos_conversation_client.count_items(user_id)
+        return jsonify({**job, "remaining_items": remaining_items}), 200
+    except Exception as e:
+        logging.exception("Exception in /history/delete_all/status")
+        return jsonify({"error": str(e)}), 500
+
+
 @bp.route("/history/clear", methods=["POST"])
 async def clear_messages():
     ## get the user id from the request headers
@@ -1557,7 +2086,7 @@ async def clear_messages():
             return jsonify({"error": "conversation_id is required"}), 400
 
         ## make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = current_app.cosmos_conversation_client
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
@@ -1571,6 +2100,7 @@ async def clear_messages():
                 {
                     "message": "Successfully deleted messages in conversation",
                     "conversation_id": conversation_id,
+                    "deleted_messages": deleted_messages["deleted"],
                 }
             ),
             200,
@@ -1586,14 +2116,16 @@ async def ensure_cosmos():
         return jsonify({"error": "CosmosDB is not configured"}), 404
 
     try:
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = current_app.cosmos_conversation_client
+        if not cosmos_conversation_client:
+            return jsonify({"error": "CosmosDB is not configured or not working"}), 500
+
         success, err = await cosmos_conversation_client.ensure()
-        if not cosmos_conversation_client or not success:
+        if not success:
             if err:
                 return jsonify({"error": err}), 422
             return jsonify({"error": "CosmosDB is not configured or not working"}), 500
 
-        await cosmos_conversation_client.cosmosdb_client.close()
         return jsonify({"message": "CosmosDB is configured and working"}), 200
     except Exception as e:
         logging.exception("Exception in /history/ensure")
@@ -1622,6 +2154,121 @@ async def ensure_cosmos():
             return jsonify({"error": "CosmosDB is not working"}), 500
 
 
+PLACEHOLDER_TITLE_WORDS = 6
+
+
+def get_placeholder_title(conversation_messages):
+    ## shown until the generated title has been written to the conversation
+    for msg in reversed(conversation_messages):
+        content = msg.get("content")
+        if msg.get("role") == "user" and msg.get("type") != "img" and isinstance(content, str):
+            words = content.split()
+            if words:
+                title = " ".join(words[:PLACEHOLDER_TITLE_WORDS])
+                return title + "..." if len(words) > PLACEHOLDER_TITLE_WORDS else title
+    return "New conversation"
+
+
+async def update_generated_title(user_id, conversation_id, conversation_messages, placeholder_title, conversation_created=None):
+    title = await generate_title(conversation_messages)
+    if not title or title == placeholder_title:
+        return
+
+    if conversation_created is not None:
+        await asyncio.wait({conversation_created})
+        if conversation_created.exception():
+            return
+
+    try:
+        cosmos_conversation_client = current_app.cosmos_conversation_client
+        if cosmos_conversation_client:
+            await cosmos_conversation_client.update_conversation_title(user_id, conversation_id, title)
+    except Exception:
+        logging.exception(f"Failed to update the title of conversation {conversation_id}")
+
+
+# Conversations this worker is summarizing, so overlapping turns do not summarize twice
+_summaries_in_progress = set()
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+SUMMARY_MAX_TOKENS = 500
+# Messages folded into the summary per turn; a long history is caught up over several turns
+SUMMARY_BATCH_MESSAGES = 40
+
+
+async def update_conversation_summary(user_id, conversation_id):
+    key = (user_id, conversation_id)
+    if key in _summaries_in_progress:
+        return
+    _summaries_in_progress.add(key)
+    try:
+        cosmos_conversation_client = current_app.cosmos_conversation_client
+        history = await cosmos_conversation_client.get_chat_history(user_id, conversation_id)
+        if not history:
+            return
+
+        summary = await cosmos_conversation_client.get_conversation_summary(user_id, conversation_id)
+        start = 0
+        if summary:
+            start = next(
+                (index + 1 for index, message in enumerate(history) if message["id"] == summary["lastMessageId"]), 0
+            )
+            if start == 0:
+                ## the summarized messages were cleared, start over
+                summary = None
+        if len(history) - start <= app_settings.chat_history.summarize_after_messages:
+            return
+
+        ## keep the most recent messages verbatim and end the summary on a completed turn
+        end = min(len(history) - app_settings.chat_history.summary_recent_messages, start + SUMMARY_BATCH_MESSAGES)
+        while end > start and history[end - 1]["role"] != "assistant":
+            end -= 1
+        if end <= start:
+            return
+
+        content = await generate_summary(summary["content"] if summary else None, history[start:end])
+        if not content:
+            return
+        token_count = None
+        if current_app.context_window:
+            token_count = current_app.context_window.count_tokens({"role": "assistant", "content": SUMMARY_PREFIX + content})
+        await cosmos_conversation_client.upsert_conversation_summary(
+            user_id,
+            conversation_id,
+            content,
+            last_message_id=history[end - 1]["id"],
+            message_count=(summary["messageCount"] if summary else 0) + end - start,
+            token_count=token_count,
+        )
+    except Exception:
+        logging.exception(f"Failed to summarize conversation {conversation_id}")
+    finally:
+        _summaries_in_progress.discard(key)
+
+
+async def generate_summary(previous_summary, conversation_messages):
+    summary_prompt = 'Summarize the conversation so far so it can stand in for these messages in later turns. Keep the facts, names, numbers, decisions and open questions the user may refer back to. Respond with the summary only.'
+
+    messages = []
+    if previous_summary:
+        messages.append({"role": "assistant", "content": SUMMARY_PREFIX + previous_summary})
+    ## images are not summarized; a placeholder keeps the turn without sending the data URL as text
+    messages += [
+        {"role": msg["role"], "content": "[image]" if msg.get("type") == "img" else msg["content"]}
+        for msg in conversation_messages
+    ]
+    messages.append({"role": "user", "content": summary_prompt})
+
+    try:
+        azure_openai_client = current_app.azure_openai_client
+        response = await azure_openai_client.chat.completions.create(
+            model=app_settings.azure_openai.model, messages=messages, temperature=0, max_tokens=SUMMARY_MAX_TOKENS
+        )
+        return response.choices[0].message.content
+    except Exception as e:
+        logging.warning(f"Failed to generate a conversation summary: {e}")
+        return None
+
+
 async def generate_title(conversation_messages):
     ## make sure the messages are sorted by _ts descending
     title_prompt = 'Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Respond with a json object in the format {{"title": string}}. Do not include any other commentary or description.'
@@ -1633,7 +2280,7 @@ async def generate_title(conversation_messages):
     messages.append({"role": "user", "content": title_prompt})
 
     try:
-        azure_openai_client = init_openai_client(use_data=False)
+        azure_openai_client = current_app.azure_openai_client
         response = await azure_openai_client.chat.completions.create(
             model=app_settings.azure_openai.model, messages=messages, temperature=1, max_tokens=64
         )
@@ -1641,7 +2288,9 @@ async def generate_title(conversation_messages):
         title = json.loads(response.choices[0].message.content)["title"]
         return title
     except Exception as e:
-        return messages[-2]["content"]
+        ## the caller keeps the placeholder title
+        logging.warning(f"Failed to generate a conversation title: {e}")
+        return None
 
 
 app = create_app()
@@ -0,0 +1,229 @@
+import asyncio
+import math
+import statistics
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Hashable, Optional
+
+# Bounds of the Retry-After hint sent with a shed request, in seconds
+MIN_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 60
+# Number of recent queue waits the percentiles are computed from
+WAIT_SAMPLES = 1024
+# Weight of the newest request in the running average of how long a slot is held
+HOLD_TIME_WEIGHT = 0.1
+
+
+class AdmissionRejected(Exception):
+    '''Raised when a request is shed instead of queued; `retry_after` is in whole seconds.'''
+
+    status_code = 503
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Lease:
+    '''A slot granted by the AdmissionController; release it when the upstream call is done.'''
+
+    def __init__(self, controller: "AdmissionController", wait: float):
+        self.wait = wait
+        self._controller = controller
+        self._acquired_at = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self._controller._release(time.monotonic() - self._acquired_at)
+
+
+class AdmissionController:
+    '''
+    Limits the Azure OpenAI requests one worker has in flight.
+
+    Up to `max_concurrency` requests run at once. Further requests wait in a
+    queue per user, and free slots go to the waiting users in turn, so a user
+    with many requests queued does not hold back the others. At most
+    `max_queue_depth` requests wait; when the queue is full, a request from a
+    user with fewer requests queued takes the place of the newest request of
+    the user with the most, otherwise it is rejected. Requests that wait longer
+    than `queue_timeout` seconds are rejected too. Rejections raise
+    AdmissionRejected with a Retry-After estimate from the queue length and the
+    average time a slot is held.
+    '''
+
+    def __init__(self, max_concurrency: int, max_queue_depth: int = 100, queue_timeout: float = 30.0):
+        self.max_concurrency = max_concurrency
+        self.max_queue_depth = max_queue_depth
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.queued = 0
+        self._queues: "OrderedDict[Hashable, Deque[asyncio.Future]]" = OrderedDict()
+        self._waits: Deque[float] = deque(maxlen=WAIT_SAMPLES)
+        self._hold_time: Optional[float] = None
+        self.admitted = 0
+        self.waited = 0
+        self.rejected = 0
+        self.shed = 0
+        self.timed_out = 0
+        self.max_wait = 0.0
+
+    async def acquire(self, user_id: Hashable) -> Lease:
+        if self.active < self.max_concurrency and not self.queued:
+            self.active += 1
+            return self._admit(0.0)
+
+        if self.queued >= self.max_queue_depth and not self._shed_for(user_id):
+            self.rejected += 1
+            raise AdmissionRejected("Too many requests are waiting for Azure OpenAI", self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user_id, deque()).append(waiter)
+        self.queued += 1
+        self.waited += 1
+        start = time.monotonic()
+        try:
+            done, _ = await asyncio.wait({waiter}, timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            self._abandon(user_id, waiter)
+            raise
+        if not done:
+            self._abandon(user_id, waiter)
+            self.timed_out += 1
+            raise AdmissionRejected("Timed out waiting for Azure OpenAI", self.retry_after())
+
+        # Raises AdmissionRejected if the request was shed to make room for another user
+        waiter.result()
+        return self._admit(time.monotonic() - start)
+
+    @asynccontextmanager
+    async def admit(self, user_id: Hashable):
+        lease = await self.acquire(user_id)
+        try:
+            yield lease
+        finally:
+            lease.release()
+
+    def retry_after(self) -> int:
+        hold_time = self._hold_time or 1.0
+        estimate = math.ceil((self.queued + 1) * hold_time / self.max_concurrency)
+        return max(MIN_RETRY_AFTER, min(MAX_RETRY_AFTER, estimate))
+
+    def _admit(self, wait: float) -> Lease:
+        self.admitted += 1
+        self._waits.append(wait)
+        self.max_wait = max(self.max_wait, wait)
+        return Lease(self, wait)
+
+    def _shed_for(self, user_id: Hashable) -> bool:
+        # Make room by dropping the newest request of the user with the longest queue,
+        # as long as that user still has more queued than this one would have
+        if not self._queues:
+            return False
+        heaviest = max(self._queues, key=lambda key: len(self._queues[key]))
+        if len(self._queues[heaviest]) <= len(self._queues.get(user_id, ())) + 1:
+            return False
+        waiter = self._queues[heaviest].pop()
+        if not self._queues[heaviest]:
+            del self._queues[heaviest]
+        self.queued -= 1
+        self.shed += 1
+        waiter.set_exception(
+            AdmissionRejected("Shed to make room for other users' requests", self.retry_after())
+        )
+        return True
+
+    def _abandon(self, user_id: Hashable, waiter: asyncio.Future):
+        if waiter.done():
+            if not waiter.cancelled() and waiter.exception() is None:
+                # The slot was handed over just as the caller gave up
+                self._release(None)
+            return
+        waiter.cancel()
+        waiters = self._queues.get(user_id)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            self.queued -= 1
+            if not waiters:
+                del self._queues[user_id]
+
+    def _release(self, hold_time: Optional[float]):
+        if hold_time is not None:
+            if self._hold_time is None:
+                self._hold_time = hold_time
+            else:
+                self._hold_time += HOLD_TIME_WEIGHT * (hold_time - self._hold_time)
+
+        if self._queues:
+            # Hand the slot to the user at the front and move them to the back
+            user_id, waiters = next(iter(self._queues.items()))
+            waiter = waiters.popleft()
+            self.queued -= 1
+            if waiters:
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+            waiter.set_result(None)
+        else:
+            self.active -= 1
+
+    def get_statistics(self) -> dict:
+        waits = sorted(self._waits)
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue_depth": self.max_queue_depth,
+            "active": self.active,
+            "queued": self.queued,
+            "queued_users": len(self._queues),
+            "admitted": self.admitted,
+            "waited": self.waited,
+            "rejected": self.rejected,
+            "shed": self.shed,
+            "timed_out": self.timed_out,
+            "queue_wait_ms": {
+                "mean": statistics.mean(waits) * 1000 if waits else 0.0,
+                "p50": _percentile(waits, 0.5) * 1000,
+                "p95": _percentile(waits, 0.95) * 1000,
+                "max": self.max_wait * 1000,
+            },
+            "average_hold_ms": (self._hold_time or 0.0) * 1000,
+        }
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class AdmittedStream:
+    '''
+    Wraps a streamed completion or response body and releases its admission
+    slot once the stream has been read to the end, failed or been closed.
+    '''
+
+    def __init__(self, response, lease: Lease):
+        self._response = response
+        self._lease = lease
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._response:
+                yield chunk
+        finally:
+            self._lease.release()
+
+    async def close(self):
+        try:
+            close = getattr(self._response, "close", None) or getattr(self._response, "aclose", None)
+            if close is not None:
+                await close()
+        finally:
+            self._lease.release()
+
+    def __del__(self):
+        # Never read nor closed, e.g. the client went away before the body was sent
+        self._lease.release()
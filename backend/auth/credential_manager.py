@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+from azure.core.credentials import AccessToken
+from azure.identity.aio import DefaultAzureCredential
+
+AZURE_OPENAI_SCOPE = "https://cognitiveservices.azure.com/.default"
+AZURE_SEARCH_SCOPE = "https://search.azure.com/.default"
+AZURE_STORAGE_SCOPE = "https://storage.azure.com/.default"
+
+def cosmosdb_scope(endpoint: str) -> str:
+    '''The scope azure-cosmos requests tokens for: the account host, e.g. https://<account>.documents.azure.com/.default'''
+    url = urlsplit(endpoint)
+    return f"{url.scheme}://{url.hostname}/.default"
+
+
+# Tokens are refreshed in the background once they are this close to expiry...
+TOKEN_REFRESH_MARGIN_SECONDS = 300
+# ...and are never handed out if they expire sooner than this.
+TOKEN_EXPIRY_SKEW_SECONDS = 30
+TOKEN_REFRESH_INTERVAL_SECONDS = 60
+
+
+class CachedTokenCredential:
+    '''
+    Async token credential shared by every Azure client in a worker.
+
+    Wraps a single DefaultAzureCredential so the credential chain is probed once,
+    caches one access token per scope, and refreshes tokens on a background task
+    before they expire so token acquisition stays off the request path.
+    '''
+
+    def __init__(
+        self,
+        credential=None,
+        refresh_margin: int = TOKEN_REFRESH_MARGIN_SECONDS,
+        refresh_interval: int = TOKEN_REFRESH_INTERVAL_SECONDS,
+    ):
+        self._credential = credential or DefaultAzureCredential()
+        self._refresh_margin = refresh_margin
+        self._refresh_interval = refresh_interval
+        self._tokens: Dict[Tuple[str, ...], AccessToken] = {}
+        self._locks: Dict[Tuple[str, ...], asyncio.Lock] = {}
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._acquisitions = 0
+        self._failures = 0
+        self._cache_hits = 0
+        self._background_refreshes = 0
+        self._total_latency = 0.0
+        self._max_latency = 0.0
+        self._last_latency = None
+
+    async def get_token(self, *scopes: str, claims: Optional[str] = None, tenant_id: Optional[str] = None, **kwargs) -> AccessToken:
+        # Claims challenges and cross-tenant requests are rare; never serve them from the cache
+        if claims or tenant_id:
+            return await self._acquire(scopes, claims=claims, tenant_id=tenant_id, **kwargs)
+
+        token = self._tokens.get(scopes)
+        if self._is_usable(token):
+            self._cache_hits += 1
+            return token
+
+        async with self._lock_for(scopes):
+            token = self._tokens.get(scopes)
+            if self._is_usable(token):
+                self._cache_hits += 1
+                return token
+
+            token = await self._acquire(scopes, **kwargs)
+            self._tokens[scopes] = token
+            return token
+
+    def start(self, *scopes: str):
+        '''Start the background refresh task, pre-fetching tokens for the given scopes.'''
+        for scope in scopes:
+            self._tokens.setdefault((scope,), None)
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def close(self):
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
+        await self._credential.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def get_statistics(self) -> dict:
+        return {
+            "scopes": len(self._tokens),
+            "acquisitions": self._acquisitions,
+            "failures": self._failures,
+            "cache_hits": self._cache_hits,
+            "background_refreshes": self._background_refreshes,
+            "average_latency_ms": (
+                round(self._total_latency / self._acquisitions * 1000, 1)
+                if self._acquisitions else None
+            ),
+            "max_latency_ms": round(self._max_latency * 1000, 1),
+            "last_latency_ms": (
+                round(self._last_latency * 1000, 1)
+                if self._last_latency is not None else None
+            ),
+        }
+
+    def _is_usable(self, token: Optional[AccessToken]) -> bool:
+        return token is not None and token.expires_on - time.time() > TOKEN_EXPIRY_SKEW_SECONDS
+
+    def _lock_for(self, scopes: Tuple[str, ...]) -> asyncio.Lock:
+        lock = self._locks.get(scopes)
+        if lock is None:
+            lock = self._locks[scopes] = asyncio.Lock()
+        return lock
+
+    async def _acquire(self, scopes: Tuple[str, ...], **kwargs) -> AccessToken:
+        start = time.perf_counter()
+        try:
+            token = await self._credential.get_token(*scopes, **kwargs)
+        except Exception:
+            self._failures += 1
+            raise
+        finally:
+            latency = time.perf_counter() - start
+            self._acquisitions += 1
+            self._total_latency += latency
+            self._max_latency = max(self._max_latency, latency)
+            self._last_latency = latency
+
+        logging.debug(f"Acquired token for {scopes} in {latency * 1000:.0f}ms")
+        return token
+
+    async def _refresh_due_tokens(self):
+        for scopes, token in list(self._tokens.items()):
+            if token is not None and token.expires_on - time.time() > self._refresh_margin:
+                continue
+
+            try:
+                async with self._lock_for(scopes):
+                    self._tokens[scopes] = await self._acquire(scopes)
+                self._background_refreshes += 1
+            except Exception as e:
+                # The cached token (if any) is still served until it expires
+                logging.warning(f"Background token refresh failed for {scopes}: {e}")
+
+    async def _refresh_loop(self):
+        while True:
+            await self._refresh_due_tokens()
+            await asyncio.sleep(self._refresh_interval)
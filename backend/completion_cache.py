@@ -0,0 +1,244 @@
+import json
+import time
+import uuid
+import hashlib
+import logging
+from collections.abc import Mapping
+from types import SimpleNamespace
+from typing import Optional
+
+from backend.cache import TTLCache
+from backend.utils import StreamResponseEncoder, extract_stream_message
+
+# Model arguments that do not change the completion and must not split the cache
+IGNORED_MODEL_ARGS = {"stream", "user"}
+
+
+def _normalize_text(text):
+    return " ".join(text.split())
+
+
+def _normalize_content(content):
+    if isinstance(content, str):
+        return _normalize_text(content)
+    if isinstance(content, list):
+        return [
+            {**part, "text": _normalize_text(part["text"])} if part.get("type") == "text" else part
+            for part in content
+        ]
+    return content
+
+
+def _canonical_default(obj):
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    return str(obj)
+
+
+def make_cache_key(model_args) -> str:
+    '''
+    Hash the parts of a chat completion request that determine its answer: the
+    normalized messages, the model parameters and the resolved data source
+    payload, including its security filter.
+    '''
+    key_args = {
+        name: value for name, value in model_args.items()
+        if name not in IGNORED_MODEL_ARGS
+    }
+    key_args["messages"] = [
+        {"role": message.get("role"), "content": _normalize_content(message.get("content"))}
+        for message in model_args.get("messages", [])
+    ]
+    canonical = json.dumps(key_args, sort_keys=True, separators=(",", ":"), default=_canonical_default)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class InMemoryCompletionCacheBackend:
+    '''Per-worker backend with TTL expiry and LRU eviction.'''
+
+    name = "memory"
+
+    def __init__(self, max_size: int = 1024, ttl: int = 3600):
+        self._cache = TTLCache(max_size=max_size, ttl=ttl)
+
+    async def get(self, key: str) -> Optional[dict]:
+        return self._cache.get(key)
+
+    async def set(self, key: str, entry: dict):
+        self._cache.set(key, entry)
+
+    async def close(self):
+        self._cache.clear()
+
+    def get_statistics(self) -> dict:
+        stats = self._cache.get_statistics()
+        return {"size": stats["size"], "max_size": stats["max_size"], "evictions": stats["evictions"]}
+
+
+class RedisCompletionCacheBackend:
+    '''
+    Backend shared by every worker through a Redis-protocol server. Entries
+    expire after `ttl` seconds; LRU eviction is left to the server's
+    maxmemory-policy.
+    '''
+
+    name = "redis"
+
+    def __init__(self, url: str, ttl: int = 3600, key_prefix: str = "completion:"):
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise ImportError(
+                "The redis completion cache backend requires the 'redis' package"
+            ) from e
+
+        self._client = redis.from_url(url)
+        self._ttl = ttl
+        self._key_prefix = key_prefix
+
+    async def get(self, key: str) -> Optional[dict]:
+        raw = await self._client.get(self._key_prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    async def set(self, key: str, entry: dict):
+        await self._client.set(self._key_prefix + key, json.dumps(entry), ex=self._ttl)
+
+    async def close(self):
+        await self._client.aclose()
+
+    def get_statistics(self) -> dict:
+        return {}
+
+
+class CompletionCache:
+    '''
+    Opt-in exact-match cache of chat completions.
+
+    Entries hold the model name and the response messages (citations and
+    answer) but no history metadata, so one entry can be replayed into any
+    conversation, either as a single response or as an NDJSON stream. Backend
+    failures are logged and treated as misses.
+    '''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.errors = 0
+
+    make_key = staticmethod(make_cache_key)
+
+    async def get(self, key: str) -> Optional[dict]:
+        try:
+            entry = await self.backend.get(key)
+        except Exception as e:
+            self.errors += 1
+            logging.warning(f"Completion cache lookup failed: {e}")
+            return None
+
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    async def set(self, key: str, entry: Optional[dict]):
+        if not entry or not entry["messages"]:
+            return
+        try:
+            await self.backend.set(key, entry)
+            self.stores += 1
+        except Exception as e:
+            self.errors += 1
+            logging.warning(f"Completion cache store failed: {e}")
+
+    async def close(self):
+        await self.backend.close()
+
+    def record_stream(self, key: str, response) -> "RecordingStream":
+        return RecordingStream(response, lambda entry: self.set(key, entry))
+
+    def get_statistics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": self.backend.name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "stores": self.stores,
+            "errors": self.errors,
+            **self.backend.get_statistics(),
+        }
+
+
+def entry_from_completion(chatCompletion) -> Optional[dict]:
+    if not chatCompletion.choices or not chatCompletion.choices[0].message:
+        return None
+
+    message = chatCompletion.choices[0].message
+    messages = []
+    if hasattr(message, "context"):
+        messages.append({"role": "tool", "content": json.dumps(message.context)})
+    messages.append({"role": "assistant", "content": message.content})
+    return {"model": chatCompletion.model, "messages": messages}
+
+
+class RecordingStream:
+    '''
+    Wraps a streamed completion and hands the assembled cache entry to
+    `on_complete` once the stream has been read to the end. Abandoned or
+    failed streams are never recorded.
+    '''
+
+    def __init__(self, response, on_complete):
+        self._response = response
+        self._on_complete = on_complete
+
+    async def __aiter__(self):
+        entry = None
+        tool_messages = []
+        content_parts = []
+        async for chatCompletionChunk in self._response:
+            if entry is None and chatCompletionChunk.id:
+                entry = {"model": chatCompletionChunk.model}
+            message = extract_stream_message(chatCompletionChunk)
+            if message is not None:
+                if message["role"] == "assistant":
+                    content_parts.append(message["content"])
+                else:
+                    tool_messages.append(message)
+            yield chatCompletionChunk
+
+        if entry is not None and content_parts:
+            entry["messages"] = tool_messages + [{"role": "assistant", "content": "".join(content_parts)}]
+            await self._on_complete(entry)
+
+    async def close(self):
+        close = getattr(self._response, "close", None)
+        if close is not None:
+            await close()
+
+
+def _replay_identity(entry):
+    # Cached answers are stored in conversation history under their response id,
+    # so every replay gets a fresh one
+    return {"id": f"chatcmpl-cache-{uuid.uuid4()}", "model": entry["model"], "created": int(time.time())}
+
+
+def format_cached_response(entry, history_metadata) -> dict:
+    return {
+        **_replay_identity(entry),
+        "object": "chat.completion",
+        "choices": [{"messages": list(entry["messages"])}],
+        "history_metadata": history_metadata,
+        "apim-request-id": None,
+    }
+
+
+async def format_cached_stream_as_ndjson(entry, history_metadata):
+    identity = _replay_identity(entry)
+    chunk = SimpleNamespace(object="chat.completion.chunk", **identity)
+    encoder = StreamResponseEncoder(history_metadata, None)
+    for message in entry["messages"]:
+        yield encoder.encode_message(chunk, message)
@@ -0,0 +1,104 @@
+import logging
+from typing import Callable, List
+
+from backend.cache import TTLCache
+
+# Tokens the chat format adds around every message (role and separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Images are not tokenized as text; this is the cost of one high detail 512px tile plus the base
+IMAGE_TOKENS = 255
+FALLBACK_ENCODING = "cl100k_base"
+
+
+def estimate_tokens(text: str) -> int:
+    '''Rough count for when no tiktoken encoding is available: about four characters per token.'''
+    return (len(text) + 3) // 4
+
+
+class ContextWindow:
+    '''
+    Fits the chat history of a request into a token budget. The newest turns
+    are kept and older ones are dropped; pinned messages, such as the system
+    message and the summary of earlier turns, count against the budget. The
+    newest message is always kept.
+
+    Token counts are taken from the message's `tokenCount` when it was stored
+    with one, otherwise counted with tiktoken once per message content and
+    kept per worker.
+    '''
+
+    def __init__(self, model: str, token_budget: int, cache_size: int = 4096, cache_ttl: float = 3600):
+        self.model = model
+        self.token_budget = token_budget
+        self._count_text: Callable[[str], int] = estimate_tokens
+        self._counts = TTLCache(max_size=cache_size, ttl=cache_ttl)
+        self.encoding = None
+        self.requests = 0
+        self.trimmed_requests = 0
+        self.dropped_messages = 0
+
+    def load_encoding(self):
+        '''Load the tiktoken encoding for the model. This may download it, so call it off the event loop.'''
+        try:
+            import tiktoken
+
+            try:
+                encoding = tiktoken.encoding_for_model(self.model)
+            except KeyError:
+                # Deployment names need not be model names
+                encoding = tiktoken.get_encoding(FALLBACK_ENCODING)
+            self._count_text = lambda text: len(encoding.encode(text, disallowed_special=()))
+            self.encoding = encoding.name
+        except Exception as e:
+            logging.warning(f"Could not load a tiktoken encoding for {self.model}, estimating token counts: {e}")
+
+    def count_tokens(self, message: dict) -> int:
+        token_count = message.get("tokenCount")
+        if isinstance(token_count, int):
+            return token_count
+
+        content = message.get("content") or ""
+        if message.get("type") == "img":
+            return MESSAGE_OVERHEAD_TOKENS + IMAGE_TOKENS
+        if not isinstance(content, str):
+            return MESSAGE_OVERHEAD_TOKENS + sum(
+                self._count_text(part.get("text", "")) if part.get("type") == "text" else IMAGE_TOKENS
+                for part in content
+            )
+
+        key = hash(content)
+        token_count = self._counts.get(key)
+        if token_count is None:
+            token_count = MESSAGE_OVERHEAD_TOKENS + self._count_text(content)
+            self._counts.set(key, token_count)
+        return token_count
+
+    def fit(self, messages: List[dict], pinned: List[dict] = ()) -> List[dict]:
+        '''Return the newest `messages` that fit into the budget left after the `pinned` messages.'''
+        self.requests += 1
+        budget = self.token_budget - sum(self.count_tokens(message) for message in pinned)
+        if sum(self.count_tokens(message) for message in messages) <= budget:
+            return messages
+
+        kept = 0
+        used = 0
+        for message in reversed(messages):
+            tokens = self.count_tokens(message)
+            if kept and used + tokens > budget:
+                break
+            used += tokens
+            kept += 1
+
+        self.trimmed_requests += 1
+        self.dropped_messages += len(messages) - kept
+        return messages[len(messages) - kept:]
+
+    def get_statistics(self) -> dict:
+        return {
+            "token_budget": self.token_budget,
+            "encoding": self.encoding,
+            "requests": self.requests,
+            "trimmed_requests": self.trimmed_requests,
+            "dropped_messages": self.dropped_messages,
+            "cached_counts": len(self._counts),
+        }
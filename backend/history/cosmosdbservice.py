@@ -1,18 +1,152 @@
 import uuid
-from datetime import datetime
+import base64
+import binascii
+import asyncio
+import functools
+import logging
+from datetime import datetime, timedelta
 from azure.cosmos.aio import CosmosClient
-from azure.cosmos import exceptions
-  
+from azure.cosmos import exceptions, http_constants
+from azure.core import MatchConditions
+from azure.core.exceptions import ServiceRequestError, ServiceResponseError
+from backend.cache import TTLCache
+
+## a transactional batch holds at most 100 operations
+DELETE_BATCH_SIZE = 100
+DELETE_CONCURRENCY = 4
+THROTTLE_RETRIES = 5
+THROTTLE_BACKOFF = 0.5
+## ids read from the query before a round of batches is sent
+PURGE_CHUNK_SIZE = DELETE_BATCH_SIZE * DELETE_CONCURRENCY
+
+## fields of a conversation shown in the history list
+CONVERSATION_LIST_FIELDS = ['id', 'title', 'createdAt', 'updatedAt']
+## the most recently updated conversations of a user are kept in one document in the
+## user's partition, so the first pages of the history list are a single point read
+CONVERSATION_INDEX_ID = 'conversationIndex'
+CONVERSATION_INDEX_SIZE = 100
+CONVERSATION_INDEX_RETRIES = 3
+## index updates of a user within this many seconds (e.g. a new conversation, its first
+## message and its title) are applied with one read and replace of the index
+CONVERSATION_INDEX_DELAY = 0.05
+## prefix of cursors that continue a list served from the conversation index
+OFFSET_CURSOR_PREFIX = 'offset:'
+## rolling summary of the older turns of a conversation, one document per conversation
+SUMMARY_ID_PREFIX = 'summary-'
+## fields of a message sent back to the model when the prompt is rebuilt from the history
+HISTORY_FIELDS = ['id', 'role', 'content', 'tokenCount', 'contentType']
+## images are sent as data URLs; messages stored without their contentType are recognized by it
+IMAGE_CONTENT_PREFIX = 'data:image/'
+## fields of a message shown in a conversation; contentType is restored as `type`
+MESSAGE_READ_FIELDS = ['id', 'role', 'content', 'createdAt', 'feedback', 'contentType']
+
+
+def encode_cursor(continuation_token):
+    return base64.urlsafe_b64encode(continuation_token.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        return base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    except (binascii.Error, UnicodeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def _parse_offset_cursor(continuation_token):
+    try:
+        return int(continuation_token[len(OFFSET_CURSOR_PREFIX):])
+    except ValueError as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def _index_upsert(entries, conversation):
+    entry = {field: conversation.get(field) for field in CONVERSATION_LIST_FIELDS}
+    entries = [existing for existing in entries if existing['id'] != entry['id']]
+    ## entries are ordered by updatedAt, newest first
+    position = 0
+    while position < len(entries) and entries[position]['updatedAt'] > entry['updatedAt']:
+        position += 1
+    entries.insert(position, entry)
+    return entries
+
+
+def _index_rename(entries, conversation_id, title):
+    return [dict(entry, title=title) if entry['id'] == conversation_id else entry for entry in entries]
+
+
+def _index_remove(entries, conversation_id):
+    return [entry for entry in entries if entry['id'] != conversation_id]
+
+
+def _history_message(item):
+    ## restore the message's content kind under the name the chat request uses
+    content_type = item.pop('contentType', None)
+    content = item.get('content')
+    if content_type is None and isinstance(content, str) and content.startswith(IMAGE_CONTENT_PREFIX):
+        content_type = 'img'
+    if content_type:
+        item['type'] = content_type
+    return item
+
+
+def throttle_delay(e, attempt):
+    ## wait as long as the service asks, otherwise back off exponentially
+    headers = getattr(e, 'headers', None) or {}
+    retry_after_ms = headers.get(http_constants.HttpHeaders.RetryAfterInMilliseconds)
+    if retry_after_ms:
+        return int(retry_after_ms) / 1000
+    return THROTTLE_BACKOFF * 2 ** attempt
+
+
+def reconnect_on_transport_error(func):
+    """Rebuild the Cosmos clients when a call fails below the HTTP layer.
+
+    The call is retried once on the new connection only if the request never
+    reached the service (ServiceRequestError); otherwise the error is re-raised
+    so non-idempotent writes are not replayed.
+    """
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        generation = self._generation
+        try:
+            return await func(self, *args, **kwargs)
+        except (ServiceRequestError, ServiceResponseError) as e:
+            logging.warning(f"CosmosDB transport error in {func.__name__}, reconnecting: {e}")
+            await self.reconnect(generation)
+            if isinstance(e, ServiceResponseError):
+                raise
+            return await func(self, *args, **kwargs)
+
+    return wrapper
+
+
 class CosmosConversationClient():
     
-    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False):
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False, conversation_cache_ttl: float = 30, conversation_cache_size: int = 1024):
         self.cosmosdb_endpoint = cosmosdb_endpoint
         self.credential = credential
         self.database_name = database_name
         self.container_name = container_name
         self.enable_message_feedback = enable_message_feedback
+        ## conversation documents by (userId, id); writes from this worker invalidate
+        ## their entry, writes from other workers are picked up after the TTL
+        self.conversation_cache = TTLCache(max_size=conversation_cache_size, ttl=conversation_cache_ttl)
+        ## prompt history by (userId, conversation id), valid while the conversation's updatedAt matches
+        self.history_cache = TTLCache(max_size=256, ttl=300)
+        ## continuation tokens by (userId, sort order, offset) for clients that page by offset
+        self.page_cursors = TTLCache(max_size=4096, ttl=300)
+        ## delete by partition key is a preview feature that has to be enabled on the account
+        self.partition_delete_supported = True
+        ## conversation index updates per user, waiting for the background task that applies them
+        self._index_updates = {}
+        self._index_tasks = {}
+        self._generation = 0
+        self._reconnect_lock = asyncio.Lock()
+        self._connect()
+
+    def _connect(self):
         try:
-            self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
+            self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=self.credential)
         except exceptions.CosmosHttpResponseError as e:
             if e.status_code == 401:
                 raise ValueError("Invalid credentials") from e
@@ -20,15 +154,42 @@ class CosmosConversationClient():
                 raise ValueError("Invalid CosmosDB endpoint") from e
 
         try:
-            self.database_client = self.cosmosdb_client.get_database_client(database_name)
+            self.database_client = self.cosmosdb_client.get_database_client(self.database_name)
         except exceptions.CosmosResourceNotFoundError:
             raise ValueError("Invalid CosmosDB database name") 
         
         try:
-            self.container_client = self.database_client.get_container_client(container_name)
+            self.container_client = self.database_client.get_container_client(self.container_name)
         except exceptions.CosmosResourceNotFoundError:
             raise ValueError("Invalid CosmosDB container name") 
-        
+
+    async def warm_up(self):
+        ## read the container once so its metadata (partition key definition) is cached
+        ## before the first user request, and the connection to the account is established
+        try:
+            await self.container_client.read()
+            return True
+        except Exception as e:
+            logging.warning(f"CosmosDB warm-up failed: {e}")
+            return False
+
+    async def reconnect(self, generation = None):
+        async with self._reconnect_lock:
+            ## another request already replaced the connection that failed
+            if generation is not None and generation != self._generation:
+                return
+
+            old_client = self.cosmosdb_client
+            self._connect()
+            self._generation += 1
+            try:
+                await old_client.close()
+            except Exception as e:
+                logging.debug(f"Error closing stale CosmosDB client: {e}")
+
+    async def close(self):
+        await self.flush_index_updates()
+        await self.cosmosdb_client.close()
 
     async def ensure(self):
         if not self.cosmosdb_client or not self.database_client or not self.container_client:
@@ -46,49 +207,186 @@ class CosmosConversationClient():
             
         return True, "CosmosDB client initialized successfully"
 
-    async def create_conversation(self, user_id, title = ''):
+    @reconnect_on_transport_error
+    async def create_conversation(self, user_id, title = '', conversation_id = None, created_at = None):
+        ## callers may choose the id and timestamp up front to use them before the write completes
+        created_at = created_at or datetime.utcnow().isoformat()
         conversation = {
-            'id': str(uuid.uuid4()),  
+            'id': conversation_id or str(uuid.uuid4()),  
             'type': 'conversation',
-            'createdAt': datetime.utcnow().isoformat(),  
-            'updatedAt': datetime.utcnow().isoformat(),  
+            'createdAt': created_at,  
+            'updatedAt': created_at,  
             'userId': user_id,
             'title': title
         }
         ## TODO: add some error handling based on the output of the upsert_item call
         resp = await self.container_client.upsert_item(conversation)  
+        self.conversation_cache.pop((user_id, conversation['id']))
         if resp:
+            self._update_conversation_index(user_id, lambda entries: _index_upsert(entries, resp))
             return resp
         else:
             return False
     
+    @reconnect_on_transport_error
     async def upsert_conversation(self, conversation):
         resp = await self.container_client.upsert_item(conversation)
+        self.conversation_cache.pop((conversation['userId'], conversation['id']))
         if resp:
+            self._update_conversation_index(conversation['userId'], lambda entries: _index_upsert(entries, resp))
             return resp
         else:
             return False
 
-    async def delete_conversation(self, user_id, conversation_id):
-        conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)        
-        if conversation:
-            resp = await self.container_client.delete_item(item=conversation_id, partition_key=user_id)
+    @reconnect_on_transport_error
+    async def update_conversation_title(self, user_id, conversation_id, title):
+        ## patch only the title so concurrent message writes to updatedAt are not overwritten
+        resp = await self.container_client.patch_item(
+            item=conversation_id,
+            partition_key=user_id,
+            patch_operations=[{'op': 'set', 'path': '/title', 'value': title}]
+        )
+        self.conversation_cache.pop((user_id, conversation_id))
+        if resp:
+            self._update_conversation_index(user_id, lambda entries: _index_rename(entries, conversation_id, title))
             return resp
         else:
-            return True
+            return False
+
+    @reconnect_on_transport_error
+    async def delete_conversation(self, user_id, conversation_id):
+        self.conversation_cache.pop((user_id, conversation_id))
+        self.history_cache.pop((user_id, conversation_id))
+        try:
+            resp = await self.container_client.delete_item(item=conversation_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            resp = True
+        self._update_conversation_index(user_id, lambda entries: _index_remove(entries, conversation_id))
+        return resp
 
         
+    @reconnect_on_transport_error
     async def delete_messages(self, conversation_id, user_id):
-        ## get a list of all the messages in the conversation
-        messages = await self.get_messages(user_id, conversation_id)
-        response_list = []
-        if messages:
-            for message in messages:
-                resp = await self.container_client.delete_item(item=message['id'], partition_key=user_id)
-                response_list.append(resp)
-            return response_list
+        ## only the ids are needed, and all messages live in the user's partition
+        parameters = [
+            {
+                'name': '@conversationId',
+                'value': conversation_id
+            },
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        query = "SELECT c.id FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId"
+        message_ids = [
+            item['id'] async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id)
+        ]
+        self.history_cache.pop((user_id, conversation_id))
+        summary = await self.delete_items(user_id, message_ids)
+        await self.delete_conversation_summary(user_id, conversation_id)
+        return summary
+
+    @reconnect_on_transport_error
+    async def delete_partition(self, user_id):
+        ## every conversation and message of a user lives in the user's partition
+        for cache in (self.conversation_cache, self.history_cache):
+            for key in cache.keys():
+                if key[0] == user_id:
+                    cache.pop(key)
+        self._clear_page_cursors(user_id)
+        ## drop the pending index updates and the index itself, which the service may
+        ## otherwise still serve while it deletes the partition in the background
+        if user_id in self._index_updates:
+            self._index_updates[user_id] = []
+        await self._delete_conversation_index(user_id)
+
+        if self.partition_delete_supported:
+            try:
+                ## the service deletes the items in the background
+                await self.container_client.delete_all_items_by_partition_key(user_id)
+                return {'method': 'partition_key'}
+            except exceptions.CosmosHttpResponseError as e:
+                ## only fall back when the account rejects the operation itself
+                if e.status_code not in (400, 403, 405, 501):
+                    raise
+                logging.warning(f"CosmosDB delete by partition key is not available, deleting items one by one: {e}")
+                self.partition_delete_supported = False
+
+        parameters = [
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        query = "SELECT c.id FROM c WHERE c.userId = @userId"
+        summary = {'method': 'query', 'deleted': 0, 'batches': 0, 'throttled_retries': 0}
+        item_ids = []
+        async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id):
+            item_ids.append(item['id'])
+            if len(item_ids) == PURGE_CHUNK_SIZE:
+                self._add_summary(summary, await self.delete_items(user_id, item_ids))
+                item_ids = []
+        self._add_summary(summary, await self.delete_items(user_id, item_ids))
+        return summary
+
+    @staticmethod
+    def _add_summary(summary, result):
+        for key, value in result.items():
+            summary[key] += value
+
+    @reconnect_on_transport_error
+    async def count_items(self, user_id):
+        parameters = [
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        query = "SELECT VALUE COUNT(1) FROM c WHERE c.userId = @userId"
+        async for count in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id):
+            return count
+        return 0
+
+    async def delete_items(self, user_id, item_ids):
+        ## delete in transactional batches, a few batches at a time
+        batches = [item_ids[i:i + DELETE_BATCH_SIZE] for i in range(0, len(item_ids), DELETE_BATCH_SIZE)]
+        semaphore = asyncio.Semaphore(DELETE_CONCURRENCY)
 
+        async def delete(batch):
+            async with semaphore:
+                return await self._delete_batch(user_id, batch)
 
+        results = await asyncio.gather(*(delete(batch) for batch in batches))
+        return {
+            'deleted': sum(deleted for deleted, _ in results),
+            'batches': len(batches),
+            'throttled_retries': sum(retries for _, retries in results)
+        }
+
+    async def _delete_batch(self, user_id, item_ids):
+        retries = 0
+        while item_ids:
+            try:
+                await self.container_client.execute_item_batch(
+                    batch_operations=[('delete', (item_id,)) for item_id in item_ids],
+                    partition_key=user_id
+                )
+                return len(item_ids), retries
+            except (exceptions.CosmosBatchOperationError, exceptions.CosmosHttpResponseError) as e:
+                ## an item was deleted by another request; the batch was rolled back, so retry without it
+                if isinstance(e, exceptions.CosmosBatchOperationError) and e.status_code == 404:
+                    item_ids = item_ids[:e.error_index] + item_ids[e.error_index + 1:]
+                ## the SDK already retried throttled requests; keep backing off a little longer
+                elif e.status_code == 429 and retries < THROTTLE_RETRIES:
+                    await asyncio.sleep(throttle_delay(e, retries))
+                    retries += 1
+                else:
+                    raise
+        return 0, retries
+
+
+    @reconnect_on_transport_error
     async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
         parameters = [
             {
@@ -106,7 +404,278 @@ class CosmosConversationClient():
         
         return conversations
 
+    @reconnect_on_transport_error
+    async def get_conversations_page(self, user_id, limit, cursor = None, offset = 0, sort_order = 'DESC'):
+        ## pages continue from a Cosmos continuation token instead of OFFSET, which reads
+        ## and bills every skipped row
+        continuation_token = decode_cursor(cursor) if cursor else None
+        if continuation_token and continuation_token.startswith(OFFSET_CURSOR_PREFIX):
+            offset = _parse_offset_cursor(continuation_token)
+            cursor = continuation_token = None
+
+        if continuation_token is None and sort_order == 'DESC':
+            index = await self.get_conversation_index(user_id)
+            entries = index['conversations'] if index else []
+            if index and (offset + limit <= len(entries) or index['complete']):
+                conversations = entries[offset:offset + limit]
+                if index['complete'] and offset + limit >= len(entries):
+                    return conversations, None
+                return conversations, encode_cursor(f"{OFFSET_CURSOR_PREFIX}{offset + len(conversations)}")
+
+        if cursor is None and offset:
+            continuation_token = self.page_cursors.get((user_id, sort_order, offset))
+
+        parameters = [
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        fields = ', '.join(f'c.{field}' for field in CONVERSATION_LIST_FIELDS)
+        query = f"SELECT {fields} FROM c WHERE c.userId = @userId AND c.type='conversation' ORDER BY c.updatedAt {sort_order}"
+
+        ## without a token for the offset, page past the skipped rows once to get one
+        conversations, continuation_token = await self._query_window(
+            query, parameters, user_id, limit, continuation_token, to_skip=offset if continuation_token is None else 0
+        )
+
+        if continuation_token is None:
+            return conversations, None
+        if cursor is None:
+            self.page_cursors.set((user_id, sort_order, offset + len(conversations)), continuation_token)
+        return conversations, encode_cursor(continuation_token)
+
+    @reconnect_on_transport_error
+    async def get_conversation_index(self, user_id):
+        ## include this worker's pending updates, so users see their own writes
+        task = self._index_tasks.get(user_id)
+        if task is not None:
+            await asyncio.wait({task})
+        try:
+            return await self.container_client.read_item(item=CONVERSATION_INDEX_ID, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            pass
+
+        ## build the index from the query the first time
+        parameters = [
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        fields = ', '.join(f'c.{field}' for field in CONVERSATION_LIST_FIELDS)
+        query = f"SELECT {fields} FROM c WHERE c.userId = @userId AND c.type='conversation' ORDER BY c.updatedAt DESC"
+        entries, continuation_token = await self._query_window(query, parameters, user_id, CONVERSATION_INDEX_SIZE, None)
+        if continuation_token is not None:
+            ## the list continues from the query where the index ends
+            self.page_cursors.set((user_id, 'DESC', len(entries)), continuation_token)
+        index = {
+            'id': CONVERSATION_INDEX_ID,
+            'type': 'conversationIndex',
+            'userId': user_id,
+            'conversations': entries,
+            'complete': continuation_token is None
+        }
+        try:
+            index = await self.container_client.create_item(index)
+        except exceptions.CosmosResourceExistsError:
+            ## built by a concurrent request
+            return index
+
+        ## a conversation written between the query and the create found no index to update,
+        ## so query again; writes after the create update the index document themselves
+        fresh_entries, fresh_token = await self._query_window(query, parameters, user_id, CONVERSATION_INDEX_SIZE, None)
+        if fresh_entries == entries:
+            return index
+        self._clear_page_cursors(user_id)
+        if fresh_token is not None:
+            self.page_cursors.set((user_id, 'DESC', len(fresh_entries)), fresh_token)
+        rebuilt = dict(index, conversations=fresh_entries, complete=fresh_token is None)
+        try:
+            return await self.container_client.replace_item(
+                item=CONVERSATION_INDEX_ID,
+                body=rebuilt,
+                etag=index['_etag'],
+                match_condition=MatchConditions.IfNotModified
+            )
+        except exceptions.CosmosAccessConditionFailedError:
+            ## already updated on top of the stale entries; drop it so the next list rebuilds it
+            await self._delete_conversation_index(user_id)
+            return rebuilt
+
+    def _clear_page_cursors(self, user_id):
+        for key in self.page_cursors.keys():
+            if key[0] == user_id:
+                self.page_cursors.pop(key)
+
+    def _update_conversation_index(self, user_id, update):
+        ## the continuation tokens saved for the pages after the index may be shifted by the write
+        self._clear_page_cursors(user_id)
+        ## applied in the background so history writes do not wait on the index; updates
+        ## that queue up while one is being applied are applied together
+        pending = self._index_updates.get(user_id)
+        if pending is not None:
+            pending.append(update)
+            return
+        self._index_updates[user_id] = [update]
+        self._index_tasks[user_id] = asyncio.create_task(self._apply_index_updates(user_id))
+
+    async def _apply_index_updates(self, user_id):
+        try:
+            await asyncio.sleep(CONVERSATION_INDEX_DELAY)
+            while self._index_updates[user_id]:
+                updates = self._index_updates[user_id]
+                self._index_updates[user_id] = []
+                await self._replace_conversation_index(user_id, updates)
+        except Exception:
+            logging.exception("Failed to update the conversation index")
+        finally:
+            del self._index_updates[user_id]
+            del self._index_tasks[user_id]
+
+    async def flush_index_updates(self):
+        ## wait for the conversation index updates started so far
+        while self._index_tasks:
+            await asyncio.wait(list(self._index_tasks.values()))
+
+    async def _delete_conversation_index(self, user_id):
+        try:
+            await self.container_client.delete_item(item=CONVERSATION_INDEX_ID, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            pass
+
+    async def _replace_conversation_index(self, user_id, updates):
+        ## a missing index is built from the query on the next list, so only existing ones are updated
+        try:
+            for _ in range(CONVERSATION_INDEX_RETRIES):
+                try:
+                    index = await self.container_client.read_item(item=CONVERSATION_INDEX_ID, partition_key=user_id)
+                except exceptions.CosmosResourceNotFoundError:
+                    return
+
+                entries = list(index['conversations'])
+                for update in updates:
+                    entries = update(entries)
+                if len(entries) > CONVERSATION_INDEX_SIZE:
+                    index['complete'] = False
+                index['conversations'] = entries[:CONVERSATION_INDEX_SIZE]
+                try:
+                    await self.container_client.replace_item(
+                        item=CONVERSATION_INDEX_ID,
+                        body=index,
+                        etag=index['_etag'],
+                        match_condition=MatchConditions.IfNotModified
+                    )
+                    return
+                except exceptions.CosmosAccessConditionFailedError:
+                    continue
+
+            ## keep losing to concurrent writers; drop the index so the next list rebuilds it
+            await self._delete_conversation_index(user_id)
+        except exceptions.CosmosHttpResponseError as e:
+            logging.warning(f"Failed to update the conversation index: {e}")
+
+    async def _query_window(self, query, parameters, user_id, limit, continuation_token, to_skip = 0):
+        ## the service may return short pages, so keep reading until the window is full
+        items = []
+        while True:
+            page, continuation_token = await self._query_page(
+                query, parameters, user_id, to_skip or limit - len(items), continuation_token
+            )
+            if to_skip:
+                to_skip -= len(page)
+            else:
+                items.extend(page)
+            if continuation_token is None or (not to_skip and len(items) >= limit):
+                return items, continuation_token
+
+    async def _query_page(self, query, parameters, user_id, max_item_count, continuation_token):
+        pages = self.container_client.query_items(
+            query=query, parameters=parameters, partition_key=user_id, max_item_count=max_item_count
+        ).by_page(continuation_token)
+        async for page in pages:
+            return [item async for item in page], pages.continuation_token
+        return [], None
+
+    @reconnect_on_transport_error
     async def get_conversation(self, user_id, conversation_id):
+        cache_key = (user_id, conversation_id)
+        conversation = self.conversation_cache.get(cache_key)
+        if conversation is None:
+            ## the id and the partition key are both known, so this is a point read
+            try:
+                conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)
+            except exceptions.CosmosResourceNotFoundError:
+                return None
+
+            if conversation.get('type') != 'conversation':
+                return None
+            self.conversation_cache.set(cache_key, conversation)
+
+        ## callers may modify the returned document
+        return dict(conversation)
+ 
+    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+        resp = await self.create_messages(conversation_id, user_id, [(uuid, input_message)])
+        if isinstance(resp, list):
+            return resp[0]
+        return resp
+
+    @reconnect_on_transport_error
+    async def create_messages(self, conversation_id, user_id, input_messages):
+        ## write the messages and move the parent conversation's updatedAt to the last
+        ## message's createdAt in one transactional batch within the user's partition
+        ## messages are ordered by createdAt, so keep the ones in a batch strictly increasing
+        created_at = datetime.utcnow()
+        messages = [
+            self._build_message(uuid, conversation_id, user_id, input_message, created_at + timedelta(microseconds=i))
+            for i, (uuid, input_message) in enumerate(input_messages)
+        ]
+        ## the conversation as it was before the write tells whether a cached prompt history is current
+        batch_operations = [('read', (conversation_id,))]
+        batch_operations += [('upsert', (message,)) for message in messages]
+        ## the predicate fails the batch when the id is not a conversation, e.g. a message or the index
+        batch_operations.append((
+            'patch',
+            (conversation_id, [{'op': 'set', 'path': '/updatedAt', 'value': messages[-1]['createdAt']}]),
+            {'filter_predicate': "FROM c WHERE c.type = 'conversation'"},
+        ))
+
+        self.conversation_cache.pop((user_id, conversation_id))
+        try:
+            results = await self.container_client.execute_item_batch(
+                batch_operations=batch_operations, partition_key=user_id
+            )
+        except exceptions.CosmosBatchOperationError as e:
+            ## the batch is rolled back, so no message is written without its conversation
+            if e.error_index in (0, len(batch_operations) - 1) and e.status_code in (404, 412):
+                return "Conversation not found"
+            raise
+
+        if results:
+            previous, conversation = results[0]['resourceBody'], results[-1]['resourceBody']
+            self._extend_history(user_id, conversation_id, previous['updatedAt'], conversation['updatedAt'], messages)
+            self._update_conversation_index(user_id, lambda entries: _index_upsert(entries, conversation))
+            return [result['resourceBody'] for result in results[1:-1]]
+        else:
+            return False
+
+    @reconnect_on_transport_error
+    async def get_chat_history(self, user_id, conversation_id):
+        ## the user and assistant messages of a conversation, oldest first, for rebuilding the prompt;
+        ## the conversation is always read so a history cached before another worker's write is not used
+        try:
+            conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+        if conversation.get('type') != 'conversation':
+            return None
+
+        cache_key = (user_id, conversation_id)
+        cached = self.history_cache.get(cache_key)
+        if cached is not None and cached['updatedAt'] == conversation['updatedAt']:
+            return list(cached['messages'])
+
         parameters = [
             {
                 'name': '@conversationId',
@@ -117,53 +686,98 @@ class CosmosConversationClient():
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId"
-        conversations = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            conversations.append(item)
+        fields = ', '.join(f'c.{field}' for field in HISTORY_FIELDS)
+        query = f"SELECT {fields} FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId AND c.role != 'tool' ORDER BY c.createdAt ASC"
+        messages = [
+            _history_message(item)
+            async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id)
+        ]
+        self.history_cache.set(cache_key, {'updatedAt': conversation['updatedAt'], 'messages': messages})
+        return list(messages)
 
-        ## if no conversations are found, return None
-        if len(conversations) == 0:
+    @reconnect_on_transport_error
+    async def get_conversation_summary(self, user_id, conversation_id):
+        try:
+            return await self.container_client.read_item(item=SUMMARY_ID_PREFIX + conversation_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
             return None
-        else:
-            return conversations[0]
- 
-    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+
+    @reconnect_on_transport_error
+    async def upsert_conversation_summary(self, user_id, conversation_id, content, last_message_id, message_count, token_count = None):
+        ## the summary covers the conversation's messages up to and including last_message_id
+        summary = {
+            'id': SUMMARY_ID_PREFIX + conversation_id,
+            'type': 'conversationSummary',
+            'userId': user_id,
+            'conversationId': conversation_id,
+            'content': content,
+            'lastMessageId': last_message_id,
+            'messageCount': message_count,
+            'updatedAt': datetime.utcnow().isoformat()
+        }
+        if token_count is not None:
+            summary['tokenCount'] = token_count
+        return await self.container_client.upsert_item(summary)
+
+    @reconnect_on_transport_error
+    async def delete_conversation_summary(self, user_id, conversation_id):
+        try:
+            await self.container_client.delete_item(item=SUMMARY_ID_PREFIX + conversation_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            pass
+
+    def _extend_history(self, user_id, conversation_id, previous_updated_at, updated_at, messages):
+        cache_key = (user_id, conversation_id)
+        cached = self.history_cache.get(cache_key)
+        if cached is None:
+            return
+        if cached['updatedAt'] != previous_updated_at:
+            ## another worker wrote to the conversation since the history was cached
+            self.history_cache.pop(cache_key)
+            return
+        self.history_cache.set(cache_key, {
+            'updatedAt': updated_at,
+            'messages': cached['messages'] + [
+                _history_message({field: message[field] for field in HISTORY_FIELDS if field in message})
+                for message in messages if message['role'] != 'tool'
+            ]
+        })
+
+    def _build_message(self, uuid, conversation_id, user_id, input_message: dict, created_at = None):
+        created_at = (created_at or datetime.utcnow()).isoformat()
         message = {
             'id': uuid,
             'type': 'message',
             'userId' : user_id,
-            'createdAt': datetime.utcnow().isoformat(),
-            'updatedAt': datetime.utcnow().isoformat(),
+            'createdAt': created_at,
+            'updatedAt': created_at,
             'conversationId' : conversation_id,
             'role': input_message['role'],
             'content': input_message['content']
         }
 
+        if 'tokenCount' in input_message:
+            message['tokenCount'] = input_message['tokenCount']
+        ## the kind of content (e.g. 'img'); 'type' is the document type
+        if input_message.get('type'):
+            message['contentType'] = input_message['type']
         if self.enable_message_feedback:
             message['feedback'] = ''
-        
-        resp = await self.container_client.upsert_item(message)  
-        if resp:
-            ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = await self.get_conversation(user_id, conversation_id)
-            if not conversation:
-                return "Conversation not found"
-            conversation['updatedAt'] = message['createdAt']
-            await self.upsert_conversation(conversation)
-            return resp
-        else:
-            return False
+        return message
     
+    @reconnect_on_transport_error
     async def update_message_feedback(self, user_id, message_id, feedback):
-        message = await self.container_client.read_item(item=message_id, partition_key=user_id)
-        if message:
-            message['feedback'] = feedback
-            resp = await self.container_client.upsert_item(message)
+        try:
+            resp = await self.container_client.patch_item(
+                item=message_id,
+                partition_key=user_id,
+                patch_operations=[{'op': 'set', 'path': '/feedback', 'value': feedback}]
+            )
             return resp
-        else:
+        except exceptions.CosmosResourceNotFoundError:
             return False
 
+    @reconnect_on_transport_error
     async def get_messages(self, user_id, conversation_id):
         parameters = [
             {
@@ -175,10 +789,33 @@ class CosmosConversationClient():
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.timestamp ASC"
+        fields = ', '.join(f'c.{field}' for field in MESSAGE_READ_FIELDS)
+        query = f"SELECT {fields} FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.createdAt ASC"
         messages = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            messages.append(item)
+        async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id):
+            messages.append(_history_message(item))
 
         return messages
 
+    @reconnect_on_transport_error
+    async def get_messages_page(self, user_id, conversation_id, limit, cursor = None):
+        ## the newest `limit` messages, or those before the cursor, returned oldest first
+        continuation_token = decode_cursor(cursor) if cursor else None
+        parameters = [
+            {
+                'name': '@conversationId',
+                'value': conversation_id
+            },
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        fields = ', '.join(f'c.{field}' for field in MESSAGE_READ_FIELDS)
+        query = f"SELECT {fields} FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.createdAt DESC"
+        messages, continuation_token = await self._query_window(
+            query, parameters, user_id, limit, continuation_token
+        )
+        messages = [_history_message(message) for message in reversed(messages)]
+        return messages, encode_cursor(continuation_token) if continuation_token else None
+
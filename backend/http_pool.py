@@ -0,0 +1,63 @@
+import logging
+import httpx
+
+from openai import DEFAULT_TIMEOUT
+
+
+def create_pooled_http_client(
+    max_connections: int,
+    max_keepalive_connections: int,
+    keepalive_expiry: float,
+    http2: bool = False,
+    timeout: httpx.Timeout = DEFAULT_TIMEOUT,
+) -> httpx.AsyncClient:
+    '''
+    Build a long-lived httpx.AsyncClient whose connection pool is shared by every
+    request the worker makes to a given upstream.
+    '''
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logging.warning("HTTP/2 was requested but the 'h2' package is not installed -- falling back to HTTP/1.1")
+            http2 = False
+
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+    return httpx.AsyncClient(limits=limits, http2=http2, timeout=timeout)
+
+
+def get_pool_statistics(http_client: httpx.AsyncClient) -> dict:
+    '''
+    Report the occupancy of an httpx.AsyncClient connection pool.
+
+    httpx does not expose pool internals publicly, so this reads the underlying
+    httpcore pool defensively and returns an empty report if the layout changes.
+    '''
+    if http_client is None:
+        return {}
+
+    pool = getattr(getattr(http_client, "_transport", None), "_pool", None)
+    connections = getattr(pool, "connections", None)
+    if connections is None:
+        return {}
+
+    stats = {
+        "connections": len(connections),
+        "idle": sum(1 for connection in connections if connection.is_idle()),
+        "active": sum(
+            1 for connection in connections
+            if not connection.is_idle() and not connection.is_closed()
+        ),
+        "http2": sum(1 for connection in connections if "HTTP/2" in connection.info()),
+        "queued_requests": sum(
+            1 for pool_request in getattr(pool, "_requests", [])
+            if pool_request.is_queued()
+        ),
+        "max_connections": getattr(pool, "_max_connections", None),
+        "max_keepalive_connections": getattr(pool, "_max_keepalive_connections", None),
+    }
+    return stats
@@ -0,0 +1,171 @@
+import time
+import logging
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from backend.cache import TTLCache
+from backend.completion_cache import make_cache_key
+
+
+def get_last_user_question(request_messages, first_turn_only: bool = True) -> Optional[str]:
+    '''
+    Return the text of the final user message of a chat request, or None if
+    the request is not eligible for the semantic cache. With `first_turn_only`
+    only requests that consist of a single user question are eligible, since
+    the answer to a follow-up depends on the turns before it.
+    '''
+    messages = [message for message in request_messages if message.get("role") != "tool"]
+    if not messages or messages[-1].get("role") != "user":
+        return None
+    if first_turn_only and len(messages) > 1:
+        return None
+
+    message = messages[-1]
+    if message.get("type") == "img" or not isinstance(message.get("content"), str):
+        return None
+    question = " ".join(message["content"].split())
+    return question or None
+
+
+def get_partition_key(model_args) -> str:
+    '''
+    Answers may only be shared between requests with the same model parameters,
+    system message and data source payload (including its security filter).
+    '''
+    return make_cache_key({
+        **model_args,
+        "messages": [message for message in model_args.get("messages", []) if message.get("role") == "system"],
+    })
+
+
+class _VectorPartition:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.vectors: List[np.ndarray] = []
+        self.entries: List[Tuple[dict, float]] = []
+        self._matrix: Optional[np.ndarray] = None
+
+    def search(self, vector: np.ndarray) -> Tuple[Optional[dict], float]:
+        self._expire()
+        if not self.vectors:
+            return None, 0.0
+
+        if self._matrix is None:
+            self._matrix = np.vstack(self.vectors)
+        similarities = self._matrix @ vector
+        best = int(np.argmax(similarities))
+        return self.entries[best][0], float(similarities[best])
+
+    def add(self, vector: np.ndarray, entry: dict, ttl: float):
+        self._expire()
+        if len(self.vectors) >= self.max_entries:
+            # Entries share one TTL, so the oldest entry expires first anyway
+            del self.vectors[0]
+            del self.entries[0]
+        self.vectors.append(vector)
+        self.entries.append((entry, time.monotonic() + ttl))
+        self._matrix = None
+
+    def _expire(self):
+        now = time.monotonic()
+        expired = 0
+        while expired < len(self.entries) and self.entries[expired][1] <= now:
+            expired += 1
+        if expired:
+            del self.vectors[:expired]
+            del self.entries[:expired]
+            self._matrix = None
+
+
+class SemanticCache:
+    '''
+    Per-worker cache of chat answers keyed by the embedding of the user's
+    question, so paraphrases of a question that was already answered are
+    served without another On Your Data round trip.
+
+    Vectors are kept in a brute-force NumPy index per partition (see
+    get_partition_key); a cached answer is returned when the cosine similarity
+    of the closest question reaches `similarity_threshold`.
+    '''
+
+    def __init__(
+        self,
+        azure_openai_client,
+        embedding_model: str,
+        similarity_threshold: float = 0.95,
+        ttl: float = 3600,
+        max_entries: int = 1000,
+        max_partitions: int = 1024,
+        first_turn_only: bool = True,
+    ):
+        self._azure_openai_client = azure_openai_client
+        self.embedding_model = embedding_model
+        self.similarity_threshold = similarity_threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.first_turn_only = first_turn_only
+        # Partitions that receive no new answers for `ttl` seconds hold only expired entries
+        self._partitions = TTLCache(max_size=max_partitions, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.errors = 0
+
+    async def embed(self, text: str) -> np.ndarray:
+        response = await self._azure_openai_client.embeddings.create(model=self.embedding_model, input=text)
+        vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    async def lookup(self, request_messages, model_args) -> Tuple[Optional[dict], Optional[tuple]]:
+        '''
+        Return the cached entry for the request if there is one. Otherwise
+        return the slot (partition and question vector) under which the new
+        answer should be stored, or None if the request is not eligible.
+        '''
+        question = get_last_user_question(request_messages, self.first_turn_only)
+        if question is None:
+            return None, None
+
+        try:
+            vector = await self.embed(question)
+        except Exception as e:
+            self.errors += 1
+            logging.warning(f"Semantic cache embedding failed: {e}")
+            return None, None
+
+        partition_key = get_partition_key(model_args)
+        partition = self._partitions.get(partition_key)
+        if partition is not None:
+            entry, similarity = partition.search(vector)
+            if entry is not None and similarity >= self.similarity_threshold:
+                self.hits += 1
+                logging.debug(f"Semantic cache hit with similarity {similarity:.3f}")
+                return entry, None
+
+        self.misses += 1
+        return None, (partition_key, vector)
+
+    async def set(self, slot: tuple, entry: Optional[dict]):
+        if not entry or not entry["messages"]:
+            return
+
+        partition_key, vector = slot
+        partition = self._partitions.get(partition_key)
+        if partition is None:
+            partition = _VectorPartition(self.max_entries)
+        partition.add(vector, entry, self.ttl)
+        self._partitions.set(partition_key, partition)
+        self.stores += 1
+
+    def get_statistics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "stores": self.stores,
+            "errors": self.errors,
+            "partitions": len(self._partitions),
+            "similarity_threshold": self.similarity_threshold,
+        }
@@ -16,6 +16,7 @@ from pydantic import (
 )
 from pydantic.alias_generators import to_snake
 from pydantic_settings import BaseSettings, SettingsConfigDict
+from types import MappingProxyType
 from typing import List, Literal, Optional
 from typing_extensions import Self
 from quart import Request
@@ -64,6 +65,48 @@ class _ChatHistorySettings(BaseSettings):
     account_key: str
     conversations_container: str
     enable_feedback: bool = False
+    conversation_cache_ttl: confloat(ge=0) = 30.0
+    messages_page_size: conint(ge=1) = 100
+    summarize_after_messages: Optional[conint(ge=1)] = None
+    summary_recent_messages: conint(ge=0) = 10
+
+
+class _CompletionCacheSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="COMPLETION_CACHE_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    enabled: bool = False
+    backend: Literal["memory", "redis"] = "memory"
+    ttl: conint(ge=1) = 3600
+    max_size: conint(ge=1) = 1024
+    redis_url: Optional[str] = None
+
+    @model_validator(mode="after")
+    def validate_backend(self) -> Self:
+        if self.enabled and self.backend == "redis" and not self.redis_url:
+            raise ValueError("COMPLETION_CACHE_REDIS_URL is required for the redis completion cache backend")
+
+        return self
+
+
+class _SemanticCacheSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="SEMANTIC_CACHE_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    enabled: bool = False
+    embedding_model: Optional[str] = None
+    similarity_threshold: confloat(ge=0, le=1) = 0.95
+    ttl: conint(ge=1) = 3600
+    max_entries: conint(ge=1) = 1000
+    first_turn_only: bool = True
 
 
 class _PromptflowSettings(BaseSettings):
@@ -123,7 +166,19 @@ class _AzureOpenAISettings(BaseSettings):
     embedding_endpoint: Optional[str] = None
     embedding_key: Optional[str] = None
     embedding_name: Optional[str] = None
-    
+    max_connections: conint(ge=1) = 100
+    max_keepalive_connections: conint(ge=0) = 20
+    keepalive_expiry: float = 30.0
+    http2: bool = False
+    stream_coalescing: bool = False
+    stream_coalescing_max_bytes: conint(ge=1) = 256
+    stream_coalescing_window_ms: confloat(ge=0) = 20.0
+    single_flight: bool = False
+    history_token_budget: Optional[conint(ge=1)] = None
+    max_concurrent_requests: Optional[conint(ge=1)] = None
+    max_queued_requests: conint(ge=0) = 100
+    queue_timeout: confloat(gt=0) = 30.0
+
     @field_validator('tools', mode='before')
     @classmethod
     def deserialize_tools(cls, tools_json_str: str) -> List[_AzureOpenAITool]:
@@ -218,18 +273,42 @@ class _SearchCommonSettings(BaseSettings):
 
 class DatasourcePayloadConstructor(BaseModel, ABC):
     _settings: '_AppSettings' = PrivateAttr()
+    _payload_template: Optional[MappingProxyType] = PrivateAttr(default=None)
     
     def __init__(self, settings: '_AppSettings', **data):
         super().__init__(**data)
         self._settings = settings
     
+    # Request-independent part of the payload, resolved once and reused
     @abstractmethod
-    def construct_payload_configuration(
+    def construct_payload_template(self) -> dict:
+        pass
+
+    # Per-request parameters merged over the template (e.g. security filters)
+    async def construct_request_parameters(self, request: Optional[Request] = None) -> dict:
+        return {}
+
+    def get_payload_template(self) -> MappingProxyType:
+        if self._payload_template is None:
+            template = self.construct_payload_template()
+            template["parameters"] = MappingProxyType(template["parameters"])
+            self._payload_template = MappingProxyType(template)
+
+        return self._payload_template
+
+    async def construct_payload_configuration(
         self,
         *args,
         **kwargs
     ):
-        pass
+        template = self.get_payload_template()
+        parameters = dict(template["parameters"])
+        parameters.update(await self.construct_request_parameters(kwargs.pop('request', None)))
+
+        return {
+            "type": template["type"],
+            "parameters": parameters
+        }
 
 
 class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
@@ -306,7 +385,7 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
     def set_query_type(self) -> Self:
         self.query_type = to_snake(self.query_type)
 
-    def _set_filter_string(self, request: Request) -> str:
+    async def _set_filter_string(self, request: Request) -> str:
         if self.permitted_groups_column:
             user_token = request.headers.get("X-MS-TOKEN-AAD-ACCESS-TOKEN", "")
             logging.debug(f"USER TOKEN is {'present' if user_token else 'not present'}")
@@ -315,24 +394,16 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
                     "Document-level access control is enabled, but user access token could not be fetched."
                 )
 
-            filter_string = generateFilterString(user_token)
+            filter_string = await generateFilterString(user_token)
             logging.debug(f"FILTER: {filter_string}")
             return filter_string
         
         return None
             
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
-        request = kwargs.pop('request', None)
-        if request and self.permitted_groups_column:
-            self.filter = self._set_filter_string(request)
-            
+    def construct_payload_template(self) -> dict:
         self.embedding_dependency = \
             self._settings.azure_openai.extract_embedding_dependency()
-        parameters = self.model_dump(exclude_none=True, by_alias=True)
+        parameters = self.model_dump(exclude_none=True, by_alias=True, exclude={"filter"})
         parameters.update(self._settings.search.model_dump(exclude_none=True, by_alias=True))
         
         return {
@@ -340,6 +411,12 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
             "parameters": parameters
         }
 
+    async def construct_request_parameters(self, request: Optional[Request] = None) -> dict:
+        if request and self.permitted_groups_column:
+            return {"filter": await self._set_filter_string(request)}
+
+        return {}
+
 
 class _AzureCosmosDbMongoVcoreSettings(
     BaseSettings,
@@ -395,11 +472,7 @@ class _AzureCosmosDbMongoVcoreSettings(
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def construct_payload_template(self) -> dict:
         self.embedding_dependency = \
             self._settings.azure_openai.extract_embedding_dependency()
         parameters = self.model_dump(exclude_none=True, by_alias=True)
@@ -462,11 +535,7 @@ class _ElasticsearchSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def construct_payload_template(self) -> dict:
         self.embedding_dependency = \
             {"type": "model_id", "model_id": self.embedding_model_id} if self.embedding_model_id else \
             self._settings.azure_openai.extract_embedding_dependency() 
@@ -531,11 +600,7 @@ class _PineconeSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def construct_payload_template(self) -> dict:
         self.embedding_dependency = \
             self._settings.azure_openai.extract_embedding_dependency()
         parameters = self.model_dump(exclude_none=True, by_alias=True)
@@ -586,11 +651,7 @@ class _AzureMLIndexSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def construct_payload_template(self) -> dict:
         parameters = self.model_dump(exclude_none=True, by_alias=True)
         parameters.update(self._settings.search.model_dump(exclude_none=True, by_alias=True))
         
@@ -624,11 +685,7 @@ class _AzureSqlServerSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def construct_payload_template(self) -> dict:
         parameters = self.model_dump(exclude_none=True, by_alias=True)
         #parameters.update(self._settings.search.model_dump(exclude_none=True, by_alias=True))
         
@@ -649,6 +706,8 @@ class _BaseSettings(BaseSettings):
     auth_enabled: bool = False
     sanitize_answer: bool = False
     use_promptflow: bool = False
+    request_log_sample_rate: confloat(ge=0.0, le=1.0) = 0.0
+    diagnostics_enabled: bool = False
 
 
 class _AppSettings(BaseModel):
@@ -656,6 +715,8 @@ class _AppSettings(BaseModel):
     azure_openai: _AzureOpenAISettings = _AzureOpenAISettings()
     search: _SearchCommonSettings = _SearchCommonSettings()
     ui: Optional[_UiSettings] = _UiSettings()
+    completion_cache: _CompletionCacheSettings = _CompletionCacheSettings()
+    semantic_cache: _SemanticCacheSettings = _SemanticCacheSettings()
     
     # Constructed properties
     chat_history: Optional[_ChatHistorySettings] = None
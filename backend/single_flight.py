@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from backend.utils import close_upstream_stream
+
+
+def with_fresh_id(response, response_id: Optional[str] = None):
+    '''
+    Copy of a completion or completion chunk under a new response id. Answers
+    are stored in the conversation history under their id, so requests that
+    share one upstream answer must not share its id.
+    '''
+    model_copy = getattr(response, "model_copy", None)
+    if model_copy is None:
+        return response
+    return model_copy(update={"id": response_id or f"chatcmpl-{uuid.uuid4()}"})
+
+
+class SharedStream:
+    '''
+    One upstream completion stream read on its own task into a buffer that any
+    number of subscribers replay from the start, so a subscriber that joins
+    late first receives the chunks already emitted. The upstream is cancelled
+    and closed as soon as its last subscriber leaves.
+    '''
+
+    def __init__(self, open_stream: Callable[[], Awaitable[Tuple[Any, Any]]]):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.response = None
+        self.apim_request_id = None
+        self.subscribers = 0
+        self.cancelled = False
+        self._started = asyncio.Event()
+        self._changed = asyncio.Event()
+        self.task = asyncio.create_task(self._run(open_stream))
+
+    async def _run(self, open_stream):
+        try:
+            self.response, self.apim_request_id = await open_stream()
+            self._started.set()
+            async for chunk in self.response:
+                self.chunks.append(chunk)
+                self._notify()
+        except asyncio.CancelledError:
+            if self.response is not None:
+                await close_upstream_stream(self.response)
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._started.set()
+            self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_started(self):
+        '''Wait for the upstream response, re-raising the error if it could not be opened.'''
+        await self._started.wait()
+        if self.response is None and self.error is not None:
+            raise self.error
+
+    def subscribe(self, fresh_id: bool = False) -> "SharedStreamSubscriber":
+        self.subscribers += 1
+        return SharedStreamSubscriber(self, f"chatcmpl-{uuid.uuid4()}" if fresh_id else None)
+
+    def unsubscribe(self):
+        self.subscribers -= 1
+        if self.subscribers == 0 and not self.done:
+            self.cancelled = True
+            self.task.cancel()
+
+    async def iterate(self):
+        index = 0
+        while True:
+            if index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            elif self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            else:
+                await self._changed.wait()
+
+
+class SharedStreamSubscriber:
+    '''
+    Async iterable view of a SharedStream; closing it releases the subscription.
+    With a `response_id` the chunks are replayed under that id instead of the
+    upstream one.
+    '''
+
+    def __init__(self, stream: SharedStream, response_id: Optional[str] = None):
+        self._stream = stream
+        self._response_id = response_id
+        self._closed = False
+
+    @property
+    def apim_request_id(self):
+        return self._stream.apim_request_id
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream.iterate():
+                yield chunk if self._response_id is None else with_fresh_id(chunk, self._response_id)
+        finally:
+            await self.close()
+
+    async def close(self):
+        if not self._closed:
+            self._closed = True
+            self._stream.unsubscribe()
+
+
+class _Call:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    '''
+    Collapses identical concurrent chat requests into one upstream call.
+
+    The first request for a key starts the call on its own task; requests with
+    the same key that arrive before it finishes attach to it instead of calling
+    Azure OpenAI again. Finished calls are forgotten immediately, so this only
+    deduplicates work that is in flight (the response caches cover the rest).
+    Followers get the answer under a fresh response id.
+    '''
+
+    def __init__(self):
+        self._flights: Dict[Hashable, Any] = {}
+        self.leaders = 0
+        self.followers = 0
+        self.late_joiners = 0
+        self.upstream_cancellations = 0
+
+    def _register(self, key: Hashable, flight, task: asyncio.Task):
+        self._flights[key] = flight
+
+        def forget(_):
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            if getattr(flight, "cancelled", False):
+                self.upstream_cancellations += 1
+
+        task.add_done_callback(forget)
+
+    async def call(self, key: Hashable, func: Callable[[], Awaitable[Tuple[Any, Any]]]) -> Tuple[Any, Any]:
+        '''Run `func` (which returns the completion and its apim-request-id) once for concurrent callers of `key`.'''
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _Call(asyncio.create_task(func()))
+            self._register(key, flight, flight.task)
+            self.leaders += 1
+        else:
+            self.followers += 1
+
+        flight.waiters += 1
+        try:
+            response, apim_request_id = await asyncio.shield(flight.task)
+            return (response if leader else with_fresh_id(response)), apim_request_id
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # Every caller went away; nobody needs the result any more
+                flight.task.cancel()
+
+    async def stream(self, key: Hashable, open_stream: Callable[[], Awaitable[Tuple[Any, Any]]]) -> SharedStreamSubscriber:
+        '''
+        Subscribe to the shared stream for `key`, opening it with `open_stream`
+        (which returns the upstream response and its apim-request-id) if no
+        identical stream is in flight.
+        '''
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = SharedStream(open_stream)
+            self._register(key, flight, flight.task)
+            self.leaders += 1
+        else:
+            self.followers += 1
+            if flight.chunks:
+                self.late_joiners += 1
+            logging.debug(f"Joined in-flight stream with {len(flight.chunks)} chunks already emitted")
+
+        subscriber = flight.subscribe(fresh_id=not leader)
+        try:
+            await flight.wait_started()
+        except BaseException:
+            await subscriber.close()
+            raise
+        return subscriber
+
+    def get_statistics(self) -> dict:
+        return {
+            "in_flight": len(self._flights),
+            "upstream_calls": self.leaders,
+            "followers": self.followers,
+            "late_joiners": self.late_joiners,
+            "upstream_cancellations": self.upstream_cancellations,
+        }
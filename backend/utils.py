@@ -1,10 +1,16 @@
 import os
 import json
+import asyncio
+import base64
+import random
+import hashlib
 import logging
-import requests
 import dataclasses
+import httpx
 
 from typing import List
+from backend.cache import TTLCache
+from backend.http_pool import create_pooled_http_client
 
 DEBUG = os.environ.get("DEBUG", "false")
 if DEBUG.lower() == "true":
@@ -13,6 +19,22 @@ if DEBUG.lower() == "true":
 AZURE_SEARCH_PERMITTED_GROUPS_COLUMN = os.environ.get(
     "AZURE_SEARCH_PERMITTED_GROUPS_COLUMN"
 )
+AZURE_SEARCH_PERMITTED_GROUPS_CACHE_TTL = float(
+    os.environ.get("AZURE_SEARCH_PERMITTED_GROUPS_CACHE_TTL", 300)
+)
+AZURE_SEARCH_PERMITTED_GROUPS_CACHE_SIZE = int(
+    os.environ.get("AZURE_SEARCH_PERMITTED_GROUPS_CACHE_SIZE", 1024)
+)
+
+_graph_http_client = None
+_user_groups_cache = TTLCache(
+    max_size=AZURE_SEARCH_PERMITTED_GROUPS_CACHE_SIZE,
+    ttl=AZURE_SEARCH_PERMITTED_GROUPS_CACHE_TTL,
+)
+_group_filter_cache = TTLCache(
+    max_size=AZURE_SEARCH_PERMITTED_GROUPS_CACHE_SIZE,
+    ttl=AZURE_SEARCH_PERMITTED_GROUPS_CACHE_TTL,
+)
 
 
 # AZURE BLOB STORAGE
@@ -37,6 +59,77 @@ async def format_as_ndjson(r):
         yield json.dumps({"error": str(error)})
 
 
+SECRET_PARAMS = {
+    "key",
+    "connection_string",
+    "embedding_key",
+    "encoded_api_key",
+    "api_key",
+}
+
+
+def redact_secrets(obj):
+    # Copy-on-write: containers are only copied along paths that hold a secret
+    # or an inline (base64) image, everything else is shared with the input
+    if isinstance(obj, dict):
+        redacted = None
+        for key, value in obj.items():
+            if key in SECRET_PARAMS and value:
+                new_value = "*****"
+            else:
+                new_value = redact_secrets(value)
+            if new_value is not value:
+                if redacted is None:
+                    redacted = dict(obj)
+                redacted[key] = new_value
+        return obj if redacted is None else redacted
+
+    if isinstance(obj, list):
+        redacted = None
+        for index, value in enumerate(obj):
+            new_value = redact_secrets(value)
+            if new_value is not value:
+                if redacted is None:
+                    redacted = list(obj)
+                redacted[index] = new_value
+        return obj if redacted is None else redacted
+
+    if isinstance(obj, str) and obj.startswith("data:") and ";base64," in obj:
+        header, _, data = obj.partition(",")
+        return f"{header},<{len(data)} bytes>"
+
+    return obj
+
+
+class RedactedLogView:
+    # Rendered only if a log record is actually emitted
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return json.dumps(redact_secrets(self.obj), indent=4, cls=JSONEncoder)
+
+
+# Sampled request bodies have their own logger, so REQUEST_LOG_SAMPLE_RATE works
+# without DEBUG (the root logger stays at WARNING otherwise)
+request_body_logger = logging.getLogger("request_body")
+
+
+def _sampled_request_logger():
+    if request_body_logger.level == logging.NOTSET:
+        request_body_logger.setLevel(logging.INFO)
+        if not logging.getLogger().handlers:
+            request_body_logger.addHandler(logging.StreamHandler())
+    return request_body_logger
+
+
+def log_request_body(model_args, sample_rate=0.0):
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("REQUEST BODY: %s", RedactedLogView(model_args))
+    elif sample_rate and random.random() < sample_rate:
+        _sampled_request_logger().info("SAMPLED REQUEST BODY: %s", RedactedLogView(model_args))
+
+
 def parse_multi_columns(columns: str) -> list:
     if "|" in columns:
         return columns.split("|")
@@ -44,40 +137,84 @@ def parse_multi_columns(columns: str) -> list:
         return columns.split(",")
 
 
-def fetchUserGroups(userToken, nextLink=None):
-    # Recursively fetch group membership
-    if nextLink:
-        endpoint = nextLink
-    else:
-        endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
+def getTokenCacheKey(userToken):
+    # Groups are cached per token subject (tenant + object id). The token digest is
+    # part of the key so a token that merely claims another user's subject can never
+    # read that user's cached groups -- only Graph validates the token.
+    digest = hashlib.sha256(userToken.encode()).hexdigest()
+    try:
+        payload = userToken.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        subject = f"{claims.get('tid', '')}:{claims.get('oid') or claims.get('sub', '')}"
+    except Exception:
+        subject = ""
+    return f"{subject}:{digest}"
+
+
+def getGraphClient():
+    # One pooled connection to Microsoft Graph per worker
+    global _graph_http_client
+    if _graph_http_client is None or _graph_http_client.is_closed:
+        _graph_http_client = create_pooled_http_client(
+            max_connections=20,
+            max_keepalive_connections=10,
+            keepalive_expiry=30.0,
+            timeout=httpx.Timeout(10.0),
+        )
+    return _graph_http_client
+
 
+async def closeGraphClient():
+    global _graph_http_client
+    if _graph_http_client is not None:
+        await _graph_http_client.aclose()
+        _graph_http_client = None
+
+
+async def fetchUserGroups(userToken, http_client=None):
+    # Fetch group membership, following @odata.nextLink pages
+    http_client = http_client or getGraphClient()
+    endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
     headers = {"Authorization": "bearer " + userToken}
+    groups = []
     try:
-        r = requests.get(endpoint, headers=headers)
-        if r.status_code != 200:
-            logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
-            return []
+        while endpoint:
+            r = await http_client.get(endpoint, headers=headers)
+            if r.status_code != 200:
+                logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
+                return None
 
-        r = r.json()
-        if "@odata.nextLink" in r:
-            nextLinkData = fetchUserGroups(userToken, r["@odata.nextLink"])
-            r["value"].extend(nextLinkData)
+            r = r.json()
+            groups.extend(r["value"])
+            endpoint = r.get("@odata.nextLink")
 
-        return r["value"]
+        return groups
     except Exception as e:
         logging.error(f"Exception in fetchUserGroups: {e}")
-        return []
+        return None
+
 
-def generateFilterString(userToken):
+async def generateFilterString(userToken, http_client=None):
     # Get list of groups user is a member of
-    userGroups = fetchUserGroups(userToken)
+    cache_key = getTokenCacheKey(userToken)
+    group_ids = _user_groups_cache.get(cache_key)
+    if group_ids is None:
+        userGroups = await fetchUserGroups(userToken, http_client)
+        group_ids = tuple(sorted(obj["id"] for obj in userGroups or []))
+        # Graph failures are not cached so the next request retries
+        if userGroups is not None:
+            _user_groups_cache.set(cache_key, group_ids)
 
     # Construct filter string
-    if not userGroups:
+    if not group_ids:
         logging.debug("No user groups found")
 
-    group_ids = ", ".join([obj["id"] for obj in userGroups])
-    return f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{group_ids}'))"
+    filter_string = _group_filter_cache.get(group_ids)
+    if filter_string is None:
+        filter_string = f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{', '.join(group_ids)}'))"
+        _group_filter_cache.set(group_ids, filter_string)
+
+    return filter_string
 
 
 def generateFilterStringForConversation(filterString, user_id, conversation_id):
@@ -128,41 +265,271 @@ def format_non_streaming_response(chatCompletion, history_metadata, apim_request
 
     return {}
 
+def extract_stream_message(chatCompletionChunk):
+    if len(chatCompletionChunk.choices) > 0:
+        delta = chatCompletionChunk.choices[0].delta
+        if delta:
+            if hasattr(delta, "context"):
+                return {"role": "tool", "content": json.dumps(delta.context)}
+            if delta.content:
+                return {"role": "assistant", "content": delta.content}
+
+    return None
+
+
 def format_stream_response(chatCompletionChunk, history_metadata, apim_request_id):
-    response_obj = {
+    message = extract_stream_message(chatCompletionChunk)
+    if message is None:
+        return {}
+
+    return {
         "id": chatCompletionChunk.id,
         "model": chatCompletionChunk.model,
         "created": chatCompletionChunk.created,
         "object": chatCompletionChunk.object,
-        "choices": [{"messages": []}],
+        "choices": [{"messages": [message]}],
         "history_metadata": history_metadata,
         "apim-request-id": apim_request_id,
     }
 
-    if len(chatCompletionChunk.choices) > 0:
-        delta = chatCompletionChunk.choices[0].delta
-        if delta:
-            if hasattr(delta, "context"):
-                messageObj = {"role": "tool", "content": json.dumps(delta.context)}
-                response_obj["choices"][0]["messages"].append(messageObj)
-                return response_obj
-            if delta.role == "assistant" and hasattr(delta, "context"):
-                messageObj = {
-                    "role": "assistant",
-                    "context": delta.context,
-                }
-                response_obj["choices"][0]["messages"].append(messageObj)
-                return response_obj
-            else:
-                if delta.content:
-                    messageObj = {
-                        "role": "assistant",
-                        "content": delta.content,
-                    }
-                    response_obj["choices"][0]["messages"].append(messageObj)
-                    return response_obj
 
-    return {}
+class StreamResponseEncoder:
+    '''
+    Encodes the chunks of one chat completion stream as NDJSON lines.
+
+    Every line carries the same envelope (id, model, created, object,
+    history_metadata, apim-request-id). It is encoded once per stream, and
+    again only if the upstream chunk identity changes, so each chunk only pays
+    for encoding its own message.
+    '''
+
+    def __init__(self, history_metadata, apim_request_id):
+        self._envelope_suffix = "]}],%s,%s}\n" % (
+            _compact_dumps({"history_metadata": history_metadata})[1:-1],
+            _compact_dumps({"apim-request-id": apim_request_id})[1:-1],
+        )
+        self._envelope_key = None
+        self._envelope_prefix = None
+
+    def encode(self, chatCompletionChunk):
+        return self.encode_message(chatCompletionChunk, extract_stream_message(chatCompletionChunk))
+
+    def encode_message(self, chatCompletionChunk, message):
+        if message is None:
+            return "{}\n"
+
+        envelope_key = (
+            chatCompletionChunk.id,
+            chatCompletionChunk.model,
+            chatCompletionChunk.created,
+            chatCompletionChunk.object,
+        )
+        if envelope_key != self._envelope_key:
+            self._envelope_key = envelope_key
+            self._envelope_prefix = '{"id":%s,"model":%s,"created":%s,"object":%s,"choices":[{"messages":[' % tuple(
+                _compact_dumps(value) for value in envelope_key
+            )
+
+        if message["role"] == "assistant":
+            encoded_message = '{"role":"assistant","content":%s}' % json.dumps(message["content"])
+        else:
+            encoded_message = _compact_dumps(message)
+
+        return self._envelope_prefix + encoded_message + self._envelope_suffix
+
+
+def _compact_dumps(obj):
+    return json.dumps(obj, cls=JSONEncoder, separators=(",", ":"))
+
+
+class StreamCoalescer:
+    '''
+    Merges consecutive assistant deltas of a chat completion stream into fewer
+    frames.
+
+    Pending content is flushed once it reaches `max_bytes` or has been held for
+    `window_ms`, whichever comes first. The first delta of every stream is
+    flushed immediately so time to first token is unchanged. Tool (citation)
+    frames are forwarded untouched, after any pending content. Chunks that
+    carry no message are dropped.
+    '''
+
+    def __init__(self, max_bytes: int = 256, window_ms: float = 20.0):
+        self.max_bytes = max_bytes
+        self.window = window_ms / 1000
+        self.streams = 0
+        self.chunks = 0
+        self.frames = 0
+
+    async def coalesce(self, response):
+        '''Yield (chunk, message) pairs, where message may span several upstream chunks.'''
+        loop = asyncio.get_running_loop()
+        iterator = response.__aiter__()
+        next_chunk = None
+        pending_chunk = None
+        pending_parts = []
+        pending_size = 0
+        deadline = None
+        first_token_sent = False
+        chunks = frames = 0
+
+        def flush():
+            nonlocal pending_chunk, pending_parts, pending_size, deadline, frames
+            message = {"role": "assistant", "content": "".join(pending_parts)}
+            item = (pending_chunk, message)
+            pending_chunk, pending_parts, pending_size, deadline = None, [], 0, None
+            frames += 1
+            return item
+
+        self.streams += 1
+        try:
+            while True:
+                try:
+                    if next_chunk is None and not pending_parts:
+                        chatCompletionChunk = await iterator.__anext__()
+                    else:
+                        # Wait for the next chunk only until the pending content is due
+                        if next_chunk is None:
+                            next_chunk = asyncio.ensure_future(iterator.__anext__())
+                        timeout = max(0, deadline - loop.time()) if pending_parts else None
+                        done, _ = await asyncio.wait({next_chunk}, timeout=timeout)
+                        if not done:
+                            yield flush()
+                            continue
+                        chatCompletionChunk = next_chunk.result()
+                        next_chunk = None
+                except StopAsyncIteration:
+                    break
+                except Exception:
+                    next_chunk = None
+                    if pending_parts:
+                        yield flush()
+                    raise
+
+                chunks += 1
+                message = extract_stream_message(chatCompletionChunk)
+                if message is None:
+                    continue
+
+                if message["role"] != "assistant":
+                    if pending_parts:
+                        yield flush()
+                    frames += 1
+                    yield chatCompletionChunk, message
+                    continue
+
+                if not first_token_sent:
+                    first_token_sent = True
+                    frames += 1
+                    yield chatCompletionChunk, message
+                    continue
+
+                if pending_chunk is None:
+                    pending_chunk = chatCompletionChunk
+                    deadline = loop.time() + self.window
+                pending_parts.append(message["content"])
+                pending_size += len(message["content"])
+                if pending_size >= self.max_bytes or loop.time() >= deadline:
+                    yield flush()
+
+            if pending_parts:
+                yield flush()
+        finally:
+            if next_chunk is not None:
+                next_chunk.cancel()
+                await asyncio.wait({next_chunk})
+            self.chunks += chunks
+            self.frames += frames
+            logging.debug(f"Coalesced stream: {chunks} upstream chunks sent as {frames} frames")
+
+    def get_statistics(self) -> dict:
+        return {
+            "max_bytes": self.max_bytes,
+            "window_ms": self.window * 1000,
+            "streams": self.streams,
+            "upstream_chunks": self.chunks,
+            "frames": self.frames,
+        }
+
+
+class StreamCancellationTracker:
+    '''
+    Records streams that were abandoned by the client before the completion
+    finished, and estimates the completion tokens saved by closing the upstream
+    response early (the unused part of max_tokens, one token per chunk).
+    '''
+
+    def __init__(self):
+        self.cancellations = 0
+        self.chunks_before_cancel = 0
+        self.estimated_tokens_saved = 0
+
+    def record(self, chunks_received, max_tokens=None):
+        tokens_saved = max(0, max_tokens - chunks_received) if max_tokens else 0
+        self.cancellations += 1
+        self.chunks_before_cancel += chunks_received
+        self.estimated_tokens_saved += tokens_saved
+        logging.info(
+            f"Client disconnected after {chunks_received} chunks; closed upstream stream "
+            f"(~{tokens_saved} tokens saved)"
+        )
+
+    def get_statistics(self) -> dict:
+        return {
+            "cancellations": self.cancellations,
+            "chunks_before_cancel": self.chunks_before_cancel,
+            "estimated_tokens_saved": self.estimated_tokens_saved,
+        }
+
+
+async def format_stream_as_ndjson(
+    response, history_metadata, apim_request_id, coalescer=None, cancellation_tracker=None, max_tokens=None
+):
+    encoder = StreamResponseEncoder(history_metadata, apim_request_id)
+    chunks_received = 0
+    completed = False
+    frames = None
+
+    async def counted(upstream):
+        nonlocal chunks_received
+        async for chatCompletionChunk in upstream:
+            chunks_received += 1
+            yield chatCompletionChunk
+
+    try:
+        if coalescer is None:
+            async for chatCompletionChunk in response:
+                chunks_received += 1
+                yield encoder.encode(chatCompletionChunk)
+        else:
+            frames = coalescer.coalesce(counted(response))
+            async for chatCompletionChunk, message in frames:
+                yield encoder.encode_message(chatCompletionChunk, message)
+        completed = True
+    except Exception as error:
+        completed = True
+        logging.exception("Exception while generating response stream: %s", error)
+        yield json.dumps({"error": str(error)})
+    finally:
+        # Reached without completing when the client disconnects: the generator
+        # is cancelled or closed, so stop generation upstream right away.
+        if not completed:
+            if frames is not None:
+                await frames.aclose()
+            await close_upstream_stream(response)
+            if cancellation_tracker is not None:
+                cancellation_tracker.record(chunks_received, max_tokens)
+
+
+async def close_upstream_stream(response):
+    '''Close a streamed completion and drop its HTTP connection.'''
+    close = getattr(response, "close", None)
+    if close is None:
+        return
+    try:
+        await close()
+    except Exception:
+        logging.exception("Failed to close upstream response stream")
 
 
 def format_pf_non_streaming_response(
@@ -0,0 +1,123 @@
+import asyncio
+import pytest
+
+from backend.admission import AdmissionController, AdmissionRejected, AdmittedStream
+
+
+async def _queue(controller, user_id, order):
+    async with controller.admit(user_id):
+        order.append(user_id)
+        await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_requests_within_the_limit_are_admitted_right_away():
+    controller = AdmissionController(max_concurrency=2)
+
+    async with controller.admit("a"):
+        async with controller.admit("b"):
+            assert controller.get_statistics()["active"] == 2
+
+    statistics = controller.get_statistics()
+    assert (statistics["active"], statistics["admitted"], statistics["waited"]) == (0, 2, 0)
+
+
+@pytest.mark.asyncio
+async def test_waiting_users_are_admitted_in_turn():
+    controller = AdmissionController(max_concurrency=1)
+    order = []
+    running = await controller.acquire("heavy")
+
+    waiters = [asyncio.create_task(_queue(controller, "heavy", order)) for _ in range(3)]
+    await asyncio.sleep(0)
+    waiters.append(asyncio.create_task(_queue(controller, "light", order)))
+    await asyncio.sleep(0)
+    assert controller.get_statistics()["queued"] == 4
+
+    running.release()
+    await asyncio.gather(*waiters)
+
+    assert order == ["heavy", "light", "heavy", "heavy"]
+    assert controller.get_statistics()["active"] == 0
+
+
+@pytest.mark.asyncio
+async def test_full_queue_sheds_the_heaviest_user():
+    controller = AdmissionController(max_concurrency=1, max_queue_depth=2)
+    running = await controller.acquire("heavy")
+    first = asyncio.create_task(controller.acquire("heavy"))
+    second = asyncio.create_task(controller.acquire("heavy"))
+    await asyncio.sleep(0)
+
+    light = asyncio.create_task(controller.acquire("light"))
+    await asyncio.sleep(0)
+    with pytest.raises(AdmissionRejected) as rejected:
+        await second
+    assert rejected.value.retry_after >= 1
+
+    ## the queue holds one request of each user now, so another one is rejected
+    with pytest.raises(AdmissionRejected):
+        await controller.acquire("heavy")
+
+    running.release()
+    (await first).release()
+    (await light).release()
+    statistics = controller.get_statistics()
+    assert (statistics["shed"], statistics["rejected"], statistics["active"]) == (1, 1, 0)
+
+
+@pytest.mark.asyncio
+async def test_queue_timeout():
+    controller = AdmissionController(max_concurrency=1, queue_timeout=0.01)
+    running = await controller.acquire("a")
+
+    with pytest.raises(AdmissionRejected):
+        await controller.acquire("b")
+
+    running.release()
+    statistics = controller.get_statistics()
+    assert (statistics["timed_out"], statistics["queued"], statistics["active"]) == (1, 0, 0)
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_leaves_the_queue():
+    controller = AdmissionController(max_concurrency=1)
+    running = await controller.acquire("a")
+    waiter = asyncio.create_task(controller.acquire("b"))
+    await asyncio.sleep(0)
+
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    running.release()
+
+    assert controller.get_statistics()["queued"] == 0
+    assert controller.get_statistics()["active"] == 0
+
+
+class FakeUpstream:
+    def __init__(self):
+        self.closed = False
+
+    async def __aiter__(self):
+        for chunk in ["a", "b"]:
+            yield chunk
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_stream_holds_its_slot_until_read_or_closed():
+    controller = AdmissionController(max_concurrency=1)
+
+    stream = AdmittedStream(FakeUpstream(), await controller.acquire("a"))
+    assert controller.get_statistics()["active"] == 1
+    assert [chunk async for chunk in stream] == ["a", "b"]
+    assert controller.get_statistics()["active"] == 0
+
+    upstream = FakeUpstream()
+    stream = AdmittedStream(upstream, await controller.acquire("a"))
+    await stream.close()
+    assert upstream.closed
+    assert controller.get_statistics()["active"] == 0
@@ -0,0 +1,79 @@
+import json
+import os
+from importlib import import_module, reload
+
+import httpx
+import pytest
+
+from backend.history import cosmosdbservice
+from test_cosmosdbservice import FakeCosmosClient
+
+USER_ID = "00000000-0000-0000-0000-000000000000"
+APP_ENV = {
+    "AZURE_OPENAI_MODEL": "gpt-35-turbo-16k",
+    "AZURE_OPENAI_KEY": "key",
+    "AZURE_OPENAI_ENDPOINT": "https://example.openai.azure.com/",
+    "AZURE_OPENAI_SYSTEM_MESSAGE": "You are an AI assistant that helps people find information.",
+    "AZURE_OPENAI_STREAM": "false",
+    "AZURE_OPENAI_MAX_CONCURRENT_REQUESTS": "1",
+    "AZURE_OPENAI_MAX_QUEUED_REQUESTS": "0",
+    "AZURE_COSMOSDB_ACCOUNT": "account",
+    "AZURE_COSMOSDB_ACCOUNT_KEY": "key",
+    "AZURE_COSMOSDB_DATABASE": "db",
+    "AZURE_COSMOSDB_CONVERSATIONS_CONTAINER": "conversations",
+}
+
+
+@pytest.fixture
+def model_requests():
+    return []
+
+
+@pytest.fixture
+def quart_app(monkeypatch, model_requests):
+    for key, value in APP_ENV.items():
+        monkeypatch.setenv(key, value)
+    monkeypatch.setenv("DOTENV_PATH", os.devnull)
+    settings = reload(import_module("backend.settings")).app_settings
+    app = import_module("app")
+    monkeypatch.setattr(app, "app_settings", settings)
+
+    def handle_model_request(request):
+        model_requests.append(json.loads(request.content))
+        return httpx.Response(200, json={
+            "id": "completion", "object": "chat.completion", "created": 0, "model": "gpt-35-turbo-16k",
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": '{"title": "Hello"}'}}],
+        })
+
+    FakeCosmosClient.instances = []
+    FakeCosmosClient.failures = []
+    monkeypatch.setattr(cosmosdbservice, "CosmosClient", FakeCosmosClient)
+    monkeypatch.setattr(
+        app, "create_pooled_http_client", lambda **kwargs: httpx.AsyncClient(transport=httpx.MockTransport(handle_model_request))
+    )
+    return app.create_app()
+
+
+@pytest.mark.asyncio
+async def test_shed_history_request_writes_nothing(quart_app, model_requests):
+    request_json = {"messages": [{"id": "question", "role": "user", "content": "hello"}]}
+
+    async with quart_app.test_app():
+        client = quart_app.test_client()
+        ## the only slot is taken and no request may wait, so the next one is shed
+        lease = await quart_app.admission.acquire(USER_ID)
+        response = await client.post("/history/generate", json=request_json)
+        assert response.status_code == 503
+        assert response.headers["Retry-After"]
+        lease.release()
+
+        response = await client.post("/history/generate", json=request_json)
+        assert response.status_code == 200
+        admitted = await response.get_json()
+
+    items = FakeCosmosClient.instances[0].container.items.values()
+    assert [item["conversationId"] for item in items if item["type"] == "message"] == [admitted["history_metadata"]["conversation_id"]]
+    assert len([item for item in items if item["type"] == "conversation"]) == 1
+    ## the admitted request's completion and title; none for the shed one
+    assert len(model_requests) == 2
+    assert quart_app.admission.get_statistics()["active"] == 0
@@ -0,0 +1,106 @@
+import json
+import pytest
+from types import SimpleNamespace
+
+from backend.completion_cache import (
+    CompletionCache,
+    InMemoryCompletionCacheBackend,
+    entry_from_completion,
+    format_cached_response,
+    format_cached_stream_as_ndjson,
+    make_cache_key,
+)
+
+
+def _model_args(question, filter=None, **overrides):
+    model_args = {
+        "messages": [{"role": "user", "content": [{"type": "text", "text": question}]}],
+        "temperature": 0,
+        "max_tokens": 1000,
+        "stream": True,
+        "model": "gpt-35-turbo",
+        "user": None,
+        "extra_body": {"data_sources": [{"type": "azure_search", "parameters": {"filter": filter}}]},
+    }
+    model_args.update(overrides)
+    return model_args
+
+
+def _chunk(content=None, context=None):
+    delta = SimpleNamespace(role=None, content=content)
+    if context is not None:
+        delta.context = context
+    return SimpleNamespace(
+        id="chatcmpl-1", model="gpt-35-turbo", created=1, object="chat.completion.chunk",
+        choices=[SimpleNamespace(delta=delta)],
+    )
+
+
+async def _stream(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def test_cache_key_normalizes_messages():
+    key = make_cache_key(_model_args("What is the PTO policy?"))
+
+    assert key == make_cache_key(_model_args("  What is the   PTO policy? "))
+    assert key == make_cache_key(_model_args("What is the PTO policy?", stream=False, user="{}"))
+    assert key != make_cache_key(_model_args("What is the PTO policy?", temperature=1))
+    assert key != make_cache_key(_model_args("What is the PTO policy?", filter="group_ids/any(g:search.in(g, 'a'))"))
+
+
+@pytest.mark.asyncio
+async def test_stream_is_recorded_and_replayed():
+    cache = CompletionCache(InMemoryCompletionCacheBackend(max_size=10, ttl=60))
+    key = make_cache_key(_model_args("What is the PTO policy?"))
+    assert await cache.get(key) is None
+
+    upstream = _stream([
+        _chunk(context={"citations": [{"title": "PTO"}]}),
+        _chunk("You get "),
+        _chunk("20 days."),
+    ])
+    assert len([chunk async for chunk in cache.record_stream(key, upstream)]) == 3
+
+    entry = await cache.get(key)
+    assert entry["messages"] == [
+        {"role": "tool", "content": json.dumps({"citations": [{"title": "PTO"}]})},
+        {"role": "assistant", "content": "You get 20 days."},
+    ]
+
+    history_metadata = {"conversation_id": "abc"}
+    lines = [json.loads(line) async for line in format_cached_stream_as_ndjson(entry, history_metadata)]
+    assert [line["choices"][0]["messages"][0] for line in lines] == entry["messages"]
+    assert all(line["history_metadata"] == history_metadata for line in lines)
+
+    response = format_cached_response(entry, history_metadata)
+    assert response["choices"][0]["messages"] == entry["messages"]
+    assert response["id"] != lines[0]["id"]
+
+    assert cache.get_statistics()["hits"] == 1
+    assert cache.get_statistics()["misses"] == 1
+
+
+@pytest.mark.asyncio
+async def test_abandoned_stream_is_not_recorded():
+    cache = CompletionCache(InMemoryCompletionCacheBackend())
+    stream = cache.record_stream("key", _stream([_chunk("partial"), _chunk(" answer")])).__aiter__()
+
+    await stream.__anext__()
+    await stream.aclose()
+
+    assert await cache.get("key") is None
+
+
+def test_entry_from_completion():
+    message = SimpleNamespace(role="assistant", content="Answer", context={"citations": []})
+    completion = SimpleNamespace(model="gpt-35-turbo", choices=[SimpleNamespace(message=message)])
+
+    assert entry_from_completion(completion) == {
+        "model": "gpt-35-turbo",
+        "messages": [
+            {"role": "tool", "content": json.dumps({"citations": []})},
+            {"role": "assistant", "content": "Answer"},
+        ],
+    }
@@ -0,0 +1,59 @@
+from backend.context_window import MESSAGE_OVERHEAD_TOKENS, ContextWindow
+
+
+def make_messages(count, words=10):
+    return [
+        {"id": str(i), "role": "user" if i % 2 == 0 else "assistant", "content": " ".join(["word"] * words) + f" {i}"}
+        for i in range(count)
+    ]
+
+
+def counting_window(token_budget):
+    context_window = ContextWindow(model="gpt-35-turbo", token_budget=token_budget)
+    context_window.counted = []
+
+    def count_text(text):
+        context_window.counted.append(text)
+        return len(text.split())
+
+    context_window._count_text = count_text
+    return context_window
+
+
+def test_history_within_budget_is_unchanged():
+    context_window = counting_window(1000)
+    messages = make_messages(5)
+
+    assert context_window.fit(messages) is messages
+    assert context_window.get_statistics()["trimmed_requests"] == 0
+
+
+def test_oldest_turns_are_dropped():
+    context_window = counting_window(100)
+    messages = make_messages(20)
+    pinned = [{"role": "system", "content": "You are an assistant."}]
+    per_message = 11 + MESSAGE_OVERHEAD_TOKENS
+
+    window = context_window.fit(messages, pinned=pinned)
+
+    assert window == messages[-((100 - 4 - MESSAGE_OVERHEAD_TOKENS) // per_message):]
+    assert context_window.get_statistics()["dropped_messages"] == 20 - len(window)
+
+
+def test_newest_message_is_always_kept():
+    context_window = counting_window(10)
+    messages = make_messages(3, words=100)
+
+    assert context_window.fit(messages) == messages[-1:]
+
+
+def test_token_counts_are_reused():
+    context_window = counting_window(1000)
+    messages = make_messages(5)
+    stored = {"role": "assistant", "content": "not counted", "tokenCount": 7}
+
+    context_window.fit(messages + [stored])
+    context_window.fit(messages + [stored])
+
+    assert len(context_window.counted) == 5
+    assert context_window.count_tokens(stored) == 7
@@ -0,0 +1,672 @@
+import re
+import pytest
+from azure.cosmos import exceptions
+from azure.core.exceptions import ServiceRequestError, ServiceResponseError
+from backend.history import cosmosdbservice
+from backend.history.cosmosdbservice import CosmosConversationClient
+
+
+class FakeQueryResults:
+    def __init__(self, container, results, max_item_count):
+        self.container = container
+        self.results = results
+        self.max_item_count = max_item_count or 100
+
+    async def __aiter__(self):
+        for result in self.results:
+            self.container.items_read += 1
+            yield result
+
+    def by_page(self, continuation_token=None):
+        return FakePageIterator(self, continuation_token)
+
+
+class FakePageIterator:
+    def __init__(self, results, continuation_token):
+        self.results = results
+        self.continuation_token = continuation_token
+        self.position = int(continuation_token) if continuation_token else 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.position >= len(self.results.results):
+            raise StopAsyncIteration
+        page = self.results.results[self.position:self.position + self.results.max_item_count]
+        self.results.container.items_read += len(page)
+        self.position += len(page)
+        self.continuation_token = str(self.position) if self.position < len(self.results.results) else None
+        return self._iterate(page)
+
+    async def _iterate(self, page):
+        for item in page:
+            yield item
+
+
+class FakeContainerClient:
+    def __init__(self, failures):
+        self.failures = failures
+        self.items = {}
+        self.batches = []
+        self.reads = 0
+        self.throttles = 0
+        self.partition_delete_enabled = True
+        self.items_read = 0
+        self.etags = 0
+
+    async def read(self):
+        return {"id": "conversations"}
+
+    async def upsert_item(self, item):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.items[item["id"]] = item
+        return item
+
+    async def execute_item_batch(self, batch_operations, partition_key):
+        if self.throttles:
+            self.throttles -= 1
+            raise exceptions.CosmosHttpResponseError(status_code=429, message="Too Many Requests")
+        self.batches.append(batch_operations)
+        staged = {id: dict(item) for id, item in self.items.items()}
+        results = []
+        for index, (operation, args, *options) in enumerate(batch_operations):
+            if operation == "read":
+                if args[0] not in staged:
+                    raise exceptions.CosmosBatchOperationError(
+                        error_index=index, headers={}, status_code=404, message="Not found", operation_responses=[]
+                    )
+                results.append({"statusCode": 200, "resourceBody": dict(staged[args[0]])})
+            elif operation == "upsert":
+                staged[args[0]["id"]] = dict(args[0])
+                results.append({"statusCode": 200, "resourceBody": staged[args[0]["id"]]})
+            elif operation == "patch":
+                item_id, patch_operations = args
+                if item_id not in staged:
+                    raise exceptions.CosmosBatchOperationError(
+                        error_index=index, headers={}, status_code=404, message="Not found", operation_responses=[]
+                    )
+                condition = options[0].get("filter_predicate") if options else None
+                if condition == "FROM c WHERE c.type = 'conversation'" and staged[item_id].get("type") != "conversation":
+                    raise exceptions.CosmosBatchOperationError(
+                        error_index=index, headers={}, status_code=412, message="Precondition failed", operation_responses=[]
+                    )
+                for patch in patch_operations:
+                    staged[item_id][patch["path"].lstrip("/")] = patch["value"]
+                results.append({"statusCode": 200, "resourceBody": staged[item_id]})
+            elif operation == "delete":
+                if args[0] not in staged:
+                    raise exceptions.CosmosBatchOperationError(
+                        error_index=index, headers={}, status_code=404, message="Not found", operation_responses=[]
+                    )
+                del staged[args[0]]
+                results.append({"statusCode": 204})
+        self.items = staged
+        return results
+
+    def query_items(self, query, parameters, partition_key=None, max_item_count=None):
+        values = {parameter["name"]: parameter["value"] for parameter in parameters}
+        items = [item for item in self.items.values() if item["userId"] == partition_key]
+        if "@conversationId" in values:
+            items = [item for item in items if item["type"] == "message" and item["conversationId"] == values["@conversationId"]]
+        if "COUNT(1)" in query:
+            return FakeQueryResults(self, [len(items)], max_item_count)
+        if "c.role != 'tool'" in query:
+            items = [item for item in items if item["role"] != "tool"]
+        if "ORDER BY c.createdAt" in query:
+            items = sorted(items, key=lambda item: item["createdAt"], reverse=query.endswith("DESC"))
+        if "ORDER BY c.updatedAt" in query:
+            items = sorted(
+                (item for item in items if item["type"] == "conversation"), key=lambda item: item["updatedAt"], reverse=True
+            )
+        if query.startswith("SELECT *"):
+            return FakeQueryResults(self, items, max_item_count)
+        fields = re.findall(r"c\.(\w+)", query[:query.index(" FROM ")])
+        return FakeQueryResults(
+            self, [{field: item[field] for field in fields if field in item} for item in items], max_item_count
+        )
+
+    async def delete_all_items_by_partition_key(self, partition_key):
+        if not self.partition_delete_enabled:
+            raise exceptions.CosmosHttpResponseError(status_code=400, message="Partition key delete feature is disabled")
+        self.items = {id: item for id, item in self.items.items() if item["userId"] != partition_key}
+
+    async def create_item(self, body):
+        if body["id"] in self.items:
+            raise exceptions.CosmosResourceExistsError(message="Conflict")
+        self.etags += 1
+        self.items[body["id"]] = dict(body, _etag=str(self.etags))
+        return dict(self.items[body["id"]])
+
+    async def replace_item(self, item, body, etag=None, match_condition=None):
+        if self.items[item]["_etag"] != etag:
+            raise exceptions.CosmosAccessConditionFailedError(message="Precondition failed")
+        self.etags += 1
+        self.items[item] = dict(body, _etag=str(self.etags))
+        return dict(self.items[item])
+
+    async def read_item(self, item, partition_key):
+        self.reads += 1
+        if item not in self.items or self.items[item]["userId"] != partition_key:
+            raise exceptions.CosmosResourceNotFoundError(message="Not found")
+        return dict(self.items[item])
+
+    async def delete_item(self, item, partition_key):
+        if item not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(message="Not found")
+        del self.items[item]
+
+    async def patch_item(self, item, partition_key, patch_operations):
+        if item not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(message="Not found")
+        document = self.items[item]
+        assert document["userId"] == partition_key
+        for operation in patch_operations:
+            assert operation["op"] == "set"
+            document[operation["path"].lstrip("/")] = operation["value"]
+        return document
+
+
+class FakeCosmosClient:
+    instances = []
+
+    def __init__(self, endpoint, credential):
+        self.closed = False
+        self.container = FakeContainerClient(FakeCosmosClient.failures)
+        FakeCosmosClient.instances.append(self)
+
+    def get_database_client(self, name):
+        return self
+
+    def get_container_client(self, name):
+        return self.container
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def cosmos_client(monkeypatch):
+    FakeCosmosClient.instances = []
+    FakeCosmosClient.failures = []
+    monkeypatch.setattr(cosmosdbservice, "CosmosClient", FakeCosmosClient)
+    return CosmosConversationClient(
+        cosmosdb_endpoint="https://account.documents.azure.com:443/",
+        credential="key",
+        database_name="db",
+        container_name="conversations"
+    )
+
+
+@pytest.mark.asyncio
+async def test_warm_up(cosmos_client):
+    assert await cosmos_client.warm_up()
+
+
+@pytest.mark.asyncio
+async def test_reconnect_and_retry_on_request_error(cosmos_client):
+    cosmos_client.container_client.failures.append(ServiceRequestError("connection reset"))
+    conversation = await cosmos_client.create_conversation("user", title="title")
+
+    assert conversation["title"] == "title"
+    assert len(FakeCosmosClient.instances) == 2
+    assert FakeCosmosClient.instances[0].closed
+    assert cosmos_client.container_client is FakeCosmosClient.instances[1].container
+
+
+@pytest.mark.asyncio
+async def test_reconnect_without_retry_on_response_error(cosmos_client):
+    cosmos_client.container_client.failures.append(ServiceResponseError("read timeout"))
+    with pytest.raises(ServiceResponseError):
+        await cosmos_client.create_conversation("user", title="title")
+
+    assert len(FakeCosmosClient.instances) == 2
+    assert FakeCosmosClient.instances[1].container.items == {}
+
+
+@pytest.mark.asyncio
+async def test_update_conversation_title(cosmos_client):
+    conversation = await cosmos_client.create_conversation("user", title="What is the PTO...")
+    conversation["updatedAt"] = "later"
+
+    updated = await cosmos_client.update_conversation_title("user", conversation["id"], "PTO Policy")
+
+    assert updated["title"] == "PTO Policy"
+    assert updated["updatedAt"] == "later"
+
+
+@pytest.mark.asyncio
+async def test_create_message_is_one_batch(cosmos_client):
+    conversation = await cosmos_client.create_conversation("user", title="title")
+    container = cosmos_client.container_client
+
+    message = await cosmos_client.create_message(
+        "message-1", conversation["id"], "user", {"role": "user", "content": "hello"}
+    )
+
+    assert message["conversationId"] == conversation["id"]
+    assert len(container.batches) == 1
+    assert container.items[conversation["id"]]["updatedAt"] == message["createdAt"]
+
+
+@pytest.mark.asyncio
+async def test_create_messages_rolls_back_without_conversation(cosmos_client):
+    result = await cosmos_client.create_messages(
+        "missing", "user", [("tool-1", {"role": "tool", "content": "{}"}), ("assistant-1", {"role": "assistant", "content": "hi"})]
+    )
+
+    assert result == "Conversation not found"
+    assert cosmos_client.container_client.items == {}
+
+
+@pytest.mark.asyncio
+async def test_create_messages_only_targets_conversations(cosmos_client):
+    conversation = await cosmos_client.create_conversation("user", title="title")
+    await cosmos_client.create_message("m1", conversation["id"], "user", {"role": "user", "content": "hello"})
+    await cosmos_client.get_conversations_page("user", limit=25)
+    await cosmos_client.flush_index_updates()
+    container = cosmos_client.container_client
+    items = {id: dict(item) for id, item in container.items.items()}
+
+    for target in ["m1", cosmosdbservice.CONVERSATION_INDEX_ID]:
+        result = await cosmos_client.create_message("m2", target, "user", {"role": "user", "content": "hi"})
+        assert result == "Conversation not found"
+    await cosmos_client.flush_index_updates()
+
+    assert container.items == items
+    index = await cosmos_client.get_conversation_index("user")
+    assert [entry["id"] for entry in index["conversations"]] == [conversation["id"]]
+
+
+@pytest.mark.asyncio
+async def test_get_conversation_is_cached_point_read(cosmos_client):
+    conversation = await cosmos_client.create_conversation("user", title="title")
+    container = cosmos_client.container_client
+    container.reads = 0
+
+    first = await cosmos_client.get_conversation("user", conversation["id"])
+    first["title"] = "changed by the caller"
+    second = await cosmos_client.get_conversation("user", conversation["id"])
+
+    assert second["title"] == "title"
+    assert container.reads == 1
+    assert await cosmos_client.get_conversation("other-user", conversation["id"]) is None
+    assert await cosmos_client.get_conversation("user", "missing") is None
+
+
+@pytest.mark.asyncio
+async def test_get_conversation_ignores_messages(cosmos_client):
+    conversation = await cosmos_client.create_conversation("user", title="title")
+    await cosmos_client.create_message("message-1", conversation["id"], "user", {"role": "user", "content": "hello"})
+
+    assert await cosmos_client.get_conversation("user", "message-1") is None
+
+
+@pytest.mark.asyncio
+async def test_writes_invalidate_cached_conversation(cosmos_client):
+    conversation = await cosmos_client.create_conversation("user", title="title")
+    await cosmos_client.get_conversation("user", conversation["id"])
+
+    await cosmos_client.update_conversation_title("user", conversation["id"], "renamed")
+    assert (await cosmos_client.get_conversation("user", conversation["id"]))["title"] == "renamed"
+
+    message = await cosmos_client.create_message(
+        "message-1", conversation["id"], "user", {"role": "user", "content": "hello"}
+    )
+    assert (await cosmos_client.get_conversation("user", conversation["id"]))["updatedAt"] == message["createdAt"]
+
+    await cosmos_client.delete_conversation("user", conversation["id"])
+    assert await cosmos_client.get_conversation("user", conversation["id"]) is None
+
+
+@pytest.mark.asyncio
+async def test_update_message_feedback_missing_message(cosmos_client):
+    assert await cosmos_client.update_message_feedback("user", "missing", "positive") is False
+
+
+async def create_conversation_with_messages(cosmos_client, count):
+    conversation = await cosmos_client.create_conversation("user", title="title")
+    await cosmos_client.create_messages(
+        conversation["id"], "user", [(f"message-{i}", {"role": "user", "content": "hello"}) for i in range(count)]
+    )
+    return conversation
+
+
+@pytest.mark.asyncio
+async def test_delete_messages_in_batches(cosmos_client):
+    conversation = await create_conversation_with_messages(cosmos_client, 250)
+    container = cosmos_client.container_client
+    container.batches = []
+
+    summary = await cosmos_client.delete_messages(conversation["id"], "user")
+
+    assert summary == {"deleted": 250, "batches": 3, "throttled_retries": 0}
+    assert sorted(len(batch) for batch in container.batches) == [50, 100, 100]
+    assert list(container.items) == [conversation["id"]]
+
+
+@pytest.mark.asyncio
+async def test_delete_messages_retries_when_throttled(cosmos_client, monkeypatch):
+    monkeypatch.setattr(cosmosdbservice, "THROTTLE_BACKOFF", 0)
+    conversation = await create_conversation_with_messages(cosmos_client, 10)
+    cosmos_client.container_client.throttles = 2
+
+    summary = await cosmos_client.delete_messages(conversation["id"], "user")
+
+    assert summary == {"deleted": 10, "batches": 1, "throttled_retries": 2}
+
+
+@pytest.mark.asyncio
+async def test_delete_items_skips_already_deleted(cosmos_client):
+    await create_conversation_with_messages(cosmos_client, 3)
+
+    summary = await cosmos_client.delete_items("user", ["message-0", "missing", "message-2"])
+
+    assert summary["deleted"] == 2
+    assert "message-1" in cosmos_client.container_client.items
+
+
+@pytest.mark.asyncio
+async def test_delete_partition(cosmos_client):
+    conversation = await create_conversation_with_messages(cosmos_client, 5)
+    other = await cosmos_client.create_conversation("other-user", title="title")
+    await cosmos_client.get_conversation("user", conversation["id"])
+    await cosmos_client.get_conversations_page("user", limit=25)
+    await cosmos_client.update_conversation_title("user", conversation["id"], "renamed")
+    cosmos_client.page_cursors.set(("user", "DESC", 1), "token")
+
+    assert await cosmos_client.delete_partition("user") == {"method": "partition_key"}
+    await cosmos_client.flush_index_updates()
+    assert await cosmos_client.count_items("user") == 0
+    assert not [key for key in cosmos_client.page_cursors.keys() if key[0] == "user"]
+    assert cosmosdbservice.CONVERSATION_INDEX_ID not in cosmos_client.container_client.items
+    assert await cosmos_client.get_conversation("user", conversation["id"]) is None
+    assert await cosmos_client.get_conversation("other-user", other["id"])
+
+
+@pytest.mark.asyncio
+async def test_delete_partition_falls_back_to_query(cosmos_client, monkeypatch):
+    monkeypatch.setattr(cosmosdbservice, "PURGE_CHUNK_SIZE", 200)
+    await create_conversation_with_messages(cosmos_client, 299)
+    cosmos_client.container_client.partition_delete_enabled = False
+
+    summary = await cosmos_client.delete_partition("user")
+
+    assert summary["method"] == "query"
+    assert summary["deleted"] == 300
+    assert await cosmos_client.count_items("user") == 0
+    assert not cosmos_client.partition_delete_supported
+
+
+async def create_conversations(cosmos_client, count):
+    for i in range(count):
+        await cosmos_client.create_conversation("user", title=f"title {i}", created_at=f"2024-01-01T{i:06d}")
+
+
+@pytest.mark.asyncio
+async def test_get_conversations_page_by_cursor(cosmos_client):
+    await create_conversations(cosmos_client, 3000)
+    container = cosmos_client.container_client
+    container.items_read = 0
+
+    conversations, cursor = [], None
+    while True:
+        page, cursor = await cosmos_client.get_conversations_page("user", limit=25, cursor=cursor)
+        assert len(page) == 25 or cursor is None
+        conversations.extend(page)
+        if cursor is None:
+            break
+
+    assert [conversation["title"] for conversation in conversations] == [f"title {i}" for i in reversed(range(3000))]
+    assert set(conversations[0]) == {"id", "title", "createdAt", "updatedAt"}
+    ## building the index queries its window a second time to pick up concurrent writes
+    assert container.items_read == 3000 + cosmosdbservice.CONVERSATION_INDEX_SIZE
+
+
+@pytest.mark.asyncio
+async def test_get_conversations_page_by_offset(cosmos_client):
+    await create_conversations(cosmos_client, 2000)
+    container = cosmos_client.container_client
+    await cosmos_client.get_conversations_page("user", limit=25)
+
+    ## a fresh worker pages past the skipped rows once
+    container.items_read = 0
+    page, _ = await cosmos_client.get_conversations_page("user", limit=25, offset=1000)
+    assert page[0]["title"] == "title 999"
+    assert container.items_read == 1025
+
+    ## later offsets continue from the remembered continuation token
+    container.items_read = 0
+    for offset in range(1025, 2000, 25):
+        page, cursor = await cosmos_client.get_conversations_page("user", limit=25, offset=offset)
+        assert page[0]["title"] == f"title {1999 - offset}"
+    assert container.items_read == 975
+    assert cursor is None
+
+
+@pytest.mark.asyncio
+async def test_get_conversations_page_invalid_cursor(cosmos_client):
+    with pytest.raises(ValueError):
+        await cosmos_client.get_conversations_page("user", limit=25, cursor="not a cursor!")
+
+
+@pytest.mark.asyncio
+async def test_get_messages_page_newest_first(cosmos_client):
+    conversation = await create_conversation_with_messages(cosmos_client, 250)
+    container = cosmos_client.container_client
+    container.items_read = 0
+
+    pages, cursor = [], None
+    while True:
+        page, cursor = await cosmos_client.get_messages_page("user", conversation["id"], limit=100, cursor=cursor)
+        pages.append([message["id"] for message in page])
+        if cursor is None:
+            break
+
+    assert pages == [
+        [f"message-{i}" for i in range(150, 250)],
+        [f"message-{i}" for i in range(50, 150)],
+        [f"message-{i}" for i in range(50)],
+    ]
+    assert container.items_read == 250
+    assert set(page[0]) == {"id", "role", "content", "createdAt"}
+
+
+@pytest.mark.asyncio
+async def test_get_messages_in_creation_order(cosmos_client):
+    conversation = await create_conversation_with_messages(cosmos_client, 20)
+
+    await cosmos_client.create_message(
+        "image-1", conversation["id"], "user", {"role": "user", "content": "data:image/png;base64,AAAA", "type": "img"}
+    )
+
+    messages = await cosmos_client.get_messages("user", conversation["id"])
+
+    assert [message["id"] for message in messages] == [f"message-{i}" for i in range(20)] + ["image-1"]
+    assert set(messages[0]) <= set(cosmosdbservice.MESSAGE_READ_FIELDS)
+    assert messages[-1]["type"] == "img"
+
+
+@pytest.mark.asyncio
+async def test_first_list_page_is_a_point_read(cosmos_client):
+    await create_conversations(cosmos_client, 30)
+    container = cosmos_client.container_client
+    await cosmos_client.get_conversations_page("user", limit=25)
+    container.items_read = 0
+    container.reads = 0
+
+    page, cursor = await cosmos_client.get_conversations_page("user", limit=25)
+    assert [conversation["title"] for conversation in page] == [f"title {i}" for i in reversed(range(5, 30))]
+    page, cursor = await cosmos_client.get_conversations_page("user", limit=25, cursor=cursor)
+    assert [conversation["title"] for conversation in page] == [f"title {i}" for i in reversed(range(5))]
+
+    assert cursor is None
+    assert container.items_read == 0
+    assert container.reads == 2
+
+
+@pytest.mark.asyncio
+async def test_conversation_index_follows_writes(cosmos_client):
+    await create_conversations(cosmos_client, 3)
+    await cosmos_client.get_conversations_page("user", limit=25)
+    conversations = {conversation["title"]: conversation["id"] for conversation in cosmos_client.container_client.items.values()
+                     if conversation["type"] == "conversation"}
+
+    new = await cosmos_client.create_conversation("user", title="new")
+    await cosmos_client.update_conversation_title("user", conversations["title 1"], "renamed")
+    await cosmos_client.create_message("message-1", conversations["title 0"], "user", {"role": "user", "content": "hello"})
+    await cosmos_client.delete_conversation("user", conversations["title 2"])
+    await cosmos_client.flush_index_updates()
+
+    index = await cosmos_client.get_conversation_index("user")
+    assert [entry["title"] for entry in index["conversations"]] == ["title 0", "new", "renamed"]
+    assert index["conversations"][1]["id"] == new["id"]
+
+
+@pytest.mark.asyncio
+async def test_writes_do_not_wait_for_the_conversation_index(cosmos_client):
+    await create_conversations(cosmos_client, 3)
+    await cosmos_client.get_conversations_page("user", limit=25)
+    container = cosmos_client.container_client
+    container.reads = 0
+
+    conversation = await cosmos_client.create_conversation("user", title="new")
+    await cosmos_client.create_message("message-1", conversation["id"], "user", {"role": "user", "content": "hello"})
+    assert container.reads == 0
+
+    ## both updates are applied with one read of the index
+    await cosmos_client.flush_index_updates()
+    assert container.reads == 1
+    index = await cosmos_client.get_conversation_index("user")
+    assert index["conversations"][0]["id"] == conversation["id"]
+
+
+@pytest.mark.asyncio
+async def test_conversation_index_build_picks_up_concurrent_writes(cosmos_client):
+    await create_conversations(cosmos_client, 3)
+    container = cosmos_client.container_client
+    create_item = container.create_item
+
+    async def create_after_concurrent_write(body):
+        ## created after the index query, before the index exists
+        container.create_item = create_item
+        await cosmos_client.create_conversation("user", title="concurrent")
+        await cosmos_client.flush_index_updates()
+        return await create_item(body)
+
+    container.create_item = create_after_concurrent_write
+    page, _ = await cosmos_client.get_conversations_page("user", limit=25)
+
+    assert page[0]["title"] == "concurrent"
+    index = await cosmos_client.get_conversation_index("user")
+    assert [entry["title"] for entry in index["conversations"]] == ["concurrent", "title 2", "title 1", "title 0"]
+
+
+@pytest.mark.asyncio
+async def test_conversation_writes_clear_page_cursors(cosmos_client):
+    await create_conversations(cosmos_client, 150)
+    page, _ = await cosmos_client.get_conversations_page("user", limit=25)
+    assert cosmos_client.page_cursors.get(("user", "DESC", cosmosdbservice.CONVERSATION_INDEX_SIZE))
+
+    await cosmos_client.create_conversation("user", title="new")
+    assert len(cosmos_client.page_cursors) == 0
+
+    await cosmos_client.flush_index_updates()
+    page, _ = await cosmos_client.get_conversations_page("user", limit=25, offset=100)
+    assert page[0]["title"] == "title 50"
+
+
+@pytest.mark.asyncio
+async def test_conversation_index_dropped_after_conflicts(cosmos_client):
+    await create_conversations(cosmos_client, 3)
+    await cosmos_client.get_conversations_page("user", limit=25)
+    container = cosmos_client.container_client
+
+    async def conflict(item, body, etag=None, match_condition=None):
+        raise exceptions.CosmosAccessConditionFailedError(message="Precondition failed")
+
+    container.replace_item = conflict
+    await cosmos_client.create_conversation("user", title="new")
+    await cosmos_client.flush_index_updates()
+
+    assert cosmosdbservice.CONVERSATION_INDEX_ID not in container.items
+    page, _ = await cosmos_client.get_conversations_page("user", limit=25)
+    assert page[0]["title"] == "new"
+
+
+@pytest.mark.asyncio
+async def test_get_chat_history(cosmos_client):
+    conversation = await cosmos_client.create_conversation("user", title="title")
+    await cosmos_client.create_messages(conversation["id"], "user", [("user-1", {"role": "user", "content": "hi"})])
+    await cosmos_client.create_messages(conversation["id"], "user", [
+        ("tool-1", {"role": "tool", "content": "{}"}), ("assistant-1", {"role": "assistant", "content": "hello"})
+    ])
+
+    history = await cosmos_client.get_chat_history("user", conversation["id"])
+
+    assert history == [
+        {"id": "user-1", "role": "user", "content": "hi"},
+        {"id": "assistant-1", "role": "assistant", "content": "hello"},
+    ]
+    assert await cosmos_client.get_chat_history("user", "missing") is None
+
+
+@pytest.mark.asyncio
+async def test_chat_history_keeps_images(cosmos_client):
+    conversation = await cosmos_client.create_conversation("user", title="title")
+    await cosmos_client.create_messages(conversation["id"], "user", [
+        ("image-1", {"role": "user", "content": "https://example.com/image.png", "type": "img"}),
+        ("question-1", {"role": "user", "content": "what is this?"}),
+    ])
+    ## written before the content type was stored
+    cosmos_client.container_client.items["image-2"] = dict(
+        cosmos_client.container_client.items["question-1"], id="image-2", content="data:image/png;base64,AAAA",
+        createdAt="9999-01-01"
+    )
+
+    history = await cosmos_client.get_chat_history("user", conversation["id"])
+
+    assert [message.get("type") for message in history] == ["img", None, "img"]
+    assert "contentType" not in history[0]
+
+
+@pytest.mark.asyncio
+async def test_chat_history_cache_follows_writes(cosmos_client):
+    conversation = await create_conversation_with_messages(cosmos_client, 3)
+    container = cosmos_client.container_client
+    await cosmos_client.get_chat_history("user", conversation["id"])
+
+    ## written through this client: the cached history is extended
+    await cosmos_client.create_message("message-3", conversation["id"], "user", {"role": "assistant", "content": "hello"})
+    container.items_read = 0
+    history = await cosmos_client.get_chat_history("user", conversation["id"])
+    assert [message["id"] for message in history] == [f"message-{i}" for i in range(4)]
+    assert container.items_read == 0
+
+    ## written by another worker: the cached history is read again
+    other_worker = CosmosConversationClient("https://account.documents.azure.com:443/", "key", "db", "conversations")
+    other_worker.container_client = container
+    await other_worker.create_message("message-4", conversation["id"], "user", {"role": "user", "content": "again"})
+    await cosmos_client.create_message("message-5", conversation["id"], "user", {"role": "assistant", "content": "hi"})
+    history = await cosmos_client.get_chat_history("user", conversation["id"])
+    assert [message["id"] for message in history] == [f"message-{i}" for i in range(6)]
+
+
+@pytest.mark.asyncio
+async def test_conversation_summary(cosmos_client):
+    conversation = await create_conversation_with_messages(cosmos_client, 4)
+    assert await cosmos_client.get_conversation_summary("user", conversation["id"]) is None
+
+    await cosmos_client.upsert_conversation_summary(
+        "user", conversation["id"], "The user said hello.", last_message_id="message-1", message_count=2, token_count=9
+    )
+    summary = await cosmos_client.get_conversation_summary("user", conversation["id"])
+    assert summary["content"] == "The user said hello."
+    assert (summary["lastMessageId"], summary["messageCount"], summary["tokenCount"]) == ("message-1", 2, 9)
+
+    ## the summary is not part of the history and goes with the messages
+    history = await cosmos_client.get_chat_history("user", conversation["id"])
+    assert [message["id"] for message in history] == [f"message-{i}" for i in range(4)]
+    await cosmos_client.delete_messages(conversation["id"], "user")
+    assert await cosmos_client.get_conversation_summary("user", conversation["id"]) is None
@@ -0,0 +1,70 @@
+import time
+import pytest
+from azure.core.credentials import AccessToken
+from azure.cosmos import _base as cosmos_base
+from backend.auth.credential_manager import CachedTokenCredential, cosmosdb_scope
+
+
+class FakeCredential:
+    def __init__(self, lifetime=3600, fail=False):
+        self.lifetime = lifetime
+        self.fail = fail
+        self.calls = 0
+        self.closed = False
+
+    async def get_token(self, *scopes, **kwargs):
+        self.calls += 1
+        if self.fail:
+            raise Exception("credential unavailable")
+        return AccessToken(f"token-{self.calls}", int(time.time()) + self.lifetime)
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_get_token_is_cached_per_scope():
+    fake = FakeCredential()
+    credential = CachedTokenCredential(fake)
+
+    first = await credential.get_token("scope-a")
+    second = await credential.get_token("scope-a")
+    other = await credential.get_token("scope-b")
+
+    assert first is second
+    assert other.token != first.token
+    assert fake.calls == 2
+    stats = credential.get_statistics()
+    assert stats["acquisitions"] == 2
+    assert stats["cache_hits"] == 1
+    await credential.close()
+    assert fake.closed
+
+
+@pytest.mark.asyncio
+async def test_background_refresh_replaces_expiring_tokens():
+    fake = FakeCredential(lifetime=120)
+    credential = CachedTokenCredential(fake, refresh_margin=300)
+
+    token = await credential.get_token("scope-a")
+    await credential._refresh_due_tokens()
+
+    assert (await credential.get_token("scope-a")).token != token.token
+    assert credential.get_statistics()["background_refreshes"] == 1
+
+
+@pytest.mark.asyncio
+async def test_failures_are_counted():
+    credential = CachedTokenCredential(FakeCredential(fail=True))
+
+    with pytest.raises(Exception):
+        await credential.get_token("scope-a")
+
+    await credential._refresh_due_tokens()
+    assert credential.get_statistics()["failures"] == 1
+
+
+def test_cosmosdb_scope_matches_the_sdk():
+    endpoint = "https://account.documents.azure.com:443/"
+    assert cosmosdb_scope(endpoint) == "https://account.documents.azure.com/.default"
+    assert cosmosdb_scope(endpoint) == cosmos_base.create_scope_from_url(endpoint)
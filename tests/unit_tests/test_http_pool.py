@@ -0,0 +1,23 @@
+import httpx
+import pytest
+from backend.http_pool import create_pooled_http_client, get_pool_statistics
+
+
+@pytest.mark.asyncio
+async def test_create_pooled_http_client():
+    client = create_pooled_http_client(
+        max_connections=10,
+        max_keepalive_connections=5,
+        keepalive_expiry=15.0
+    )
+    stats = get_pool_statistics(client)
+    assert stats["connections"] == 0
+    assert stats["queued_requests"] == 0
+    assert stats["max_connections"] == 10
+    assert stats["max_keepalive_connections"] == 5
+    await client.aclose()
+
+
+def test_get_pool_statistics_without_pool():
+    assert get_pool_statistics(None) == {}
+    assert get_pool_statistics(httpx.AsyncClient(transport=httpx.MockTransport(lambda r: None))) == {}
@@ -0,0 +1,80 @@
+import pytest
+from types import SimpleNamespace
+
+from backend.semantic_cache import SemanticCache, get_last_user_question
+
+EMBEDDINGS = {
+    "What is the PTO policy?": [1.0, 0.0, 0.0],
+    "what's our PTO policy": [0.98, 0.2, 0.0],
+    "How do I reset my password?": [0.0, 1.0, 0.0],
+}
+
+
+class FakeEmbeddings:
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, model, input):
+        self.calls += 1
+        return SimpleNamespace(data=[SimpleNamespace(embedding=EMBEDDINGS[input])])
+
+
+def _model_args(filter=None):
+    return {
+        "messages": [{"role": "user", "content": []}],
+        "temperature": 0,
+        "model": "gpt-35-turbo",
+        "extra_body": {"data_sources": [{"type": "azure_search", "parameters": {"filter": filter}}]},
+    }
+
+
+def _request(question):
+    return [{"id": "1", "role": "user", "content": question}]
+
+
+ENTRY = {"model": "gpt-35-turbo", "messages": [{"role": "assistant", "content": "20 days."}]}
+
+
+@pytest.fixture
+def semantic_cache():
+    client = SimpleNamespace(embeddings=FakeEmbeddings())
+    return SemanticCache(client, "text-embedding-ada-002", similarity_threshold=0.95)
+
+
+def test_get_last_user_question():
+    assert get_last_user_question(_request("  What is the  PTO policy? ")) == "What is the PTO policy?"
+    follow_up = [
+        {"role": "user", "content": "What is the PTO policy?"},
+        {"role": "assistant", "content": "20 days."},
+        {"role": "user", "content": "And for contractors?"},
+    ]
+    assert get_last_user_question(follow_up) is None
+    assert get_last_user_question(follow_up, first_turn_only=False) == "And for contractors?"
+
+
+@pytest.mark.asyncio
+async def test_paraphrase_hits_within_partition(semantic_cache):
+    entry, slot = await semantic_cache.lookup(_request("What is the PTO policy?"), _model_args())
+    assert entry is None
+    await semantic_cache.set(slot, ENTRY)
+
+    entry, slot = await semantic_cache.lookup(_request("what's our PTO policy"), _model_args())
+    assert entry == ENTRY
+    assert slot is None
+
+    entry, slot = await semantic_cache.lookup(_request("How do I reset my password?"), _model_args())
+    assert entry is None
+    assert slot is not None
+
+    stats = semantic_cache.get_statistics()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+
+
+@pytest.mark.asyncio
+async def test_security_filter_partitions_answers(semantic_cache):
+    _, slot = await semantic_cache.lookup(_request("What is the PTO policy?"), _model_args(filter="group_ids/any(g:g eq 'a')"))
+    await semantic_cache.set(slot, ENTRY)
+
+    entry, _ = await semantic_cache.lookup(_request("What is the PTO policy?"), _model_args(filter="group_ids/any(g:g eq 'b')"))
+    assert entry is None
@@ -0,0 +1,146 @@
+import asyncio
+import pytest
+from pydantic import BaseModel
+
+from backend.single_flight import SingleFlight
+
+
+class FakeUpstream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.released = asyncio.Event()
+        self.closed = False
+
+    async def __aiter__(self):
+        for index, chunk in enumerate(self.chunks):
+            if index == 2:
+                # Hold the stream open halfway through until the test releases it
+                await self.released.wait()
+            yield chunk
+
+    async def close(self):
+        self.closed = True
+
+
+async def _collect(subscriber):
+    return [chunk async for chunk in subscriber]
+
+
+@pytest.mark.asyncio
+async def test_identical_streams_share_one_upstream():
+    single_flight = SingleFlight()
+    upstream = FakeUpstream(["a", "b", "c", "d"])
+    opened = 0
+
+    async def open_stream():
+        nonlocal opened
+        opened += 1
+        return upstream, "apim-1"
+
+    first = await single_flight.stream("key", open_stream)
+    first_reader = asyncio.create_task(_collect(first))
+    await asyncio.sleep(0)
+
+    # Joins after "a" and "b" were emitted and gets them replayed
+    second = await single_flight.stream("key", open_stream)
+    assert second.apim_request_id == "apim-1"
+    second_reader = asyncio.create_task(_collect(second))
+
+    upstream.released.set()
+    assert await first_reader == ["a", "b", "c", "d"]
+    assert await second_reader == ["a", "b", "c", "d"]
+    assert opened == 1
+
+    stats = single_flight.get_statistics()
+    assert stats["upstream_calls"] == 1
+    assert stats["followers"] == 1
+    assert stats["late_joiners"] == 1
+    assert stats["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_upstream_is_cancelled_when_last_subscriber_leaves():
+    single_flight = SingleFlight()
+    upstream = FakeUpstream(["a", "b", "c"])
+
+    async def open_stream():
+        return upstream, None
+
+    first = await single_flight.stream("key", open_stream)
+    second = await single_flight.stream("key", open_stream)
+    await asyncio.sleep(0)
+
+    await first.close()
+    assert not upstream.closed
+
+    await second.close()
+    await asyncio.sleep(0.01)
+    assert upstream.closed
+    assert single_flight.get_statistics()["upstream_cancellations"] == 1
+
+
+@pytest.mark.asyncio
+async def test_open_error_reaches_every_subscriber():
+    single_flight = SingleFlight()
+
+    async def open_stream():
+        await asyncio.sleep(0)
+        raise ValueError("throttled")
+
+    results = await asyncio.gather(
+        single_flight.stream("key", open_stream),
+        single_flight.stream("key", open_stream),
+        return_exceptions=True,
+    )
+    assert [str(result) for result in results] == ["throttled", "throttled"]
+
+
+@pytest.mark.asyncio
+async def test_identical_calls_share_one_result():
+    single_flight = SingleFlight()
+    calls = 0
+
+    async def complete():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return "answer", "apim-1"
+
+    results = await asyncio.gather(*[single_flight.call("key", complete) for _ in range(5)])
+    assert results == [("answer", "apim-1")] * 5
+    assert calls == 1
+
+
+class FakeChunk(BaseModel):
+    id: str
+    content: str
+
+
+@pytest.mark.asyncio
+async def test_followers_get_their_own_response_id():
+    single_flight = SingleFlight()
+
+    async def complete():
+        await asyncio.sleep(0.01)
+        return FakeChunk(id="cmpl-1", content="answer"), "apim-1"
+
+    results = await asyncio.gather(*[single_flight.call("key", complete) for _ in range(3)])
+    assert [response.content for response, _ in results] == ["answer"] * 3
+    assert results[0][0].id == "cmpl-1"
+    assert len({response.id for response, _ in results}) == 3
+
+    upstream = FakeUpstream([FakeChunk(id="cmpl-2", content=str(i)) for i in range(4)])
+
+    async def open_stream():
+        return upstream, "apim-2"
+
+    first = await single_flight.stream("stream", open_stream)
+    second = await single_flight.stream("stream", open_stream)
+    readers = [asyncio.create_task(_collect(first)), asyncio.create_task(_collect(second))]
+    upstream.released.set()
+    first_chunks, second_chunks = await asyncio.gather(*readers)
+
+    assert {chunk.id for chunk in first_chunks} == {"cmpl-2"}
+    assert len({chunk.id for chunk in second_chunks}) == 1
+    assert second_chunks[0].id != "cmpl-2"
+    assert [chunk.content for chunk in second_chunks] == ["0", "1", "2", "3"]
@@ -1,5 +1,22 @@
+import json
+import logging
+import asyncio
+import httpx
 import pytest
-from backend.utils import format_as_ndjson, parse_multi_columns
+from types import SimpleNamespace
+from backend.utils import (
+    StreamCancellationTracker,
+    StreamCoalescer,
+    StreamResponseEncoder,
+    fetchUserGroups,
+    format_as_ndjson,
+    format_stream_as_ndjson,
+    format_stream_response,
+    generateFilterString,
+    log_request_body,
+    parse_multi_columns,
+    redact_secrets,
+)
 
 
 @pytest.mark.asyncio
@@ -27,3 +44,201 @@ def test_parse_multi_columns():
     assert parse_multi_columns(test_pipes) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_commas) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_single) == ["col1"]
+
+
+def test_redact_secrets():
+    authentication = {"type": "api_key", "key": "secret"}
+    fields_mapping = {"content_fields": ["content"]}
+    messages = [
+        {"role": "user", "content": [{"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}}]},
+        {"role": "assistant", "content": "hello"},
+    ]
+    model_args = {
+        "messages": messages,
+        "extra_body": {
+            "data_sources": [{
+                "type": "azure_search",
+                "parameters": {"authentication": authentication, "fields_mapping": fields_mapping}
+            }]
+        }
+    }
+
+    redacted = redact_secrets(model_args)
+    parameters = redacted["extra_body"]["data_sources"][0]["parameters"]
+    assert parameters["authentication"] == {"type": "api_key", "key": "*****"}
+    assert redacted["messages"][0]["content"][0]["image_url"]["url"] == "data:image/png;base64,<4 bytes>"
+
+    # The input is left untouched and unchanged branches are shared, not copied
+    assert authentication["key"] == "secret"
+    assert parameters["fields_mapping"] is fields_mapping
+    assert redacted["messages"][1] is messages[1]
+    assert redact_secrets(fields_mapping) is fields_mapping
+
+
+@pytest.mark.asyncio
+async def test_generate_filter_string_paginates_and_caches():
+    requests_seen = []
+
+    def graph_handler(request):
+        requests_seen.append(str(request.url))
+        if "page2" in str(request.url):
+            return httpx.Response(200, json={"value": [{"id": "group-b"}]})
+        return httpx.Response(200, json={
+            "value": [{"id": "group-a"}],
+            "@odata.nextLink": "https://graph.microsoft.com/v1.0/page2"
+        })
+
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(graph_handler))
+    token = "header.eyJ0aWQiOiJ0ZW5hbnQiLCJvaWQiOiJ1c2VyIn0.signature"
+
+    groups = await fetchUserGroups(token, http_client)
+    assert groups == [{"id": "group-a"}, {"id": "group-b"}]
+
+    first = await generateFilterString(token, http_client)
+    second = await generateFilterString(token, http_client)
+    assert "search.in(g, 'group-a, group-b')" in first
+    assert second is first
+    # one paginated fetch above, one for the first filter string, none for the cached one
+    assert len(requests_seen) == 4
+    await http_client.aclose()
+
+
+def _chunk(delta, chunk_id="chatcmpl-1"):
+    return SimpleNamespace(
+        id=chunk_id,
+        model="gpt-4",
+        created=1700000000,
+        object="chat.completion.chunk",
+        choices=[SimpleNamespace(delta=delta)] if delta is not None else [],
+    )
+
+
+def test_stream_response_encoder_matches_format_stream_response():
+    history_metadata = {"conversation_id": "abc", "title": "Café"}
+    encoder = StreamResponseEncoder(history_metadata, "apim-1")
+    chunks = [
+        _chunk(None, chunk_id=""),
+        _chunk(SimpleNamespace(role="assistant", content="", context={"citations": [{"title": "doc"}]})),
+        _chunk(SimpleNamespace(role="assistant", content="")),
+        _chunk(SimpleNamespace(role=None, content="Hello \"world\"\n")),
+        _chunk(SimpleNamespace(role=None, content=" again"), chunk_id="chatcmpl-2"),
+    ]
+
+    for chunk in chunks:
+        line = encoder.encode(chunk)
+        assert line.endswith("\n")
+        assert json.loads(line) == format_stream_response(chunk, history_metadata, "apim-1")
+
+
+@pytest.mark.asyncio
+async def test_format_stream_as_ndjson_exception():
+    async def failing_stream():
+        yield _chunk(SimpleNamespace(role=None, content="partial"))
+        raise Exception("upstream closed")
+
+    lines = [line async for line in format_stream_as_ndjson(failing_stream(), {}, None)]
+    assert json.loads(lines[0])["choices"][0]["messages"][0]["content"] == "partial"
+    assert lines[1] == '{"error": "upstream closed"}'
+
+
+async def _stream(chunks, delay=0):
+    for chunk in chunks:
+        if delay:
+            await asyncio.sleep(delay)
+        yield chunk
+
+
+@pytest.mark.asyncio
+async def test_stream_coalescer_merges_assistant_deltas():
+    coalescer = StreamCoalescer(max_bytes=8, window_ms=1000)
+    chunks = [
+        _chunk(None, chunk_id=""),
+        _chunk(SimpleNamespace(role="assistant", content="", context={"citations": []})),
+        _chunk(SimpleNamespace(role=None, content="Hello")),
+        _chunk(SimpleNamespace(role=None, content=" wo")),
+        _chunk(SimpleNamespace(role=None, content="rld")),
+        _chunk(SimpleNamespace(role=None, content=" and")),
+        _chunk(SimpleNamespace(role=None, content=" more")),
+        _chunk(SimpleNamespace(role=None, content="!")),
+    ]
+
+    frames = [message async for _, message in coalescer.coalesce(_stream(chunks))]
+
+    assert frames == [
+        {"role": "tool", "content": json.dumps({"citations": []})},
+        {"role": "assistant", "content": "Hello"},
+        {"role": "assistant", "content": " world and"},
+        {"role": "assistant", "content": " more!"},
+    ]
+    assert coalescer.get_statistics()["upstream_chunks"] == 8
+    assert coalescer.get_statistics()["frames"] == 4
+
+
+@pytest.mark.asyncio
+async def test_stream_coalescer_flushes_after_window():
+    coalescer = StreamCoalescer(max_bytes=1024, window_ms=5)
+    chunks = [_chunk(SimpleNamespace(role=None, content=token)) for token in ["a", "b", "c"]]
+
+    frames = [message["content"] async for _, message in coalescer.coalesce(_stream(chunks, delay=0.02))]
+
+    # Chunks arrive slower than the window, so nothing is held back
+    assert frames == ["a", "b", "c"]
+
+
+class FakeUpstreamStream:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.closed = False
+
+    async def __aiter__(self):
+        for token in self.tokens:
+            if self.closed:
+                return
+            await asyncio.sleep(0)
+            yield _chunk(SimpleNamespace(role=None, content=token))
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("coalescer", [None, StreamCoalescer(max_bytes=1, window_ms=0)])
+async def test_format_stream_as_ndjson_closes_upstream_on_disconnect(coalescer):
+    upstream = FakeUpstreamStream(["a", "b", "c", "d"])
+    tracker = StreamCancellationTracker()
+    stream = format_stream_as_ndjson(
+        upstream, {}, None, coalescer=coalescer, cancellation_tracker=tracker, max_tokens=100
+    )
+
+    await stream.__anext__()
+    await stream.__anext__()
+    await stream.aclose()
+
+    assert upstream.closed
+    assert tracker.get_statistics() == {
+        "cancellations": 1,
+        "chunks_before_cancel": 2,
+        "estimated_tokens_saved": 98,
+    }
+
+
+@pytest.mark.asyncio
+async def test_format_stream_as_ndjson_completed_stream_is_not_a_cancellation():
+    upstream = FakeUpstreamStream(["a", "b"])
+    tracker = StreamCancellationTracker()
+
+    lines = [line async for line in format_stream_as_ndjson(upstream, {}, None, cancellation_tracker=tracker)]
+
+    assert len(lines) == 2
+    assert not upstream.closed
+    assert tracker.get_statistics()["cancellations"] == 0
+
+
+def test_sampled_request_body_is_logged_at_default_level(caplog):
+    assert logging.getLogger().getEffectiveLevel() == logging.WARNING
+
+    log_request_body({"messages": [{"role": "user", "content": "hi"}], "api_key": "secret"}, sample_rate=1.0)
+
+    assert [record.name for record in caplog.records] == ["request_body"]
+    assert "SAMPLED REQUEST BODY" in caplog.text
+    assert "secret" not in caplog.text
@@ -0,0 +1,117 @@
+"""
+Measures the latency and request units (RU) of writing one chat message to the
+conversation history.
+
+Compares the previous three round trips (upsert the message, query the parent
+conversation, upsert the conversation) with the single transactional batch used
+by CosmosConversationClient.create_message. Runs against the Cosmos DB account
+configured in the environment (AZURE_COSMOSDB_* settings, .env is honoured) in
+a throwaway partition that is deleted afterwards.
+
+    python tools/benchmark_create_message.py
+"""
+import os
+import sys
+import time
+import uuid
+import asyncio
+import statistics
+from datetime import datetime
+
+# Add parent directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from dotenv import load_dotenv
+from azure.identity.aio import DefaultAzureCredential
+
+from backend.history.cosmosdbservice import CosmosConversationClient
+
+load_dotenv()
+
+MESSAGES = 50
+
+
+def request_charge(cosmos_conversation_client):
+    headers = cosmos_conversation_client.container_client.client_connection.last_response_headers
+    return float(headers.get("x-ms-request-charge", 0))
+
+
+async def legacy_create_message(cosmos_conversation_client, conversation_id, user_id, content):
+    '''The previous implementation: three round trips, measured one by one.'''
+    container = cosmos_conversation_client.container_client
+    charge = 0.0
+    message = cosmos_conversation_client._build_message(
+        str(uuid.uuid4()), conversation_id, user_id, {"role": "user", "content": content}
+    )
+    await container.upsert_item(message)
+    charge += request_charge(cosmos_conversation_client)
+
+    query = "SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId"
+    parameters = [{"name": "@conversationId", "value": conversation_id}, {"name": "@userId", "value": user_id}]
+    conversations = [item async for item in container.query_items(query=query, parameters=parameters)]
+    charge += request_charge(cosmos_conversation_client)
+
+    conversation = conversations[0]
+    conversation["updatedAt"] = message["createdAt"]
+    await container.upsert_item(conversation)
+    charge += request_charge(cosmos_conversation_client)
+    return charge
+
+
+async def batched_create_message(cosmos_conversation_client, conversation_id, user_id, content):
+    await cosmos_conversation_client.create_message(
+        str(uuid.uuid4()), conversation_id, user_id, {"role": "user", "content": content}
+    )
+    return request_charge(cosmos_conversation_client)
+
+
+async def measure(name, create, cosmos_conversation_client, conversation_id, user_id):
+    latencies = []
+    charges = []
+    for i in range(MESSAGES):
+        start = time.perf_counter()
+        charges.append(await create(cosmos_conversation_client, conversation_id, user_id, f"Benchmark message {i}"))
+        latencies.append(time.perf_counter() - start)
+
+    print(
+        f"{name}: median {statistics.median(latencies) * 1000:6.1f} ms, "
+        f"p95 {sorted(latencies)[int(MESSAGES * 0.95) - 1] * 1000:6.1f} ms, "
+        f"{statistics.mean(charges):5.2f} RU per message"
+    )
+
+
+async def main():
+    account = os.environ.get("AZURE_COSMOSDB_ACCOUNT")
+    if not account:
+        sys.exit("Set AZURE_COSMOSDB_ACCOUNT, AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_CONVERSATIONS_CONTAINER")
+
+    account_key = os.environ.get("AZURE_COSMOSDB_ACCOUNT_KEY")
+    credential = account_key or DefaultAzureCredential()
+    cosmos_conversation_client = CosmosConversationClient(
+        cosmosdb_endpoint=f"https://{account}.documents.azure.com:443/",
+        credential=credential,
+        database_name=os.environ["AZURE_COSMOSDB_DATABASE"],
+        container_name=os.environ["AZURE_COSMOSDB_CONVERSATIONS_CONTAINER"],
+    )
+
+    user_id = f"benchmark-{uuid.uuid4()}"
+    try:
+        await cosmos_conversation_client.warm_up()
+        conversation = await cosmos_conversation_client.create_conversation(
+            user_id=user_id, title="create_message benchmark", created_at=datetime.utcnow().isoformat()
+        )
+        await measure("upsert + query + upsert", legacy_create_message, cosmos_conversation_client, conversation["id"], user_id)
+        await measure("transactional batch    ", batched_create_message, cosmos_conversation_client, conversation["id"], user_id)
+    finally:
+        container = cosmos_conversation_client.container_client
+        query = "SELECT c.id FROM c WHERE c.userId = @userId"
+        parameters = [{"name": "@userId", "value": user_id}]
+        async for item in container.query_items(query=query, parameters=parameters):
+            await container.delete_item(item=item["id"], partition_key=user_id)
+        await cosmos_conversation_client.close()
+        if not account_key:
+            await credential.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
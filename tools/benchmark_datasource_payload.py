@@ -0,0 +1,103 @@
+"""
+Micro-benchmark for the per-request cost of building the On Your Data payload.
+
+Compares rebuilding the full data source payload on every request (previous
+behaviour) with rendering it from the precompiled template. Uses placeholder
+configuration, no Azure resources are called.
+
+    python tools/benchmark_datasource_payload.py
+"""
+import os
+import sys
+import time
+import asyncio
+
+# Placeholder configuration for a vector-enabled Azure AI Search data source
+BENCHMARK_ENV = {
+    "AZURE_OPENAI_MODEL": "gpt-35-turbo-16k",
+    "AZURE_OPENAI_KEY": "placeholder",
+    "AZURE_OPENAI_ENDPOINT": "https://placeholder.openai.azure.com/",
+    "AZURE_OPENAI_EMBEDDING_NAME": "text-embedding-ada-002",
+    "AZURE_OPENAI_SYSTEM_MESSAGE": "You are an AI assistant that helps people find information.",
+    "DATASOURCE_TYPE": "AzureCognitiveSearch",
+    "AZURE_SEARCH_SERVICE": "placeholder",
+    "AZURE_SEARCH_INDEX": "placeholder-index",
+    "AZURE_SEARCH_KEY": "placeholder",
+    "AZURE_SEARCH_QUERY_TYPE": "vectorSemanticHybrid",
+    "AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG": "default",
+    "AZURE_SEARCH_CONTENT_COLUMNS": "content|chunk",
+    "AZURE_SEARCH_VECTOR_COLUMNS": "contentVector",
+    "AZURE_SEARCH_TITLE_COLUMN": "title",
+    "AZURE_SEARCH_URL_COLUMN": "url",
+    "AZURE_SEARCH_FILENAME_COLUMN": "filepath",
+}
+for key, value in BENCHMARK_ENV.items():
+    os.environ.setdefault(key, value)
+os.environ.setdefault("DOTENV_PATH", os.devnull)
+
+# Add parent directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import app
+from backend.settings import app_settings
+
+ITERATIONS = 20000
+
+
+async def time_async(func):
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        await func()
+    return time.perf_counter() - start
+
+
+def report(name, rebuild_seconds, template_seconds):
+    rebuild_us = rebuild_seconds / ITERATIONS * 1e6
+    template_us = template_seconds / ITERATIONS * 1e6
+    print(f"{name}")
+    print(f"  rebuild per request:  {rebuild_us:8.2f} us")
+    print(f"  template per request: {template_us:8.2f} us  ({rebuild_us / template_us:.1f}x faster)")
+
+
+async def benchmark_app_payload():
+    quart_app = app.create_app()
+    async with quart_app.test_request_context("/conversation", method="POST"):
+        async def rebuild():
+            user_id = app.get_authenticated_user_details(app.request.headers)["user_principal_id"]
+            data_source = app.build_data_source_template()
+            parameters = dict(data_source["parameters"])
+            parameters["filter"] = app.generateFilterStringForConversation(None, user_id, "conversation")
+            return {"type": data_source["type"], "parameters": parameters}
+
+        async def from_template():
+            return await app.get_configured_data_source("conversation")
+
+        assert await rebuild() == await from_template()
+        report(
+            "app.get_configured_data_source",
+            await time_async(rebuild),
+            await time_async(from_template),
+        )
+
+
+async def benchmark_settings_payload():
+    datasource = app_settings.datasource
+
+    async def rebuild():
+        template = datasource.construct_payload_template()
+        return {"type": template["type"], "parameters": dict(template["parameters"])}
+
+    async def from_template():
+        return await datasource.construct_payload_configuration()
+
+    assert await rebuild() == await from_template()
+    report(
+        "DatasourcePayloadConstructor.construct_payload_configuration",
+        await time_async(rebuild),
+        await time_async(from_template),
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(benchmark_app_payload())
+    asyncio.run(benchmark_settings_payload())
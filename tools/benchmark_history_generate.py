@@ -0,0 +1,192 @@
+"""
+Benchmark for the time to first byte of /history/generate.
+
+Compares writing the conversation and the user message to Cosmos DB before the
+chat completion request is sent (previous behaviour) with issuing the writes
+concurrently with the request. Cosmos DB and Azure OpenAI are replaced by local
+stand-ins with fixed latencies, no Azure resources are called.
+
+    python tools/benchmark_history_generate.py
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import statistics
+
+BENCHMARK_ENV = {
+    "AZURE_OPENAI_MODEL": "gpt-35-turbo-16k",
+    "AZURE_OPENAI_KEY": "placeholder",
+    "AZURE_OPENAI_ENDPOINT": "https://placeholder.openai.azure.com/",
+    "AZURE_OPENAI_SYSTEM_MESSAGE": "You are an AI assistant that helps people find information.",
+    "AZURE_COSMOSDB_ACCOUNT": "placeholder",
+    "AZURE_COSMOSDB_ACCOUNT_KEY": "placeholder",
+    "AZURE_COSMOSDB_DATABASE": "db_conversation_history",
+    "AZURE_COSMOSDB_CONVERSATIONS_CONTAINER": "conversations",
+}
+for key, value in BENCHMARK_ENV.items():
+    os.environ.setdefault(key, value)
+os.environ.setdefault("DOTENV_PATH", os.devnull)
+
+# Add parent directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import httpx
+from azure.cosmos import exceptions
+
+import app
+from backend.history import cosmosdbservice
+
+ITERATIONS = 20
+COSMOS_LATENCY = 0.015  # per Cosmos DB operation
+AOAI_FIRST_TOKEN_LATENCY = 0.150
+
+
+class LocalContainer:
+    '''In-memory stand-in for a Cosmos DB container with a fixed per-operation latency.'''
+
+    def __init__(self):
+        self.items = {}
+        self.operations = 0
+
+    async def _round_trip(self):
+        self.operations += 1
+        await asyncio.sleep(COSMOS_LATENCY)
+
+    async def read(self):
+        await self._round_trip()
+        return {"id": "conversations"}
+
+    async def upsert_item(self, item):
+        await self._round_trip()
+        self.items[item["id"]] = dict(item)
+        return dict(item)
+
+    async def read_item(self, item, partition_key):
+        await self._round_trip()
+        if item not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(message="Not found")
+        return dict(self.items[item])
+
+    async def patch_item(self, item, partition_key, patch_operations):
+        await self._round_trip()
+        for operation in patch_operations:
+            self.items[item][operation["path"].lstrip("/")] = operation["value"]
+        return dict(self.items[item])
+
+    async def execute_item_batch(self, batch_operations, partition_key):
+        await self._round_trip()
+        results = []
+        for operation, args in batch_operations:
+            if operation == "read":
+                results.append({"statusCode": 200, "resourceBody": dict(self.items[args[0]])})
+            elif operation == "upsert":
+                self.items[args[0]["id"]] = dict(args[0])
+                results.append({"statusCode": 200, "resourceBody": dict(args[0])})
+            else:
+                item_id, patch_operations = args
+                for patch in patch_operations:
+                    self.items[item_id][patch["path"].lstrip("/")] = patch["value"]
+                results.append({"statusCode": 200, "resourceBody": dict(self.items[item_id])})
+        return results
+
+    async def query_items(self, query, parameters):
+        await self._round_trip()
+        values = {parameter["name"]: parameter["value"] for parameter in parameters}
+        for item in list(self.items.values()):
+            if item.get("id") == values.get("@conversationId") and item.get("type") == "conversation":
+                yield dict(item)
+
+
+class LocalCosmosClient:
+    def __init__(self, endpoint, credential):
+        self.container = LocalContainer()
+
+    def get_database_client(self, name):
+        return self
+
+    def get_container_client(self, name):
+        return self.container
+
+    async def close(self):
+        pass
+
+
+class SlowCompletionStream(httpx.AsyncByteStream):
+    async def __aiter__(self):
+        await asyncio.sleep(AOAI_FIRST_TOKEN_LATENCY)
+        base = {"id": "chatcmpl-1", "object": "chat.completion.chunk", "created": 1, "model": "gpt-35-turbo"}
+        for token in ["Hello", " there", "."]:
+            chunk = {**base, "choices": [{"index": 0, "delta": {"content": token}}]}
+            yield f"data: {json.dumps(chunk)}\n\n".encode()
+        yield b"data: [DONE]\n\n"
+
+
+def completion_handler(request):
+    return httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=SlowCompletionStream())
+
+
+async def time_to_first_byte(response):
+    async with response.response as body:
+        async for line in body:
+            return line
+
+
+async def sequential(quart_app, request_json):
+    '''Previous behaviour: both history writes complete before the completion request starts.'''
+    async with quart_app.test_request_context("/history/generate", method="POST", json=request_json):
+        start = time.perf_counter()
+        cosmos_conversation_client = quart_app.cosmos_conversation_client
+        conversation = await cosmos_conversation_client.create_conversation(user_id="00000000-0000-0000-0000-000000000000", title="Benchmark")
+        await cosmos_conversation_client.create_message(
+            uuid=str(uuid.uuid4()),
+            conversation_id=conversation["id"],
+            user_id="00000000-0000-0000-0000-000000000000",
+            input_message=request_json["messages"][-1],
+        )
+        request_body = dict(request_json, history_metadata={"conversation_id": conversation["id"]})
+        response = await app.conversation_internal(request_body, app.request.headers)
+        await time_to_first_byte(response)
+        return time.perf_counter() - start
+
+
+async def overlapped(quart_app, request_json):
+    async with quart_app.test_request_context("/history/generate", method="POST", json=request_json):
+        start = time.perf_counter()
+        response = await app.add_conversation()
+        await time_to_first_byte(response)
+        elapsed = time.perf_counter() - start
+        await asyncio.gather(*app._history_writes)
+        return elapsed
+
+
+async def main():
+    cosmosdbservice.CosmosClient = LocalCosmosClient
+    app.create_pooled_http_client = lambda **kwargs: httpx.AsyncClient(transport=httpx.MockTransport(completion_handler))
+    app.generate_title = lambda messages: asyncio.sleep(0, result="Benchmark")
+
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        container = quart_app.cosmos_conversation_client.container_client
+        results = {}
+        for name, run in [("sequential writes", sequential), ("overlapped writes", overlapped)]:
+            timings = []
+            operations = container.operations
+            for i in range(ITERATIONS):
+                request_json = {"messages": [{"id": str(i), "role": "user", "content": "What is the PTO policy?"}]}
+                timings.append(await run(quart_app, request_json))
+            results[name] = statistics.median(timings)
+            print(
+                f"{name}: median time to first byte {results[name] * 1000:7.1f} ms "
+                f"({(container.operations - operations) / ITERATIONS:.0f} Cosmos operations per request)"
+            )
+
+    saved = results["sequential writes"] - results["overlapped writes"]
+    print(f"saved {saved * 1000:.1f} ms per new conversation "
+          f"(Cosmos latency {COSMOS_LATENCY * 1000:.0f} ms, first token after {AOAI_FIRST_TOKEN_LATENCY * 1000:.0f} ms)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
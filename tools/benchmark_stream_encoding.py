@@ -0,0 +1,78 @@
+"""
+Micro-benchmark for the per-chunk cost of encoding a streamed chat completion.
+
+Compares building a full response dict and serializing it with json.dumps for
+every chunk (previous behaviour) with StreamResponseEncoder, which encodes the
+stream envelope once. Uses synthetic chunks, no Azure resources are called.
+
+    python tools/benchmark_stream_encoding.py
+"""
+import os
+import sys
+import json
+import time
+
+# Add parent directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from openai.types.chat import ChatCompletionChunk
+
+from backend.utils import JSONEncoder, StreamResponseEncoder, format_stream_response
+
+ITERATIONS = 20
+TOKENS = [" The", " quick", " brown", " fox", " jumps", " over", " the", " lazy", " dog", "."] * 50
+
+HISTORY_METADATA = {
+    "conversation_id": "0b6fdd0e-5b43-4b44-9ef3-6d3b1f7c1c3e",
+    "title": "Benchmark conversation",
+    "date": "2024-01-01T00:00:00.000000",
+}
+APIM_REQUEST_ID = "8c7b1f2e-3d4a-4b5c-9d6e-7f8a9b0c1d2e"
+
+
+def make_chunks():
+    return [
+        ChatCompletionChunk(
+            id="chatcmpl-8benchmark",
+            model="gpt-35-turbo-16k",
+            created=1700000000,
+            object="chat.completion.chunk",
+            choices=[{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+        )
+        for token in TOKENS
+    ]
+
+
+def encode_per_chunk(chunks):
+    lines = []
+    for chunk in chunks:
+        response_obj = format_stream_response(chunk, HISTORY_METADATA, APIM_REQUEST_ID)
+        lines.append(json.dumps(response_obj, cls=JSONEncoder) + "\n")
+    return lines
+
+
+def encode_with_envelope(chunks):
+    encoder = StreamResponseEncoder(HISTORY_METADATA, APIM_REQUEST_ID)
+    return [encoder.encode(chunk) for chunk in chunks]
+
+
+def measure(func, chunks):
+    start = time.process_time()
+    for _ in range(ITERATIONS):
+        lines = func(chunks)
+    elapsed = time.process_time() - start
+    per_chunk_us = elapsed / (ITERATIONS * len(chunks)) * 1e6
+    per_chunk_bytes = sum(len(line.encode("utf-8")) for line in lines) / len(chunks)
+    return per_chunk_us, per_chunk_bytes, lines
+
+
+if __name__ == "__main__":
+    chunks = make_chunks()
+    before_us, before_bytes, before_lines = measure(encode_per_chunk, chunks)
+    after_us, after_bytes, after_lines = measure(encode_with_envelope, chunks)
+
+    assert [json.loads(line) for line in before_lines] == [json.loads(line) for line in after_lines]
+
+    print(f"{len(chunks)} chunks per stream, {ITERATIONS} streams")
+    print(f"  per-chunk dict + json.dumps: {before_us:6.2f} us CPU  {before_bytes:6.1f} bytes")
+    print(f"  StreamResponseEncoder:       {after_us:6.2f} us CPU  {after_bytes:6.1f} bytes  ({before_us / after_us:.1f}x faster)")